@@ -3,6 +3,7 @@ from fastapi import APIRouter, HTTPException, Security
 from fastapi.security import HTTPAuthorizationCredentials
 import jwt as PyJWT
 from app.api.models import Result, Token, UserLogin
+from app.api.offload import runBlocking
 from app.core.lib import Setting
 from app.utils.common import md5_str
 from app.utils.jwt import security, MAX_TOKENS_PER_USER, SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES, create_access_token, user_tokens, token_blacklist, save_blacklist, save_user_tokens
@@ -14,7 +15,7 @@ router = APIRouter(
 # 路由定义
 @router.post("/login", response_model=Token, summary="登录", tags=["身份认证"])
 async def login_for_access_token(user_data: UserLogin):
-    settings = Setting()
+    settings = await runBlocking(Setting)
     if user_data.username != settings.username or md5_str(user_data.password) != settings.password:
         raise HTTPException(
             status_code=401,
@@ -34,7 +35,7 @@ async def login_for_access_token(user_data: UserLogin):
     )
     # 记录用户token
     user_tokens[user_data.username].add(access_token)
-    save_user_tokens()
+    await runBlocking(save_user_tokens)
     
     return {"access_token": access_token, "token_type": "bearer"}
 
@@ -47,13 +48,13 @@ async def logout(credentials: HTTPAuthorizationCredentials = Security(security))
         if username:
             # 从用户token记录中移除
             user_tokens[username].discard(credentials.credentials)
-            save_user_tokens()
+            await runBlocking(save_user_tokens)
     except:
         pass  # 即使token解码失败也继续处理
     
     # 将token加入黑名单
     today = datetime.now(timezone.utc)
     token_blacklist[today.date()].add(credentials.credentials)
-    save_blacklist(token_blacklist)
+    await runBlocking(save_blacklist, token_blacklist)
     
     return Result(code=200, msg="已注销", data={})
\ No newline at end of file
@@ -46,6 +46,10 @@ class TaskItem(BaseModel):
     path_of_115: str = Field("/mnt/115", title="115挂载根目录")
     copy_meta_file: int = Field(1, title="元数据选项") # 元数据选项：1-关闭，2-复制，3-软链接
     copy_delay: int = Field(1, title="元数据复制间隔") 
+    strm_workers: int = Field(4, title="STRM写入线程数", ge=1, le=32)
+    meta_workers: int = Field(2, title="元数据复制线程数", ge=1, le=16)
+    meta_rate: float = Field(0, title="元数据复制限速(MB/s)，0为不限速", ge=0)
+    meta_update: bool = Field(False, title="检查元数据更新")
     webdav_url: Optional[str] = Field("", title="webdav服务器链接")
     webdav_username: Optional[str] = Field("", title="webdav服务器用户名")
     webdav_password: Optional[str] = Field("", title="webdav服务器密码")
@@ -0,0 +1,44 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import os
+from typing import Callable, TypeVar
+
+from fastapi import HTTPException
+
+# API中读写配置、提交任务等阻塞操作使用的线程数
+API_WORKERS = int(os.getenv('API_WORKERS', '8'))
+# 浏览目录使用的线程数，和其他操作分开，挂载卡住时不会占满API的线程
+API_FS_WORKERS = int(os.getenv('API_FS_WORKERS', '4'))
+# 阻塞操作的超时时间，秒
+API_TIMEOUT = float(os.getenv('API_TIMEOUT', '10'))
+# 浏览挂载目录的超时时间，秒
+API_FS_TIMEOUT = float(os.getenv('API_FS_TIMEOUT', '20'))
+# 访问外部服务(例如测试Telegram通知)的超时时间，秒
+API_NET_TIMEOUT = float(os.getenv('API_NET_TIMEOUT', '30'))
+
+T = TypeVar('T')
+
+_executor = ThreadPoolExecutor(max_workers=max(1, API_WORKERS), thread_name_prefix='api')
+_fsExecutor = ThreadPoolExecutor(max_workers=max(1, API_FS_WORKERS), thread_name_prefix='api-fs')
+
+
+async def runBlocking(func: Callable[..., T], *args, timeout: float = API_TIMEOUT, executor: ThreadPoolExecutor | None = None, **kwargs) -> T:
+    """
+    在线程池中执行阻塞操作，事件循环不会被慢的磁盘或者网络卡住
+    超时后返回504，已经开始的操作会在后台继续执行完，但不再占用请求
+    :param func: 阻塞的函数
+    :param timeout: 超时时间，秒
+    :param executor: 线程池，默认使用API的线程池
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(executor or _executor, functools.partial(func, *args, **kwargs))
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail='操作超时，请稍后重试')
+
+
+async def runFs(func: Callable[..., T], *args, timeout: float = API_FS_TIMEOUT, **kwargs) -> T:
+    # 访问挂载目录等可能很慢的文件系统操作，使用单独的线程池
+    return await runBlocking(func, *args, timeout=timeout, executor=_fsExecutor, **kwargs)
@@ -1,13 +1,18 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 from app.utils.common import md5_str
+from app.utils.fs import DirCache
 from app.utils.jwt import verify_token
+from app.utils.log import logFile
+from app.utils.logreader import followLog, readRange, readTail
 from app.api.models import SettingUpdate, AccountCookie, TaskItem, Result
+from app.api.offload import API_NET_TIMEOUT, runBlocking, runFs
 import os
 import signal
-from multiprocessing import Process
 
-from app.modules.job import StartJob
-from app.core.lib import Libs, OO5List, Setting, TGBot
+from app.modules.scheduler import GetScheduler
+from app.core.progress import followProgress, GetProgress
+from app.core.lib import Lib, Libs, OO5List, Setting, TGBot
 
 LIBS = Libs()
 o5List = OO5List()
@@ -19,109 +24,153 @@ router = APIRouter(
 
 @router.get("/libs", response_model=Result, summary="获取同步目录列表", tags=["同步目录管理"])
 async def get_libs(_: str = Depends(verify_token)) -> Result:
-    data = [item.getJson() for item in LIBS.list()]
+    data = [item.getJson() for item in await runBlocking(LIBS.list)]
     return Result(code=200, msg="", data=data)
 
 @router.post("/libs", response_model=Result, summary="添加同步目录", tags=["同步目录管理"])
 async def add_lib(data: TaskItem, _: str = Depends(verify_token)) -> Result:
-    rs, msg = LIBS.add(data.model_dump(exclude_unset=True))
+    rs, msg = await runBlocking(LIBS.add, data.model_dump(exclude_unset=True))
     if not rs:
         raise HTTPException(status_code=500, detail=msg)
     return Result(code=200, msg="", data={})
 
 @router.get("/lib/{key}", response_model=Result, summary="获取同步目录详情", tags=["同步目录管理"])
 async def get_lib(key: str, _: str = Depends(verify_token)) -> Result:
-    lib = LIBS.getLib(key)
+    lib = await runBlocking(LIBS.getLib, key)
     if lib is None:
         raise HTTPException(status_code=404, detail="同步目录不存在")
     return {"code": 200, "msg": "", "data": lib.getJson()}
 
 @router.delete("/lib/{key}", response_model=Result, summary="删除同步目录", tags=["同步目录管理"])
 async def delete_lib(key: str, _: str = Depends(verify_token)) -> Result:
-    rs, msg = LIBS.deleteLib(key)
+    rs, msg = await runBlocking(LIBS.deleteLib, key)
     if not rs:
         raise HTTPException(status_code=500, detail=msg)
     return {"code": 200, "msg": "", "data": {}}
 
 @router.put("/lib/{key}", response_model=Result, summary="更新同步目录", tags=["同步目录管理"])
 async def update_lib(key: str, data: TaskItem, _: str = Depends(verify_token)) -> Result:
-    rs, msg = LIBS.updateLib(key, data.model_dump(exclude_unset=True))
+    rs, msg = await runBlocking(LIBS.updateLib, key, data.model_dump(exclude_unset=True))
     if not rs:
         raise HTTPException(status_code=500, detail=msg)
     return {"code": 200, "msg": "", "data": {}}
 
 @router.post("/lib/sync/{key}", response_model=Result, summary="运行指定同步目录", tags=["同步目录管理"])
 async def sync_lib(key: str, _: str = Depends(verify_token)) -> Result:
-    lib = LIBS.getLib(key)
+    lib = await runBlocking(LIBS.getLib, key)
     if lib is None:
         raise HTTPException(status_code=404, detail="同步目录不存在")
     if lib.extra.pid > 0:
         raise HTTPException(status_code=500, detail="该目录正在同步中...")
-    p1 = Process(target=StartJob, kwargs={'key': key})
-    p1.start()
-    return {"code": 200, "msg": "已启动任务", "data": {}}
+    rs, msg = await runBlocking(GetScheduler().submit, key)
+    if not rs:
+        raise HTTPException(status_code=500, detail=msg)
+    return {"code": 200, "msg": "已加入同步队列", "data": {}}
+
+def stopLib(lib: Lib):
+    try:
+        os.kill(lib.extra.pid, signal.SIGILL)
+        lib.extra.status = 3
+    except:
+        lib.extra.status = 1
+    lib.extra.pid = 0
+    LIBS.saveExtra(lib)
 
 @router.post("/lib/stop/{key}", response_model=Result, summary="停止指定同步目录", tags=["同步目录管理"])
 async def stop_lib(key: str, _: str = Depends(verify_token)) -> Result:
-    lib = LIBS.getLib(key)
+    lib = await runBlocking(LIBS.getLib, key)
     if lib is None:
         raise HTTPException(status_code=404, detail="同步目录不存在")
     if lib.extra.pid > 0:
-        try:
-            os.kill(lib.extra.pid, signal.SIGILL)
-            lib.extra.status = 3
-        except:
-            lib.extra.status = 1
-        lib.extra.pid = 0
-        LIBS.saveExtra(lib)
+        await runBlocking(stopLib, lib)
     return {"code": 200, "msg": "已停止", "data": {}}
 
+def getLogFile(key: str) -> str:
+    # key直接拼进文件路径，不允许包含目录
+    if key == '' or key != os.path.basename(key) or key.startswith('.'):
+        raise HTTPException(status_code=404, detail="日志不存在")
+    return logFile(key)
+
 @router.get("/lib/log/{key}", response_model=Result, summary="获取指定同步目录的日志", tags=["同步目录管理"])
-async def get_lib_log(key: str, _: str = Depends(verify_token)) -> Result:
-    logFile = os.path.abspath(f"../../data/logs/{key}.log")
-    if not os.path.exists(logFile):
-        return Result(code=200, msg="", data="")
-    with open(logFile, mode='r', encoding='utf-8') as logfd:
-        content = logfd.read()
-    content = content.replace("\n", "<br />")
+async def get_lib_log(key: str, lines: int = Query(1000, ge=1, le=100000, description="返回最后多少行"), _: str = Depends(verify_token)) -> Result:
+    chunk = await runBlocking(readTail, getLogFile(key), lines)
+    content = chunk.content.replace("\n", "<br />")
     return {"code": 200, "msg": "", "data": content}
 
+@router.get("/lib/log/{key}/tail", response_model=Result, summary="获取指定同步目录日志的最后几行", tags=["同步目录管理"])
+async def get_lib_log_tail(key: str, lines: int = Query(100, ge=1, le=100000, description="行数"), _: str = Depends(verify_token)) -> Result:
+    chunk = await runBlocking(readTail, getLogFile(key), lines)
+    return Result(code=200, msg="", data=chunk.getJson())
+
+@router.get("/lib/log/{key}/range", response_model=Result, summary="按字节偏移分段获取指定同步目录的日志", tags=["同步目录管理"])
+async def get_lib_log_range(key: str, offset: int = Query(0, ge=0, description="起始字节偏移，使用上一次返回的end继续读取"), limit: int = Query(65536, ge=1, le=4194304, description="最多读取的字节数"), _: str = Depends(verify_token)) -> Result:
+    chunk = await runBlocking(readRange, getLogFile(key), offset, limit)
+    return Result(code=200, msg="", data=chunk.getJson())
+
+@router.get("/lib/log/{key}/stream", summary="实时推送指定同步目录的日志(SSE)", tags=["同步目录管理"])
+async def stream_lib_log(key: str, request: Request, offset: int | None = Query(None, ge=0, description="起始字节偏移，不传时只推送新写入的日志"), _: str = Depends(verify_token)):
+    file = getLogFile(key)
+    lastEventId = request.headers.get('last-event-id')
+    if lastEventId is not None and lastEventId.isdigit():
+        offset = int(lastEventId)
+    return StreamingResponse(
+        followLog(file, offset, is_disconnected=request.is_disconnected),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.get("/lib/progress/{key}", response_model=Result, summary="获取指定同步目录的同步进度", tags=["同步目录管理"])
+async def get_lib_progress(key: str, _: str = Depends(verify_token)) -> Result:
+    if await runBlocking(LIBS.getLib, key) is None:
+        raise HTTPException(status_code=404, detail="同步目录不存在")
+    return Result(code=200, msg="", data=await runBlocking(GetProgress, key))
+
+@router.get("/lib/progress/{key}/stream", summary="实时推送指定同步目录的同步进度(SSE)", tags=["同步目录管理"])
+async def stream_lib_progress(key: str, request: Request, _: str = Depends(verify_token)):
+    if await runBlocking(LIBS.getLib, key) is None:
+        raise HTTPException(status_code=404, detail="同步目录不存在")
+    return StreamingResponse(
+        followProgress(key, is_disconnected=request.is_disconnected),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @router.get("/oo5list", response_model=Result, summary="获取115账号列表", tags=["115账号管理"])
 async def get_oo5_list(_: str = Depends(verify_token)) -> Result:
-    data = [item.getJson() for item in o5List.getList()]
+    data = [item.getJson() for item in await runBlocking(o5List.getList)]
     return Result(code=200, msg="", data=data)
 
 @router.post("/oo5list", response_model=Result, summary="添加115账号", tags=["115账号管理"])
 async def add_oo5(data: AccountCookie, _: str = Depends(verify_token)) -> Result:
-    rs, msg = o5List.add(data.model_dump(exclude_unset=True))
+    rs, msg = await runBlocking(o5List.add, data.model_dump(exclude_unset=True))
     if not rs:
         raise HTTPException(status_code=500, detail=msg)
     return Result(code=200, msg="", data={})
 
 @router.get("/oo5/{key}", response_model=Result, summary="获取115账号详情", tags=["115账号管理"])
 async def get_oo5(key: str, _: str = Depends(verify_token)) -> Result:
-    oo5 = o5List.get(key)
+    oo5 = await runBlocking(o5List.get, key)
     if oo5 is None:
         raise HTTPException(status_code=404, detail="115账号不存在")
     return Result(code=200, msg="", data=oo5.getJson())
 
 @router.delete("/oo5/{key}", summary="删除115账号", tags=["115账号管理"])
 async def delete_oo5(key: str, _: str = Depends(verify_token)) -> Result:
-    rs, msg = o5List.delOO5(key)
+    rs, msg = await runBlocking(o5List.delOO5, key)
     if not rs:
         raise HTTPException(status_code=500, detail=msg)
     return Result(code=200, msg="", data={})
 
 @router.put("/oo5/{key}", response_model=Result, summary="更新115账号", tags=["115账号管理"])
 async def update_oo5(key: str, data: AccountCookie, _: str = Depends(verify_token)) -> Result:
-    rs, msg = o5List.updateOO5(key, data.model_dump(exclude_unset=True))
+    rs, msg = await runBlocking(o5List.updateOO5, key, data.model_dump(exclude_unset=True))
     if not rs:
         raise HTTPException(status_code=500, detail=msg)
     return Result(code=200, msg="", data={})
 
 @router.get("/settings", response_model=Result, summary="获取配置", tags=["配置管理"])
 async def get_settings(_: str = Depends(verify_token)) -> Result:
-    settings = Setting()
+    settings = await runBlocking(Setting)
     return Result(code=200, msg="", data=settings.__dict__)
 
 @router.post("/settings", response_model=Result, summary="更新配置", tags=["配置管理"])
@@ -129,16 +178,16 @@ async def update_settings(data: SettingUpdate, _: str = Depends(verify_token)) -
     if data.username == '' or data.password == '':
         raise HTTPException(status_code=500, detail="用户名密码不能为空")
     
-    settings = Setting()
+    settings = await runBlocking(Setting)
     settings.username = data.username
     settings.password = md5_str(data.password)
     settings.telegram_bot_token = data.telegram_bot_token
     settings.telegram_user_id = data.telegram_user_id
-    settings.save()
+    await runBlocking(settings.save)
     
     if settings.telegram_bot_token and settings.telegram_user_id:
-        bot = TGBot()
-        rs, msg = bot.sendMsg("通知配置成功，稍后您将在此收到运行通知")
+        bot = await runBlocking(TGBot)
+        rs, msg = await runBlocking(bot.sendMsg, "通知配置成功，稍后您将在此收到运行通知", timeout=API_NET_TIMEOUT)
         if not rs:
             raise HTTPException(
                 status_code=500, 
@@ -146,14 +195,31 @@ async def update_settings(data: SettingUpdate, _: str = Depends(verify_token)) -
             )
     return Result(code=200, msg="", data=settings.__dict__)
 
+dirCache = DirCache()
+
+def listDirs(base_dir: str, page: int | None, page_size: int) -> list[str] | dict:
+    try:
+        dirs = dirCache.list(base_dir)
+    except (FileNotFoundError, NotADirectoryError):
+        raise HTTPException(status_code=404, detail="目录不存在")
+    except PermissionError:
+        raise HTTPException(status_code=403, detail="没有权限访问该目录")
+    if page is None:
+        return list(dirs)
+    start = (page - 1) * page_size
+    return {"items": dirs[start:start + page_size], "total": len(dirs), "page": page, "page_size": page_size}
+
 @router.post("/dir", response_model=Result, summary="获取目录列表", tags=["目录管理"])
 async def get_dirs(data: dict = {}, _: str = Depends(verify_token)) -> Result:
+    # 传入page时分页返回：{items, total, page, page_size}，否则返回全部子目录的列表
     base_dir = data.get('base_dir', '/')
-    dirs = []
-    for dir in os.listdir(base_dir):
-        item = os.path.join(base_dir, dir)
-        if not os.path.isfile(item):
-            dirs.append(dir)
+    page = data.get('page')
+    try:
+        page = max(1, int(page)) if page is not None else None
+        page_size = min(1000, max(1, int(data.get('page_size', 100))))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="分页参数错误")
+    dirs = await runFs(listDirs, base_dir, page, page_size)
     return Result(code=200, msg="", data=dirs)
 
 @router.get("/job", response_model=Result, summary="获取任务列表", tags=["任务管理"])
@@ -161,16 +227,17 @@ async def start_job(path: str, _: str = Depends(verify_token)) -> Result:
     if not path:
         raise HTTPException(status_code=404, detail="同步目录不存在")
     
-    lib = LIBS.getByPath(path)
+    lib = await runBlocking(LIBS.getByPath, path)
     if lib is None:
         raise HTTPException(status_code=404, detail="同步目录不存在")
     if lib.extra.pid > 0:
         raise HTTPException(status_code=500, detail="该目录正在同步中...")
     
-    p1 = Process(target=StartJob, kwargs={'key': lib.key})
-    p1.start()
+    rs, msg = await runBlocking(GetScheduler().submit, lib.key)
+    if not rs:
+        raise HTTPException(status_code=500, detail=msg)
     return Result(
         code=200, 
-        msg=f'已启动任务，可调用API查询状态：/api/lib/{lib.key}', 
+        msg=f'已加入同步队列，可调用API查询状态：/api/lib/{lib.key}', 
         data={}
     )
\ No newline at end of file
@@ -0,0 +1,59 @@
+import threading
+
+from p115client import P115Client
+
+from app.core.lib import OO5, OO5List
+
+
+class ClientPool:
+    """
+    115客户端缓存，每个115账号一个P115Client，同一进程中的多次同步复用登录状态和HTTP长连接
+    客户端按创建时的cookie缓存，账号的cookie被修改后(其他进程修改也一样)，下次获取时自动替换
+    """
+    clients: dict[str, tuple[str, P115Client]] # OO5.key => (cookie, 客户端)
+    lock: threading.Lock
+
+    def __init__(self):
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def get(self, oo5: OO5) -> P115Client:
+        with self.lock:
+            cached = self.clients.get(oo5.key)
+            if cached is not None and cached[0] == oo5.cookie:
+                return cached[1]
+            client = P115Client(oo5.cookie)
+            self.clients[oo5.key] = (oo5.cookie, client)
+            return client
+
+    def evict(self, key: str):
+        with self.lock:
+            self.clients.pop(key, None)
+
+
+_pool = ClientPool()
+
+
+def GetClient(oo5: OO5) -> P115Client:
+    """
+    获取115账号的客户端，没有缓存或者cookie已经变化时新建
+    :param oo5: 115账号
+    """
+    return _pool.get(oo5)
+
+
+def CheckClient(oo5: OO5, client: P115Client) -> bool:
+    """
+    请求出错后检查cookie是否还有效，失效的话移出缓存，并把账号状态标记为失效
+    :param oo5: 115账号
+    :param client: 出错的客户端
+    :return: cookie是否有效，检查本身失败(例如网络错误)时按有效处理
+    """
+    try:
+        valid = client.login_status()
+    except Exception:
+        return True
+    if not valid:
+        _pool.evict(oo5.key)
+        OO5List().setStatus(oo5.key, 1, oo5.cookie)
+    return valid
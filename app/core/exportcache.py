@@ -0,0 +1,133 @@
+import os
+import sqlite3
+import time
+from typing import Iterable, Iterator
+
+# 导出的目录树缓存多少秒，只给排队中共用同一次导出的同步目录使用，0表示不使用缓存
+EXPORT_CACHE_TTL = float(os.getenv('EXPORT_CACHE_TTL', '600'))
+
+
+class ExportCache:
+    """
+    115目录树导出结果的缓存，同一个115账号下嵌套的同步目录共用上级目录的一次导出
+
+    每个115账号一个SQLite文件：data/config/exports/{账号key}.db
+    - exports: 导出根目录 => 导出完成的时间
+    - paths: 导出根目录下的全部路径，使用/分隔，和导出时解析的路径一致
+    - readers: 导出根目录 => 导出或者已经读取过这次导出的同步目录
+    每个同步目录对同一次导出只读取一次，再次同步时一定重新导出，不会拿到自己上次用过的目录树。
+    多个进程中的任务通过115账号的文件锁保证同时只有一个在导出，其他任务等待后直接读取缓存
+    """
+    cache_dir: str = os.path.abspath("./data/config/exports")
+    key: str
+    cache_file: str
+    ttl: float
+    conn: sqlite3.Connection | None
+    batch_size: int = 2000
+
+    def __init__(self, key: str, ttl: float = EXPORT_CACHE_TTL):
+        self.key = key
+        self.cache_file = os.path.join(self.cache_dir, '%s.db' % key)
+        self.ttl = ttl
+        self.conn = None
+
+    def connect(self) -> sqlite3.Connection:
+        if self.conn is not None:
+            return self.conn
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        conn = sqlite3.connect(self.cache_file, timeout=30)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS exports (root TEXT PRIMARY KEY, created_at REAL) WITHOUT ROWID')
+        conn.execute('CREATE TABLE IF NOT EXISTS paths (root TEXT, path TEXT, PRIMARY KEY (root, path)) WITHOUT ROWID')
+        conn.execute('CREATE TABLE IF NOT EXISTS readers (root TEXT, reader TEXT, PRIMARY KEY (root, reader)) WITHOUT ROWID')
+        conn.commit()
+        self.conn = conn
+        return conn
+
+    def findRoot(self, path: str, reader: str) -> str | None:
+        """
+        查找包含path、没有过期并且reader还没有读取过的导出根目录，没有返回None
+        :param path: 同步目录在115中的路径
+        :param reader: 同步目录key
+        """
+        if self.ttl <= 0 or not os.path.exists(self.cache_file):
+            return None
+        path = path.strip('/')
+        try:
+            rows = self.connect().execute(
+                'SELECT root FROM exports WHERE created_at + ? > ? AND root NOT IN (SELECT root FROM readers WHERE reader = ?) ORDER BY created_at DESC',
+                (self.ttl, time.time(), reader)).fetchall()
+        except sqlite3.Error:
+            return None
+        for row in rows:
+            root = row[0].strip('/')
+            if path == root or path.startswith(root + '/'):
+                return row[0]
+        return None
+
+    def markRead(self, root: str, reader: str):
+        # 记录reader已经读取过这次导出
+        conn = self.connect()
+        conn.execute('INSERT OR IGNORE INTO readers (root, reader) VALUES (?, ?)', (root, reader))
+        conn.commit()
+
+    def iterPaths(self, root: str, prefix: str) -> Iterator[str]:
+        # 返回缓存中prefix本身以及prefix下的全部路径，父目录先于子项返回
+        # prefix/下的路径都在 prefix/ 和 prefix0 之间（'0'是'/'之后的字符）
+        cursor = self.connect().execute(
+            'SELECT path FROM paths WHERE root = ? AND (path = ? OR (path >= ? AND path < ?)) ORDER BY path',
+            (root, prefix, prefix + '/', prefix + '0'))
+        for row in cursor:
+            yield row[0]
+
+    def recordIter(self, root: str, paths: Iterable[str], reader: str) -> Iterator[str]:
+        """
+        边保存边返回导出的路径，全部读取完成后才替换缓存，中途出错时保留原来的缓存
+        :param root: 导出根目录
+        :param paths: 导出解析出的路径
+        :param reader: 导出的同步目录key，它自己不会再读取这次导出
+        """
+        if self.ttl <= 0:
+            yield from paths
+            return
+        conn = self.connect()
+        complete = False
+        try:
+            conn.execute('DELETE FROM paths WHERE root = ?', (root,))
+            batch = []
+            for path in paths:
+                batch.append((root, path))
+                if len(batch) >= self.batch_size:
+                    conn.executemany('INSERT OR IGNORE INTO paths (root, path) VALUES (?, ?)', batch)
+                    batch = []
+                yield path
+            if len(batch) > 0:
+                conn.executemany('INSERT OR IGNORE INTO paths (root, path) VALUES (?, ?)', batch)
+            now = time.time()
+            conn.execute('INSERT OR REPLACE INTO exports (root, created_at) VALUES (?, ?)', (root, now))
+            conn.execute('DELETE FROM readers WHERE root = ?', (root,))
+            conn.execute('INSERT INTO readers (root, reader) VALUES (?, ?)', (root, reader))
+            # 顺便清理过期的导出结果
+            for row in conn.execute('SELECT root FROM exports WHERE created_at + ? <= ?', (self.ttl, now)).fetchall():
+                conn.execute('DELETE FROM paths WHERE root = ?', (row[0],))
+                conn.execute('DELETE FROM exports WHERE root = ?', (row[0],))
+                conn.execute('DELETE FROM readers WHERE root = ?', (row[0],))
+            conn.commit()
+            complete = True
+        finally:
+            if not complete:
+                conn.rollback()
+
+    def close(self):
+        if self.conn is None:
+            return
+        self.conn.close()
+        self.conn = None
+
+    def delete(self):
+        self.close()
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(self.cache_file + suffix):
+                os.unlink(self.cache_file + suffix)
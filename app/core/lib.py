@@ -1,15 +1,22 @@
+import copy
 import datetime, pytz
 import json
 import hashlib, os
-from typing import List, Mapping
-from crontab import CronTab
+import threading
+from typing import Callable, List, Mapping
+from croniter import croniter
 import telebot
 from telebot import apihelper
 from telebot import apihelper
+
+from app.core.exportcache import ExportCache
+from app.core.meta import MetaManifest
+from app.core.snapshot import TreeSnapshot
+from app.utils.lock import FileLock
 proxyHost = os.getenv('PROXY_HOST', '')
 if proxyHost != '':
     apihelper.proxy = {'http': proxyHost, 'https': proxyHost}
-TABFILE = './data/config/cron.tab'
+SETTING_FILE = os.path.abspath('./data/config/setting.json')
 
 
 
@@ -23,9 +30,93 @@ def GetNow():
     return now_beijing.strftime("%Y-%m-%d %H:%M:%S")
 
 
+def fileStamp(file: str) -> tuple[int, int, int] | None:
+    # 文件的修改时间、大小和inode，文件不存在返回None
+    # 保存都是写临时文件再os.replace，每次写入inode都会变化，同一个时间精度内写入大小相同的内容也能发现
+    try:
+        st = os.stat(file)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+class ConfigFile:
+    """
+    配置文件缓存：解析后的对象保存在内存中，只有文件的mtime/size/inode变化时才重新解析
+    同一个文件在进程内只有一个ConfigFile，通过GetConfigFile获取
+    """
+    file: str
+    loader: Callable[[dict], object] # 把json内容转换为内存中的对象
+    stamp: tuple[int, int, int] | None
+    data: object
+    lock: threading.RLock
+
+    def __init__(self, file: str, loader: Callable[[dict], object]):
+        self.file = file
+        self.loader = loader
+        self.stamp = None
+        self.data = None
+        self.lock = threading.RLock()
+
+    def load(self) -> object:
+        stamp = fileStamp(self.file)
+        with self.lock:
+            if self.data is not None and stamp == self.stamp:
+                return self.data
+            jsonData = {}
+            if stamp is not None:
+                try:
+                    with open(self.file, mode='r', encoding='utf-8') as fd:
+                        stamp = fileStamp(self.file)
+                        jsonData = json.load(fd)
+                except FileNotFoundError:
+                    stamp = None
+            self.data = self.loader(jsonData)
+            self.stamp = stamp
+            return self.data
+
+    def save(self, jsonData: object, data: object):
+        # 先写临时文件再重命名，其他进程不会读到写了一半的文件
+        # 写入后记录文件指纹，避免重新解析自己写入的内容
+        with self.lock:
+            dirname = os.path.dirname(self.file)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname, exist_ok=True)
+            tmpFile = '{0}.{1}.{2}.tmp'.format(self.file, os.getpid(), threading.get_ident())
+            try:
+                with open(tmpFile, mode='w', encoding='utf-8') as fd:
+                    json.dump(jsonData, fd, default=jsonHook)
+                os.replace(tmpFile, self.file)
+            finally:
+                if os.path.exists(tmpFile):
+                    os.unlink(tmpFile)
+            self.stamp = fileStamp(self.file)
+            self.data = data
+
+    def delete(self):
+        with self.lock:
+            if os.path.exists(self.file):
+                os.unlink(self.file)
+            self.stamp = None
+            self.data = None
+
+
+_configFiles: dict[str, ConfigFile] = {}
+_configFilesLock = threading.Lock()
+
+
+def GetConfigFile(file: str, loader: Callable[[dict], object]) -> ConfigFile:
+    with _configFilesLock:
+        configFile = _configFiles.get(file)
+        if configFile is None:
+            configFile = ConfigFile(file, loader)
+            _configFiles[file] = configFile
+        return configFile
+
+
 class LibExtra:
     pid: str # 正在运行的进程ID
-    status: int # 运行状态: 1-正常，2-运行中，3-中断
+    status: int # 运行状态: 1-正常，2-运行中，3-中断，4-排队中
     last_sync_at: str # 最后运行时间
     last_sync_result: Mapping[str, List[int]]
 
@@ -33,12 +124,53 @@ class LibExtra:
         self.pid = pid
         self.status = status
         self.last_sync_at = last_sync_at
-        self.last_sync_result = last_sync_result
+        # 复制一份，避免多个对象共享默认参数中的dict
+        self.last_sync_result = {k: list(v) for k, v in last_sync_result.items()}
 
     def getJson(self):
         dict = self.__dict__
         return dict
 
+    def copy(self) -> 'LibExtra':
+        return LibExtra(self.pid, self.status, self.last_sync_at, self.last_sync_result)
+
+    @staticmethod
+    def fromJson(jsonExtra: dict) -> 'LibExtra | None':
+        if len(jsonExtra) == 0:
+            return None
+        return LibExtra(
+            pid=jsonExtra.get('pid', 0),
+            status=jsonExtra.get('status', 1),
+            last_sync_at=jsonExtra.get('last_sync_at', ''),
+            last_sync_result=jsonExtra.get('last_sync_result', {'strm': [0,0], 'meta': [0,0],'delete': [0,0]})
+        )
+
+
+class LibExtraStore:
+    """
+    同步目录的运行状态(pid, status, last_sync_at, last_sync_result)单独保存
+    每个同步目录一个文件：data/config/extra/{key}.json，写入时先写临时文件再重命名，
+    多个任务同时结束也不会互相覆盖，libs.json只保存配置
+    """
+    extra_dir: str = os.path.abspath("./data/config/extra")
+
+    def getFile(self, key: str) -> ConfigFile:
+        return GetConfigFile(os.path.join(self.extra_dir, '%s.json' % key), LibExtra.fromJson)
+
+    def get(self, key: str) -> LibExtra | None:
+        try:
+            return self.getFile(key).load()
+        except ValueError:
+            # 文件损坏
+            return None
+
+    def save(self, key: str, extra: LibExtra):
+        self.getFile(key).save(extra.getJson(), extra)
+
+    def delete(self, key: str):
+        self.getFile(key).delete()
+
+
 class LibBase:
     key: str # 标识
     cloud_type: str # 网盘类型，分为：115, other
@@ -51,7 +183,11 @@ class LibBase:
     alist_115_path: str # alist中115路径，一般都是：115
     path_of_115: str # 115挂载根目录
     copy_meta_file: int # 元数据选项：1-关闭，2-复制，3-软链接
-    copy_delay: int | float # 元数据复制间隔
+    copy_delay: int | float # 元数据复制间隔，换算为每秒复制的文件数
+    meta_workers: int # 并发复制元数据的线程数
+    meta_rate: int | float # 元数据复制限速，MB/s，0表示不限速
+    meta_update: bool # 检查元数据更新，云端修改过的元数据重新复制
+    strm_workers: int # 并发写入STRM文件的线程数
     webdav_url: str # webdav服务器链接
     webdav_username: str # webdav服务器用户名
     webdav_password: str # webdav服务器密码
@@ -76,6 +212,10 @@ class LibBase:
         self.path_of_115 = data.get('path_of_115') if data.get('path_of_115') is not None else ''
         self.copy_meta_file = data.get('copy_meta_file') if data.get('copy_meta_file') is not None else '关闭'
         self.copy_delay = float(data.get('copy_delay')) if data.get('copy_delay') is not None else 1
+        self.meta_workers = int(data.get('meta_workers')) if data.get('meta_workers') is not None else 2
+        self.meta_rate = float(data.get('meta_rate')) if data.get('meta_rate') is not None else 0
+        self.meta_update = bool(data.get('meta_update')) if data.get('meta_update') is not None else False
+        self.strm_workers = int(data.get('strm_workers')) if data.get('strm_workers') is not None else 4
         self.webdav_url = data.get('webdav_url') if data.get('webdav_url') is not None else ''
         self.webdav_username = data.get('webdav_username') if data.get('webdav_username') is not None else ''
         self.webdav_password = data.get('webdav_password') if data.get('webdav_password') is not None else ''
@@ -157,32 +297,14 @@ class Lib(LibBase):
             return False, '115挂载根目录不存在，请检查文件系统中是否存在该目录：%s' % self.path_of_115
         if self.cloud_type == 'other' and not os.path.exists(self.path):
             return False, '同步路径不存在，请检查文件系统中是否存在该目录：%s' % self.path
+        # 定时同步由定时任务服务按cron_str调度
+        if self.sync_type == '定时' and not croniter.is_valid(self.cron_str):
+            return False, '定时同步规则无效：%s' % self.cron_str
         return True, ''
 
-    def cron(self):
-        # 处理定时任务
-        cron = CronTab(tabfile=TABFILE)
-        iter = cron.find_comment(self.key)
-        existsJob = None
-        for i in iter:
-            existsJob = i
-        if self.sync_type == '定时':
-            if existsJob is not None:
-                cron.remove(existsJob)
-                cron.write(filename=TABFILE)
-            jobFile = os.path.abspath('./job.py')
-            job = cron.new(comment="%s" % self.key, command="python3 %s -k %s" % (jobFile, self.key))
-            job.setall(self.cron_str)
-            cron.write(filename=TABFILE)
-        else:
-            if existsJob is not None:
-                # 删除定时任务
-                cron.remove(existsJob)
-                cron.write(filename=TABFILE)
-        return True
-
     def getJson(self):
-        dict = self.__dict__
+        # 返回副本，不能把self.extra替换成dict
+        dict = self.__dict__.copy()
         if isinstance(self.extra, LibExtra):
             dict['extra'] = self.extra.getJson()
         else:
@@ -193,54 +315,112 @@ class Lib(LibBase):
 def jsonHook(obj):
     return obj.getJson()
 
+
+class LibIndex:
+    # 同步目录列表以及按路径、名称的索引
+    libs: Mapping[str, Lib]
+    byPath: Mapping[str, Lib]
+    byName: Mapping[str, Lib]
+
+    def __init__(self, libs: Mapping[str, Lib]):
+        self.libs = libs
+        self.byPath = {}
+        self.byName = {}
+        for lib in libs.values():
+            self.byPath[lib.path] = lib
+            self.byName[lib.name] = lib
+
+    @staticmethod
+    def fromJson(jsonLibs: dict) -> 'LibIndex':
+        libs = {}
+        for k in jsonLibs:
+            libs[k] = Lib(jsonLibs[k])
+        return LibIndex(libs)
+
+
 class Libs:
+    """
+    同步目录列表，解析后的列表缓存在ConfigFile中，被进程内所有Libs实例和API的多个线程共享
+
+    缓存中的字典和Lib对象只读：修改时在ConfigFile的锁内 读取->复制->修改->保存，
+    读取时返回Lib的副本，调用方修改返回的对象不会影响其他线程
+    """
     libs_file: str = os.path.abspath("./data/config/libs.json")
-    libList: Mapping[str, List[Lib]] # 同步目录列表
+    libList: Mapping[str, Lib] # 同步目录列表
+    index: LibIndex
+    store: ConfigFile
+    extraStore: LibExtraStore
 
     def __init__(self):
         self.libList = {}
+        self.store = GetConfigFile(self.libs_file, LibIndex.fromJson)
+        self.extraStore = LibExtraStore()
         self.loadFromFile()
     
     def loadFromFile(self):
-        libs = {}
-        if os.path.exists(self.libs_file):
-            with open(self.libs_file, mode='r', encoding='utf-8') as fd_libs:
-                jsonLibs = json.load(fd_libs)
-            for k in jsonLibs:
-                libs[k] = Lib(jsonLibs[k])
-        self.libList = libs
+        # 文件没有变化时直接使用内存中的对象，所有Libs实例共享
+        self.index = self.store.load()
+        self.libList = self.index.libs
         return True
+
+    def loadExtra(self, lib: Lib | None) -> Lib | None:
+        # 返回副本，运行状态从单独的文件读取，没有的话使用libs.json中旧版本保存的状态
+        if lib is None:
+            return None
+        lib = copy.copy(lib)
+        extra = self.extraStore.get(lib.key)
+        if extra is None:
+            extra = lib.extra
+        if isinstance(extra, LibExtra):
+            lib.extra = extra.copy()
+        return lib
     
     def list(self) -> List[Lib]:
         self.loadFromFile()
+        libList = self.libList
         l: list[Lib] = []
-        for key in self.libList:
-            l.append(self.libList.get(key))
+        for key in libList:
+            l.append(self.loadExtra(libList.get(key)))
         return l
     
-    def save(self) -> bool:
-        with open(self.libs_file, mode='w', encoding='utf-8') as fd_libs:
-            json.dump(self.libList, fd_libs, default=jsonHook)
+    def save(self, libList: Mapping[str, Lib] | None = None) -> bool:
+        # libs.json只保存配置，运行状态由saveExtra单独保存
+        # 修改时传入新的字典，必须在self.store.lock内调用
+        if libList is None:
+            libList = self.libList
+        jsonLibs = {}
+        for key, lib in libList.items():
+            jsonLib = lib.getJson()
+            del jsonLib['extra']
+            jsonLibs[key] = jsonLib
+        index = LibIndex(libList)
+        self.store.save(jsonLibs, index)
+        self.index = index
+        self.libList = libList
         return True
         
     def getLib(self, key: str) -> Lib | None:
         self.loadFromFile()
-        return self.libList.get(key)
+        return self.loadExtra(self.libList.get(key))
     
     def getByPath(self, path: str) -> Lib | None:
         self.loadFromFile()
-        for key in self.libList:
-            item = self.libList.get(key)
-            if item.path == path:
-                return item
-        return None
+        return self.loadExtra(self.index.byPath.get(path))
+
+    def getByName(self, name: str) -> Lib | None:
+        self.loadFromFile()
+        return self.loadExtra(self.index.byName.get(name))
     
     def add(self, data: dict) -> tuple[bool, str]:
-        for k, v in self.libList.items():
-            if v.path == data['path']:
-                return False, '同步目录已存在'
-            if v.name == data['name']:
-                return False, '同步目录名称已存在'
+        with self.store.lock:
+            return self.addLocked(data)
+
+    def addLocked(self, data: dict) -> tuple[bool, str]:
+        self.loadFromFile()
+        if data['path'] in self.index.byPath:
+            return False, '同步目录已存在'
+        if data['name'] in self.index.byName:
+            return False, '同步目录名称已存在'
         data['extra'] = {
             'pid': 0,
             'status': 1,
@@ -255,49 +435,53 @@ class Libs:
         rs, msg = lib.validate()
         if rs is False:
             return rs, msg
-        self.libList[lib.key] = lib
-        self.save()
-        lib.cron()
+        libList = dict(self.libList)
+        libList[lib.key] = lib
+        self.save(libList)
+        self.extraStore.save(lib.key, lib.extra)
         return True, ''
 
     def updateLib(self, key: str, data: dict) -> tuple[bool, str]:
-        lib = self.getLib(key)
-        if lib is None:
-            return False, '同步目录不存在'
-        del data['extra']
-        for k in data:
-            lib.__setattr__(k, data[k])
-        self.libList[key] = lib
-        self.save()
-        lib.cron()
+        with self.store.lock:
+            lib = self.getLib(key)
+            if lib is None:
+                return False, '同步目录不存在'
+            data.pop('extra', None)
+            for k in data:
+                lib.__setattr__(k, data[k])
+            libList = dict(self.libList)
+            libList[key] = lib
+            self.save(libList)
+        # 配置变化后STRM内容可能不同，下次执行全量同步
+        TreeSnapshot(key).delete()
         return True, ''
 
     def saveExtra(self, lib: Lib):
-        self.libList[lib.key] = lib
-        self.save()
-        pass
+        # 只写入该同步目录的运行状态文件，不改动libs.json
+        self.extraStore.save(lib.key, lib.extra)
 
     def deleteLib(self, key: str) -> tuple[bool, str]:
-        lib = self.getLib(key)
-        lib.sync_type = '手动'
-        lib.cron()
-        del self.libList[key]
-        self.save()
+        with self.store.lock:
+            self.loadFromFile()
+            if key not in self.libList:
+                return False, '同步目录不存在'
+            libList = dict(self.libList)
+            del libList[key]
+            self.save(libList)
+        self.extraStore.delete(key)
+        TreeSnapshot(key).delete()
+        MetaManifest(key).delete()
+        # progress依赖本模块，在这里导入
+        from app.core.progress import DeleteProgress
+        DeleteProgress(key)
         return True, ''
-    
-    def initCron(self):
-        # 每次启动服务时，检查定时任务是否存在，不存在的创建
-        libs = self.list()
-        for item in libs:
-            item.cron()
-        return True
 
-    
+
 class OO5:
     key: str
     name: str
     cookie: str
-    status: int
+    status: int # 0-正常，1-cookie已失效
     created_at: str
     updated_at: str
 
@@ -314,84 +498,141 @@ class OO5:
         return dict
     
 
+class OO5Index:
+    # 115账号列表以及按名称、cookie的索引
+    accounts: Mapping[str, OO5]
+    byName: Mapping[str, OO5]
+    byCookie: Mapping[str, OO5]
+
+    def __init__(self, accounts: Mapping[str, OO5]):
+        self.accounts = accounts
+        self.byName = {}
+        self.byCookie = {}
+        for oo5 in accounts.values():
+            self.byName[oo5.name] = oo5
+            self.byCookie[oo5.cookie] = oo5
+
+    @staticmethod
+    def fromJson(jsonList: dict) -> 'OO5Index':
+        accounts = {}
+        for k in jsonList:
+            accounts[k] = OO5(jsonList[k])
+        return OO5Index(accounts)
+
+
 class OO5List:
+    """
+    115账号列表，和Libs一样：缓存中的字典和OO5对象只读，修改时在ConfigFile的锁内复制后保存，读取时返回副本
+    同步进程也会修改账号状态，所以修改时还要持有跨进程的文件锁，在锁内重新读取文件后再修改，
+    不会覆盖API进程刚保存的cookie
+    """
     oo5_files = os.path.abspath("./data/config/115.json")
     list: Mapping[str, OO5] # 115账号列表
+    index: OO5Index
+    store: ConfigFile
 
     def __init__(self):
         self.list = {}
+        self.store = GetConfigFile(self.oo5_files, OO5Index.fromJson)
         self.loadFromFile()
     
     def loadFromFile(self):
-        list = {}
-        if os.path.exists(self.oo5_files):
-            with open(self.oo5_files, mode='r', encoding='utf-8') as fd_oo5:
-                jsonList = json.load(fd_oo5)
-            for k in jsonList:
-                list[k] = OO5(jsonList[k])
-        self.list = list
+        # 文件没有变化时直接使用内存中的对象，所有OO5List实例共享
+        self.index = self.store.load()
+        self.list = self.index.accounts
         return True
 
-    def save(self) -> bool:
-        with open(self.oo5_files, mode='w', encoding='utf-8') as o:
-            json.dump(self.list, o, default=jsonHook)
+    def save(self, accounts: Mapping[str, OO5] | None = None) -> bool:
+        # 修改时传入新的字典，必须在self.store.lock和文件锁115-accounts内调用
+        if accounts is None:
+            accounts = self.list
+        index = OO5Index(accounts)
+        self.store.save(accounts, index)
+        self.index = index
+        self.list = accounts
         return True
     
     def get(self, key: str) -> OO5 | None:
         self.loadFromFile()
-        return self.list.get(key)
+        oo5 = self.list.get(key)
+        return copy.copy(oo5) if oo5 is not None else None
     
     def getByCookie(self, cookies: str) -> OO5 | None:
         self.loadFromFile()
+        oo5 = self.index.byCookie.get(cookies)
+        return copy.copy(oo5) if oo5 is not None else None
     
     def getList(self) -> List[OO5]:
         self.loadFromFile()
+        accounts = self.list
         l: list[OO5] = []
-        for key in self.list:
-            l.append(self.list.get(key))
+        for key in accounts:
+            l.append(copy.copy(accounts.get(key)))
         return l
+
+    def put(self, oo5: OO5):
+        # 必须在self.store.lock和文件锁115-accounts内调用
+        accounts = dict(self.list)
+        accounts[oo5.key] = oo5
+        self.save(accounts)
     
     def add(self, data: dict) -> tuple[bool, str]:
-        self.loadFromFile()
-        for key in self.list:
-            if self.list[key].name == data['name'] or self.list[key].cookie == data['cookie']:
+        with self.store.lock, FileLock('115-accounts'):
+            self.loadFromFile()
+            if data['name'] in self.index.byName or data['cookie'] in self.index.byCookie:
                 return False, '名称或者cookie已存在'
-        data['created_at'] = GetNow()
-        data['updated_at'] = ''
-        data['status'] = 0
-        m = hashlib.md5()
-        m.update(data['name'].encode(encoding='UTF-8'))
-        data['key'] = m.hexdigest()
-        oo5 = OO5(data)
-        self.list[oo5.key] = oo5
-        self.save()
+            data['created_at'] = GetNow()
+            data['updated_at'] = ''
+            data['status'] = 0
+            m = hashlib.md5()
+            m.update(data['name'].encode(encoding='UTF-8'))
+            data['key'] = m.hexdigest()
+            self.put(OO5(data))
         return True, ''
     
     def updateOO5(self, key: str, data: dict):
-        self.loadFromFile()
-        oo5 = self.get(key)
-        if oo5 is None:
-            return False, '115账号不存在'
-        oo5.name = data['name']
-        oo5.cookie = data['cookie']
-        oo5.updated_at = GetNow()
-        self.list[key] = oo5
-        self.save()
+        with self.store.lock, FileLock('115-accounts'):
+            oo5 = self.get(key)
+            if oo5 is None:
+                return False, '115账号不存在'
+            oo5.name = data['name']
+            if oo5.cookie != data['cookie']:
+                # 换了cookie，重新标记为正常，各进程缓存的客户端会按新cookie重建
+                oo5.cookie = data['cookie']
+                oo5.status = 0
+            oo5.updated_at = GetNow()
+            self.put(oo5)
         return True, ''
 
+    def setStatus(self, key: str, status: int, cookie: str | None = None):
+        """
+        修改账号状态
+        :param cookie: 检查结果对应的cookie，账号的cookie已经被修改时不再修改状态
+        """
+        with self.store.lock, FileLock('115-accounts'):
+            oo5 = self.get(key)
+            if oo5 is None or oo5.status == status:
+                return
+            if cookie is not None and oo5.cookie != cookie:
+                return
+            oo5.status = status
+            self.put(oo5)
+
     def delOO5(self, key: str):
-        self.loadFromFile()
-        oo5 = self.get(key)
-        if oo5 is None:
-            return True, ''
-        # 检查是否有在使用
-        libs = Libs()
-        libList = libs.list()
-        for item in libList:
-            if item.id_of_115 == key:
-                return False, '该账号使用中'
-        del self.list[key]
-        self.save()
+        with self.store.lock, FileLock('115-accounts'):
+            oo5 = self.get(key)
+            if oo5 is None:
+                return True, ''
+            # 检查是否有在使用
+            libs = Libs()
+            libList = libs.list()
+            for item in libList:
+                if item.id_of_115 == key:
+                    return False, '该账号使用中'
+            accounts = dict(self.list)
+            del accounts[key]
+            self.save(accounts)
+        ExportCache(key).delete()
         return True, ''
 
 class Setting:
@@ -404,11 +645,11 @@ class Setting:
         self.loadFromFile()
 
     def loadFromFile(self):
-        if not os.path.exists("./data/config/setting.json"):
-            return False
         try:
-            with open("./data/config/setting.json", mode='r', encoding='utf-8') as fd:
-                jsonSetting: dict = json.load(fd)
+            # 文件没有变化时直接使用缓存的内容
+            jsonSetting: dict = GetConfigFile(SETTING_FILE, dict).load()
+            if len(jsonSetting) == 0:
+                return False
             self.username = jsonSetting.get("username")
             self.password = jsonSetting.get("password")
             self.telegram_bot_token = jsonSetting.get("telegram_bot_token")
@@ -419,8 +660,7 @@ class Setting:
     
     def save(self) -> tuple[bool, str]:
         try:
-            with open('./data/config/setting.json', mode='w', encoding='utf-8') as f:
-                json.dump(self.__dict__, f)
+            GetConfigFile(SETTING_FILE, dict).save(self.__dict__, dict(self.__dict__))
         except Exception as e:
             return False, e
         return True, ""
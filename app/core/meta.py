@@ -0,0 +1,182 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from typing import Iterable, Iterator
+
+from app.utils.ratelimit import TokenBucket
+
+# 元数据复制失败后的重试次数
+META_RETRIES = int(os.getenv('META_RETRIES', '3'))
+# 第一次重试前等待的秒数，之后每次翻倍
+META_RETRY_DELAY = float(os.getenv('META_RETRY_DELAY', '2'))
+
+
+class MetaManifest:
+    """
+    同步目录已经复制的元数据清单：data/config/manifests/{key}.db
+    记录复制时源文件的大小和修改时间，之后只需要stat源文件就能判断云端是否更新了元数据，
+    不需要读取目标文件，也不需要重新读取源文件的内容
+    """
+    manifest_dir: str = os.path.abspath("./data/config/manifests")
+    key: str
+    manifest_file: str
+    conn: sqlite3.Connection | None
+
+    def __init__(self, key: str):
+        self.key = key
+        self.manifest_file = os.path.join(self.manifest_dir, '%s.db' % key)
+        self.conn = None
+
+    def connect(self) -> sqlite3.Connection:
+        if self.conn is not None:
+            return self.conn
+        if not os.path.exists(self.manifest_dir):
+            os.makedirs(self.manifest_dir, exist_ok=True)
+        conn = sqlite3.connect(self.manifest_file, timeout=30)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER) WITHOUT ROWID')
+        conn.commit()
+        self.conn = conn
+        return conn
+
+    def load(self) -> dict[str, tuple[int, int]]:
+        # 读取全部记录：路径 => (大小, 修改时间)
+        return {row[0]: (row[1], row[2]) for row in self.connect().execute('SELECT path, size, mtime FROM meta')}
+
+    def get(self, path: str) -> tuple[int, int] | None:
+        row = self.connect().execute('SELECT size, mtime FROM meta WHERE path = ?', (path,)).fetchone()
+        return None if row is None else (row[0], row[1])
+
+    def save(self, records: dict[str, tuple[int, int]]):
+        if len(records) == 0:
+            return
+        conn = self.connect()
+        conn.executemany('INSERT OR REPLACE INTO meta (path, size, mtime) VALUES (?, ?, ?)', [(k, v[0], v[1]) for k, v in records.items()])
+        conn.commit()
+
+    def close(self):
+        if self.conn is None:
+            return
+        self.conn.close()
+        self.conn = None
+
+    def delete(self):
+        self.close()
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(self.manifest_file + suffix):
+                os.unlink(self.manifest_file + suffix)
+
+
+def metaStamp(st: os.stat_result) -> tuple[int, int]:
+    # 清单中记录的源文件指纹：大小，修改时间(秒)
+    return st.st_size, int(st.st_mtime)
+
+
+class MetaCopier:
+    """
+    并发复制元数据文件
+
+    访问115挂载的速度按 文件数/秒 和 字节数/秒 两个令牌桶限速，代替每个文件固定的sleep，
+    几个线程共用限速额度，额度内尽量跑满。stat源文件也要访问挂载，每个文件先取一个文件数令牌再stat，
+    需要复制时直接使用这个令牌；源文件没有变化时跳过，不占用字节数额度。
+    复制失败按指数退避重试。
+    传入清单时按清单中的记录判断源文件是否变化，复制成功或者确认没有变化的文件记录到updated，
+    由调用方保存
+    """
+    workers: int
+    files: TokenBucket
+    bytes: TokenBucket
+    retries: int
+    retry_delay: float
+    manifest: dict[str, tuple[int, int]] | None
+    updated: dict[str, tuple[int, int]]
+    lock: threading.Lock
+
+    def __init__(self, workers: int = 2, files_per_sec: float = 0, bytes_per_sec: float = 0, retries: int = META_RETRIES, retry_delay: float = META_RETRY_DELAY, manifest: dict[str, tuple[int, int]] | None = None):
+        self.workers = max(1, workers)
+        self.files = TokenBucket(files_per_sec, capacity=self.workers)
+        self.bytes = TokenBucket(bytes_per_sec)
+        self.retries = max(0, retries)
+        self.retry_delay = retry_delay
+        self.manifest = manifest
+        self.updated = {}
+        self.lock = threading.Lock()
+
+    def record(self, key: str, stamp: tuple[int, int]):
+        if self.manifest is None:
+            return
+        with self.lock:
+            self.updated[key] = stamp
+
+    def unchanged(self, key: str, src_stat: os.stat_result, dest_file: str) -> bool:
+        stamp = metaStamp(src_stat)
+        if self.manifest is not None:
+            record = self.manifest.get(key)
+            if record is not None:
+                # 目标文件在本地，检查是否存在的开销可以忽略
+                return tuple(record) == stamp and os.path.exists(dest_file)
+        try:
+            dest_stat = os.stat(dest_file)
+        except FileNotFoundError:
+            return False
+        if dest_stat.st_size != src_stat.st_size:
+            return False
+        if self.manifest is not None:
+            # 清单中还没有记录（之前的版本复制的文件没有保留修改时间），大小一致就直接记录
+            self.record(key, stamp)
+            return True
+        # copy2会保留修改时间，大小和修改时间(精确到秒)都一致就认为没有变化
+        return int(dest_stat.st_mtime) == stamp[1]
+
+    def copyFile(self, key: str, src_file: str, dest_file: str) -> bool:
+        # 复制一个文件，返回是否真的复制了（没有变化返回False），重试后仍然失败抛出OSError
+        # 检查元数据更新时每次同步都要stat全部元数据，访问挂载之前先取令牌，不能绕过限速
+        self.files.take(1)
+        src_stat = os.stat(src_file)
+        if self.unchanged(key, src_stat, dest_file):
+            return False
+        attempt = 0
+        while True:
+            if attempt > 0:
+                self.files.take(1)
+            self.bytes.take(src_stat.st_size)
+            try:
+                os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+                shutil.copy2(src_file, dest_file)
+                self.record(key, metaStamp(src_stat))
+                return True
+            except FileNotFoundError:
+                raise
+            except OSError:
+                if attempt >= self.retries:
+                    raise
+                time.sleep(self.retry_delay * (2 ** attempt))
+                attempt += 1
+
+    def copy(self, items: Iterable[tuple[str, str, str]]) -> Iterator[tuple[str, bool, OSError | None]]:
+        """
+        复制元数据，按完成顺序返回结果
+        :param items: (标识, 源文件, 目标文件)，可以是生成器
+        :return: (标识, 是否复制了文件, 错误)
+        """
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='meta') as executor:
+            pending: dict[Future, str] = {}
+            for key, src_file, dest_file in items:
+                pending[executor.submit(self.copyFile, key, src_file, dest_file)] = key
+                if len(pending) >= self.workers * 4:
+                    yield from self.collect(pending)
+            while len(pending) > 0:
+                yield from self.collect(pending)
+
+    def collect(self, pending: dict[Future, str]) -> Iterator[tuple[str, bool, OSError | None]]:
+        done, _ = wait(pending.keys(), return_when=FIRST_COMPLETED)
+        for future in done:
+            key = pending.pop(future)
+            try:
+                yield key, future.result(), None
+            except OSError as e:
+                yield key, False, e
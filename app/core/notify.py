@@ -0,0 +1,183 @@
+import atexit
+import os
+import queue
+import textwrap
+import threading
+import time
+from typing import Callable
+
+import telebot
+from telebot import apihelper
+import telegramify_markdown
+from telegramify_markdown import customize
+
+from app.core.lib import Setting
+from app.utils.log import getLogger
+from app.utils.ratelimit import TokenBucket
+
+# 汇总窗口，秒：第一条同步完成的通知进入后，等待这么久，期间完成的同步目录合并成一条消息发送
+NOTIFY_DIGEST_WINDOW = float(os.getenv('NOTIFY_DIGEST_WINDOW', '10'))
+# 每个聊天每秒最多发送的消息数，Telegram对同一个聊天的限制大约是每秒1条
+NOTIFY_CHAT_RATE = float(os.getenv('NOTIFY_CHAT_RATE', '1'))
+# 发送失败后的重试次数
+NOTIFY_RETRIES = int(os.getenv('NOTIFY_RETRIES', '3'))
+# 第一次重试前等待的秒数，之后每次翻倍，Telegram返回429时按它给出的时间等待
+NOTIFY_RETRY_DELAY = float(os.getenv('NOTIFY_RETRY_DELAY', '2'))
+# 进程退出前等待未发送通知的最长秒数
+NOTIFY_EXIT_TIMEOUT = float(os.getenv('NOTIFY_EXIT_TIMEOUT', '15'))
+
+logger = getLogger(name='notify', rotating=True)
+
+
+class Notifier:
+    """
+    Telegram通知发送队列
+
+    调用方只把消息放入队列，由后台线程发送，同步任务不会被Telegram或者代理的延迟阻塞。
+    整个进程共用一个TeleBot，机器人token变化后才重新创建；每个聊天一个令牌桶限速，
+    失败按指数退避重试。标记为汇总的消息（同步完成）在NOTIFY_DIGEST_WINDOW内合并成一条发送
+    """
+    bot: telebot.TeleBot | None
+    token: str
+    queue: queue.Queue # (消息, 是否汇总) 或者 (None, Event) 表示flush
+    digest: list[str]
+    digest_at: float | None # 汇总窗口结束的时间
+    buckets: dict[str, TokenBucket] # 聊天ID => 限速
+    thread: threading.Thread | None
+    lock: threading.Lock
+
+    def __init__(self):
+        self.bot = None
+        self.token = ''
+        self.queue = queue.Queue()
+        self.digest = []
+        self.digest_at = None
+        self.buckets = {}
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def send(self, msg: str, digest: bool = False):
+        """
+        发送通知，立即返回
+        :param msg: markdown格式的消息，发送前转换为Telegram的MarkdownV2
+        :param digest: 是否可以和窗口内的其他消息合并成一条
+        """
+        self.startThread()
+        self.queue.put((msg, digest))
+
+    def flush(self, timeout: float = NOTIFY_EXIT_TIMEOUT) -> bool:
+        # 立即发送汇总中的消息，等待队列中的消息发送完成，返回是否在超时前完成
+        if self.thread is None:
+            return True
+        done = threading.Event()
+        self.queue.put((None, done))
+        return done.wait(timeout)
+
+    def startThread(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, name='notify', daemon=True)
+            self.thread.start()
+            atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            timeout = None
+            if self.digest_at is not None:
+                timeout = max(0, self.digest_at - time.time())
+            try:
+                msg, arg = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                self.sendDigest()
+                continue
+            if msg is None:
+                self.sendDigest()
+                arg.set()
+            elif arg:
+                if self.digest_at is None:
+                    self.digest_at = time.time() + NOTIFY_DIGEST_WINDOW
+                self.digest.append(msg)
+            else:
+                self.deliver(msg)
+
+    def sendDigest(self):
+        msgs = self.digest
+        self.digest = []
+        self.digest_at = None
+        if len(msgs) == 0:
+            return
+        if len(msgs) == 1:
+            self.deliver(msgs[0])
+            return
+        self.deliver('*同步完成汇总*：{0} 个同步目录\n\n{1}'.format(len(msgs), '\n\n'.join(textwrap.dedent(msg).strip() for msg in msgs)))
+
+    def getBot(self, token: str) -> telebot.TeleBot:
+        if self.bot is None or self.token != token:
+            self.bot = telebot.TeleBot(token)
+            self.token = token
+        return self.bot
+
+    def getBucket(self, chat_id: str) -> TokenBucket:
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(NOTIFY_CHAT_RATE)
+            self.buckets[chat_id] = bucket
+        return bucket
+
+    def deliver(self, msg: str):
+        # 在发送线程中调用，配置在发送时读取，Setting有缓存
+        settings = Setting()
+        if settings.telegram_bot_token == '' or settings.telegram_user_id == '':
+            return
+        try:
+            customize.strict_markdown = False
+            text = telegramify_markdown.markdownify(textwrap.dedent(msg))
+        except Exception as e:
+            logger.warning('转换通知格式失败: {0}'.format(e))
+            text = msg
+        bot = self.getBot(settings.telegram_bot_token)
+        bucket = self.getBucket(settings.telegram_user_id)
+        attempt = 0
+        while True:
+            bucket.take(1)
+            try:
+                bot.send_message(settings.telegram_user_id, text, "MarkdownV2")
+                logger.info('成功发送通知')
+                return
+            except Exception as e:
+                if attempt >= NOTIFY_RETRIES:
+                    logger.warning('无法发送通知: {0}'.format(e))
+                    return
+                delay = NOTIFY_RETRY_DELAY * (2 ** attempt)
+                if isinstance(e, apihelper.ApiTelegramException):
+                    if e.error_code == 429:
+                        delay = max(delay, e.result_json.get('parameters', {}).get('retry_after', 0))
+                    elif 400 <= e.error_code < 500:
+                        # 消息格式或者配置错误，重试也不会成功
+                        logger.warning('无法发送通知: {0}'.format(e))
+                        return
+                time.sleep(delay)
+                attempt += 1
+
+
+_notifier = Notifier()
+# 不为None时通知交给它处理，常驻同步进程通过它把通知转发给调度器所在的进程
+_sink: Callable[[str, bool], None] | None = None
+
+
+def Notify(msg: str, digest: bool = False):
+    """
+    发送Telegram通知，不阻塞调用方
+    :param msg: markdown格式的消息
+    :param digest: 是否可以合并到同步完成汇总中
+    """
+    if _sink is not None:
+        _sink(msg, digest)
+        return
+    _notifier.send(msg, digest)
+
+
+def SetNotifySink(sink: Callable[[str, bool], None] | None):
+    global _sink
+    _sink = sink
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import os
+import time
+from typing import AsyncIterator
+
+from app.core.lib import ConfigFile, GetConfigFile
+
+# 同步进度最短的发布间隔，秒，处理再快也不会更频繁地写文件
+PROGRESS_INTERVAL = float(os.getenv('PROGRESS_INTERVAL', '0.5'))
+# 实时进度没有变化时发送心跳的间隔，秒
+PROGRESS_HEARTBEAT = float(os.getenv('PROGRESS_HEARTBEAT', '15'))
+
+PROGRESS_DIR = os.path.abspath("./data/config/progress")
+
+
+def progressFile(key: str) -> ConfigFile:
+    return GetConfigFile(os.path.join(PROGRESS_DIR, '%s.json' % key), lambda data: data if len(data) > 0 else None)
+
+
+class Progress:
+    """
+    同步任务的结构化进度，按PROGRESS_INTERVAL节流后写入 data/config/progress/{key}.json
+
+    任务在调度器的进程中运行，API在另一个进程，进度文件和运行状态一样先写临时文件再重命名，
+    读取方通过ConfigFile缓存，文件没有变化时只需要一次stat
+    phase: strm-解析网盘目录树并生成STRM，delete-删除，meta-元数据，done-完成，failed-出错，stopped-中断
+    """
+    key: str
+    enabled: bool
+    phase: str
+    done: int
+    total: int # 0表示总数未知（边解析边生成时）
+    errors: int
+    scanned: int # 已经解析的网盘路径数
+    started_at: float # 任务开始的时间
+    phase_at: float # 当前阶段开始的时间
+    published_at: float
+    message: str
+
+    def __init__(self, key: str, enabled: bool = True):
+        self.key = key
+        self.enabled = enabled
+        self.started_at = time.time()
+        self.published_at = 0
+        self.scanned = 0
+        self.message = ''
+        self.reset('strm')
+
+    def reset(self, phase: str, total: int = 0):
+        self.phase = phase
+        self.total = total
+        self.done = 0
+        self.errors = 0
+        self.phase_at = time.time()
+
+    def start(self, phase: str, total: int = 0):
+        # 进入新的阶段，立即发布
+        self.reset(phase, total)
+        self.publish(True)
+
+    def advance(self, n: int = 1, error: bool = False):
+        self.done += n
+        if error:
+            self.errors += n
+        self.publish()
+
+    def set(self, done: int, errors: int = 0):
+        # 调用方自己维护计数时直接设置
+        self.done = done
+        self.errors = errors
+        self.publish()
+
+    def scan(self, n: int = 1):
+        self.scanned += n
+        self.publish()
+
+    def finish(self, phase: str = 'done', message: str = ''):
+        self.phase = phase
+        self.message = message
+        self.publish(True)
+
+    def getJson(self) -> dict:
+        now = time.time()
+        elapsed = now - self.phase_at
+        rate = self.done / elapsed if elapsed > 0 else 0
+        eta = None
+        if self.total > 0 and rate > 0:
+            eta = round(max(0, self.total - self.done) / rate, 1)
+        return {
+            'key': self.key,
+            'pid': os.getpid(),
+            'phase': self.phase,
+            'done': self.done,
+            'total': self.total,
+            'errors': self.errors,
+            'scanned': self.scanned,
+            'rate': round(rate, 1),
+            'eta': eta,
+            'message': self.message,
+            'running': self.phase not in ('done', 'failed', 'stopped'),
+            'started_at': self.started_at,
+            'updated_at': now,
+        }
+
+    def publish(self, force: bool = False):
+        if not self.enabled:
+            return
+        now = time.time()
+        if not force and now - self.published_at < PROGRESS_INTERVAL:
+            return
+        self.published_at = now
+        data = self.getJson()
+        try:
+            progressFile(self.key).save(data, data)
+        except OSError:
+            # 进度只用于展示，写入失败不影响同步
+            pass
+
+
+def GetProgress(key: str) -> dict | None:
+    """
+    读取同步目录最近一次发布的进度，没有进度返回None
+    :param key: 同步目录key
+    """
+    try:
+        return progressFile(key).load()
+    except ValueError:
+        return None
+
+
+def DeleteProgress(key: str):
+    progressFile(key).delete()
+
+
+async def followProgress(key: str, is_disconnected=None) -> AsyncIterator[str]:
+    """
+    实时进度，生成SSE格式的事件，进度文件变化时推送最新的进度，连接建立时先推送当前的进度
+    :param key: 同步目录key
+    :param is_disconnected: 检查客户端是否已断开的协程函数
+    """
+    last = None
+    idle = 0.0
+    while True:
+        if is_disconnected is not None and await is_disconnected():
+            return
+        data = GetProgress(key)
+        if data is not None and data is not last:
+            last = data
+            idle = 0
+            yield 'event: progress\ndata: %s\n\n' % json.dumps(data, ensure_ascii=False)
+        elif idle >= PROGRESS_HEARTBEAT:
+            idle = 0
+            yield ': ping\n\n'
+        await asyncio.sleep(PROGRESS_INTERVAL)
+        idle += PROGRESS_INTERVAL
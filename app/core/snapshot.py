@@ -0,0 +1,129 @@
+import os
+import sqlite3
+from typing import Iterable, Iterator
+
+
+class TreeSnapshot:
+    """
+    保存每个同步目录上一次成功同步时的115目录树，用于增量同步
+
+    每个同步目录一个SQLite文件：data/config/snapshots/{key}.db
+    - tree: 上一次成功同步的目录树
+    - next: 本次同步解析出的目录树，同步成功后替换tree
+    """
+    snapshot_dir: str = os.path.abspath("./data/config/snapshots")
+    key: str
+    snapshot_file: str
+    conn: sqlite3.Connection | None
+    batch: list[tuple[str]]
+    batch_size: int = 2000
+
+    def __init__(self, key: str):
+        self.key = key
+        self.snapshot_file = os.path.join(self.snapshot_dir, '%s.db' % key)
+        self.conn = None
+        self.batch = []
+
+    def exists(self) -> bool:
+        if not os.path.exists(self.snapshot_file):
+            return False
+        try:
+            row = self.connect().execute("SELECT value FROM meta WHERE name = 'complete'").fetchone()
+        except sqlite3.Error:
+            return False
+        return row is not None and row[0] == '1'
+
+    def connect(self) -> sqlite3.Connection:
+        if self.conn is not None:
+            return self.conn
+        if not os.path.exists(self.snapshot_dir):
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+        conn = sqlite3.connect(self.snapshot_file)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID')
+        conn.execute('CREATE TABLE IF NOT EXISTS tree (path TEXT PRIMARY KEY) WITHOUT ROWID')
+        conn.execute('DROP TABLE IF EXISTS next')
+        conn.execute('CREATE TABLE next (path TEXT PRIMARY KEY) WITHOUT ROWID')
+        conn.commit()
+        self.conn = conn
+        return conn
+
+    def feed(self, path: str) -> bool:
+        # 记录本次的一个路径，返回该路径是否为上次快照中没有的新路径
+        conn = self.connect()
+        self.batch.append((path,))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+        return conn.execute('SELECT 1 FROM tree WHERE path = ?', (path,)).fetchone() is None
+
+    def flush(self):
+        if len(self.batch) == 0:
+            return
+        self.conn.executemany('INSERT OR IGNORE INTO next (path) VALUES (?)', self.batch)
+        self.batch = []
+
+    def add(self, path: str):
+        # 全量同步时只记录目录树，不需要比对
+        self.connect()
+        self.batch.append((path,))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def record(self, src_tree_list: Iterable[str]):
+        for path in src_tree_list:
+            self.add(path)
+        self.flush()
+        self.connect().commit()
+
+    def recordIter(self, src_tree_list: Iterable[str]) -> Iterator[str]:
+        # 边记录边返回，用于流式处理
+        for path in src_tree_list:
+            self.add(path)
+            yield path
+
+    def removed(self) -> Iterator[str]:
+        # 上次快照中存在，本次不存在的路径，必须在全部feed之后调用
+        self.flush()
+        self.conn.commit()
+        cursor = self.conn.execute('SELECT path FROM tree EXCEPT SELECT path FROM next ORDER BY 1')
+        for row in cursor:
+            yield row[0]
+
+    def delta(self, src_tree_list: Iterable[str]) -> tuple[list[str], list[str]]:
+        # 返回：新增的路径，删除的路径
+        added = [path for path in src_tree_list if self.feed(path)]
+        return added, list(self.removed())
+
+    def commit(self):
+        # 同步成功，用本次的目录树替换快照
+        conn = self.connect()
+        self.flush()
+        conn.execute('DELETE FROM tree')
+        conn.execute('INSERT INTO tree (path) SELECT path FROM next')
+        conn.execute('DELETE FROM next')
+        conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('complete', '1')")
+        conn.commit()
+        self.close()
+
+    def discard(self):
+        # 同步失败，保留上一次的快照
+        if self.conn is None:
+            return
+        self.batch = []
+        self.conn.rollback()
+        self.conn.execute('DELETE FROM next')
+        self.conn.commit()
+        self.close()
+
+    def close(self):
+        if self.conn is None:
+            return
+        self.conn.close()
+        self.conn = None
+
+    def delete(self):
+        self.close()
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(self.snapshot_file + suffix):
+                os.unlink(self.snapshot_file + suffix)
@@ -0,0 +1,170 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import os
+from typing import Iterable, Iterator
+import urllib
+import urllib.parse
+
+from app.core.lib import Lib
+
+
+class StrmBuilder:
+    """
+    按同步目录的配置生成STRM文件的内容，同步任务和监控服务使用同一套规则
+
+    URL的前缀(WebDAV地址+账号密码、Alist的/d/路径)在创建时只计算一次，
+    同一目录下的文件共用上级目录编码后的结果，生成大量STRM时只需要编码文件名
+    """
+    lib: Lib
+    local: bool
+    base: str # 本地路径：STRM内容的根目录；其他：URL前缀，以/结尾
+    mount_prefix: str # 需要从路径中去掉的alist挂载根文件夹，不带首尾的/
+    quoted_dirs: dict[str, str] # 上级目录 => 编码后的URL前缀
+    max_cached_dirs: int = 100000
+
+    def __init__(self, lib: Lib):
+        self.lib = lib
+        self.local = lib.type == '本地路径'
+        self.mount_prefix = lib.mount_path.strip('/')
+        self.quoted_dirs = {}
+        if self.local:
+            self.base = lib.path_of_115 if lib.cloud_type == '115' else lib.path
+        elif lib.type == 'WebDAV':
+            url = lib.webdav_url
+            if not url.startswith('http'):
+                url = "http://{0}".format(url)
+            if lib.webdav_username != '' or lib.webdav_password != '':
+                url = url.replace('//', '//{0}:{1}@'.format(lib.webdav_username, lib.webdav_password), 1)
+            self.base = url.rstrip('/') + '/'
+        else:
+            alist_115_path = lib.alist_115_path.strip('/')
+            self.base = '{0}/d/{1}'.format(lib.alist_server.rstrip('/'), alist_115_path + '/' if alist_115_path != '' else '')
+
+    def stripMount(self, path: str) -> str:
+        # 去掉路径开头的alist挂载根文件夹，只按完整的目录名匹配
+        path = path.lstrip('/')
+        if self.mount_prefix == '':
+            return path
+        if path == self.mount_prefix:
+            return ''
+        if path.startswith(self.mount_prefix + '/'):
+            return path[len(self.mount_prefix) + 1:]
+        return path
+
+    def quoteDir(self, dirname: str) -> str:
+        # 编码后的上级目录前缀，以/结尾（根目录为空字符串）
+        quoted = self.quoted_dirs.get(dirname)
+        if quoted is None:
+            if len(self.quoted_dirs) >= self.max_cached_dirs:
+                self.quoted_dirs.clear()
+            quoted = urllib.parse.quote(dirname) + '/' if dirname != '' else ''
+            self.quoted_dirs[dirname] = quoted
+        return quoted
+
+    def build(self, path: str) -> str:
+        # path是相对于115挂载目录(或者other类型的同步路径)的路径，使用系统路径分隔符
+        if self.local:
+            return os.path.join(self.base, path)
+        if os.sep != '/':
+            path = path.replace(os.sep, '/')
+        if self.mount_prefix != '' or path.startswith('/'):
+            path = self.stripMount(path)
+        dirname, _, filename = path.rpartition('/')
+        return self.base + self.quoteDir(dirname) + urllib.parse.quote(filename)
+
+    def buildMany(self, paths: Iterable[str]) -> list[str]:
+        """
+        批量生成STRM内容，顺序和paths一致
+        :param paths: 相对于115挂载目录的路径，使用系统路径分隔符
+        """
+        build = self.build
+        return [build(path) for path in paths]
+
+    def getExt(self, strm_content: str) -> str:
+        # 从STRM内容中取出视频文件的扩展名
+        if self.lib.type != '本地路径':
+            strm_content = urllib.parse.unquote(strm_content)
+        _, ext = os.path.splitext(strm_content.strip())
+        return ext
+
+
+class StrmWriter:
+    """
+    并发写入STRM文件
+
+    待写入的文件按批次读取，每批先按上级目录分组，每个目录只创建一次，
+    然后把文件写入分发到线程池中。网络存储(NFS/SMB)上每个系统调用都是一次往返，
+    并发可以把延迟叠加起来，让整体速度只受带宽限制
+    """
+    root: str
+    workers: int
+    batch_size: int
+    made_dirs: set[str] # 已经确认存在的目录
+
+    def __init__(self, root: str, workers: int = 4, batch_size: int = 500):
+        self.root = root
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.made_dirs = set()
+
+    def makedirs(self, real_dirname: str):
+        os.makedirs(real_dirname, exist_ok=True)
+        return real_dirname
+
+    def writeFile(self, strm_real_file: str, content: str) -> bool:
+        # 独占创建，一次调用同时完成是否存在的检查，返回是否新建了文件
+        try:
+            with open(strm_real_file, 'x', encoding='utf-8') as f:
+                f.write(content)
+        except FileExistsError:
+            return False
+        return True
+
+    def write(self, items: Iterable[tuple[str, str, str]]) -> Iterator[tuple[str, bool, OSError | None]]:
+        """
+        写入STRM文件，按完成顺序返回结果
+
+        :param items: (标识, 相对于root的STRM文件路径, STRM内容)，可以是生成器
+        :return: (标识, 是否新建了文件, 错误)
+        """
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='strm') as executor:
+            batch = []
+            for item in items:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    yield from self.writeBatch(executor, batch)
+                    batch = []
+            if len(batch) > 0:
+                yield from self.writeBatch(executor, batch)
+
+    def writeBatch(self, executor: ThreadPoolExecutor, batch: list[tuple[str, str, str]]) -> Iterator[tuple[str, bool, OSError | None]]:
+        # 按上级目录分组，先并发创建本批次中新出现的目录
+        groups: dict[str, list[tuple[str, str, str]]] = {}
+        for item in batch:
+            real_dirname = os.path.dirname(os.path.join(self.root, item[1]))
+            groups.setdefault(real_dirname, []).append(item)
+        dir_errors: dict[str, OSError] = {}
+        dir_futures = {executor.submit(self.makedirs, d): d for d in groups if d not in self.made_dirs}
+        for future in dir_futures:
+            real_dirname = dir_futures[future]
+            try:
+                future.result()
+                self.made_dirs.add(real_dirname)
+            except OSError as e:
+                dir_errors[real_dirname] = e
+        # 再并发写入文件
+        futures = {}
+        for real_dirname, group in groups.items():
+            for key, strm_file, content in group:
+                if real_dirname in dir_errors:
+                    yield key, False, dir_errors[real_dirname]
+                    continue
+                future = executor.submit(self.writeFile, os.path.join(self.root, strm_file), content)
+                futures[future] = key
+        pending = set(futures)
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    yield futures[future], future.result(), None
+                except OSError as e:
+                    yield futures[future], False, e
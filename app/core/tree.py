@@ -0,0 +1,79 @@
+import os
+from typing import Iterable, List, Mapping
+
+
+class TreeDiffResult:
+    added: List[str] # 需要生成STRM的视频文件
+    kept: List[str] # 两边都存在的文件或目录
+    orphaned: List[str] # 本地存在但网盘不存在，需要删除
+    meta: List[str] # 需要复制的元数据
+
+    def __init__(self):
+        self.added = []
+        self.kept = []
+        self.orphaned = []
+        self.meta = []
+
+
+class TreeDiff:
+    """
+    基于哈希索引的目录树比对，替代逐项在列表中查找和删除的写法
+
+    本地目录树在初始化时建立一次索引（路径集合 + 文件名到.strm文件的映射），
+    之后每个网盘路径的判断都是O(1)，整体只需一次线性遍历
+    """
+    strm_ext: frozenset[str]
+    meta_ext: frozenset[str]
+    dest_index: Mapping[str, bool] # 本地路径 => 是否已被网盘路径匹配
+    strm_index: Mapping[str, str] # 去掉扩展名的路径 => 本地.strm文件路径
+
+    def __init__(self, dest_tree_list: Iterable[str], strm_ext: Iterable[str], meta_ext: Iterable[str]):
+        self.strm_ext = frozenset(ext.lower() for ext in strm_ext)
+        self.meta_ext = frozenset(ext.lower() for ext in meta_ext)
+        # dict保留插入顺序，删除阶段仍按本地目录遍历的顺序处理
+        self.dest_index = dict.fromkeys(dest_tree_list, False)
+        self.strm_index = {}
+        for dest_item in self.dest_index:
+            if dest_item.endswith('.strm'):
+                self.strm_index[dest_item[:-5]] = dest_item
+
+    def classify(self, src_item: str) -> str | None:
+        # 返回值：kept-已存在，added-需要生成STRM，meta-需要复制的元数据，None-无需处理
+        dest_index = self.dest_index
+        if src_item in dest_index:
+            dest_index[src_item] = True
+            return 'kept'
+        filename, ext = os.path.splitext(src_item)
+        ext = ext.lower()
+        if ext in self.strm_ext:
+            strm_file = self.strm_index.get(filename)
+            if strm_file is not None:
+                dest_index[strm_file] = True
+                return 'kept'
+            return 'added'
+        if ext in self.meta_ext:
+            return 'meta'
+        return None
+
+    def orphaned(self) -> List[str]:
+        # 本地存在但没有被任何网盘路径匹配到的项目
+        return [item for item, matched in self.dest_index.items() if not matched]
+
+    def diff(self, src_tree_list: Iterable[str]) -> TreeDiffResult:
+        result = TreeDiffResult()
+        buckets = {
+            'kept': result.kept,
+            'added': result.added,
+            'meta': result.meta,
+        }
+        classify = self.classify
+        for src_item in src_tree_list:
+            action = classify(src_item)
+            if action is not None:
+                buckets[action].append(src_item)
+        result.orphaned = self.orphaned()
+        return result
+
+
+def diffTree(src_tree_list: Iterable[str], dest_tree_list: Iterable[str], strm_ext: Iterable[str], meta_ext: Iterable[str]) -> TreeDiffResult:
+    return TreeDiff(dest_tree_list, strm_ext, meta_ext).diff(src_tree_list)
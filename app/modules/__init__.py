@@ -1,3 +1,4 @@
 from app.modules.cron import StartCron
 from app.modules.watch import StartWatch
 from app.modules.job import StartJob
+from app.modules.scheduler import GetScheduler
@@ -1,67 +1,131 @@
-
-import hashlib
-from multiprocessing import Process
-import os
+import datetime
+import heapq
+import signal
+import sys
+import threading
 import time
-from crontab import CronTab
+from croniter import croniter, CroniterError
 
-from app.core.lib import TABFILE, Libs
+from app.core.lib import Libs
+from app.modules.observer import WatchConfigFile
+from app.modules.scheduler import GetScheduler
 from app.utils.log import getLogger
 
-cronSubProc: Process | None = None
 logger = getLogger(name='cron', rotating=True, stream=True)
 
-def get_file_md5(file_path):
+
+class CronEntry:
+    # 一个同步目录的定时规则，规则只在创建时解析一次
+    key: str
+    cron_str: str
+    iter: croniter
+    gen: int # 规则变化后旧的堆元素作废
+
+    def __init__(self, key: str, cron_str: str, gen: int):
+        self.key = key
+        self.cron_str = cron_str
+        self.iter = croniter(cron_str, datetime.datetime.now())
+        self.gen = gen
+
+    def next(self) -> float:
+        # 从当前时间开始计算下一次执行的时间戳，进程卡住错过的执行不会补跑
+        self.iter.set_current(datetime.datetime.now())
+        return self.iter.get_next(datetime.datetime).timestamp()
+
+
+class CronScheduler:
     """
-    获取文件md5值
-    :param file_path: 文件路径名
-    :return: 文件md5值
+    进程内的定时任务调度器
+
+    同步目录的cron_str只在配置变化时解析，下一次执行的时间保存在最小堆中，
+    主循环只在最近一次执行的时间或者libs.json变化时醒来，
+    到期的同步目录交给同步任务调度器，在已经加载好模块的进程中运行，不再启动新的解释器
     """
-    with open(file_path, 'rb') as f:
-        md5obj = hashlib.md5()
-        md5obj.update(f.read())
-        _hash = md5obj.hexdigest()
-    return str(_hash).upper()
-
-def startCronSub():
-    logger.info('启动Crontab守护进程')
-    tab = CronTab(tabfile=TABFILE)
-    try:
-        for result in tab.run_scheduler():
-            logger.info("Return code: {0}".format(result.returncode))
-            logger.info("Standard Out: {0}".format(result.stdout))
-            logger.info("Standard Err: {0}".format(result.stderr))
-    except:
-        pass
+    libs: Libs
+    entries: dict[str, CronEntry]
+    heap: list[tuple[float, int, str]] # (下一次执行的时间戳, gen, 同步目录key)
+    gen: int
+    changed: threading.Event
+
+    def __init__(self, libs: Libs | None = None):
+        self.libs = libs if libs is not None else Libs()
+        self.entries = {}
+        self.heap = []
+        self.gen = 0
+        self.changed = threading.Event()
+
+    def reload(self):
+        # 对比配置，只处理新增、删除和规则有变化的同步目录
+        libs = {lib.key: lib for lib in self.libs.list() if lib.sync_type == '定时' and lib.cron_str != ''}
+        for key in list(self.entries.keys()):
+            lib = libs.get(key)
+            if lib is not None and lib.cron_str == self.entries[key].cron_str:
+                continue
+            del self.entries[key]
+            logger.info('移除定时任务：%s' % key)
+        for key, lib in libs.items():
+            if key in self.entries:
+                continue
+            self.gen += 1
+            try:
+                entry = CronEntry(key, lib.cron_str, self.gen)
+            except (CroniterError, ValueError) as e:
+                logger.error('同步目录[{0}]的定时规则无效 {1} : {2}'.format(lib.name, lib.cron_str, e))
+                continue
+            self.entries[key] = entry
+            self.push(entry)
+            logger.info('添加定时任务：同步目录[{0}]，规则：{1}'.format(lib.name, lib.cron_str))
+
+    def push(self, entry: CronEntry):
+        at = entry.next()
+        heapq.heappush(self.heap, (at, entry.gen, entry.key))
+        logger.info('同步目录[{0}]下一次执行时间：{1}'.format(entry.key, datetime.datetime.fromtimestamp(at).strftime("%Y-%m-%d %H:%M:%S")))
+
+    def fire(self) -> float | None:
+        # 执行所有到期的任务，返回距离下一次执行的秒数，没有任务返回None
+        while len(self.heap) > 0:
+            at, gen, key = self.heap[0]
+            entry = self.entries.get(key)
+            if entry is None or entry.gen != gen:
+                # 已经删除或者规则已经变化
+                heapq.heappop(self.heap)
+                continue
+            now = time.time()
+            if at > now:
+                return at - now
+            heapq.heappop(self.heap)
+            rs, msg = GetScheduler().submit(key)
+            if rs:
+                logger.info('定时任务触发：%s' % key)
+            else:
+                logger.warning('定时任务触发失败 {0} : {1}'.format(key, msg))
+            self.push(entry)
+        return None
+
+    def run(self):
+        while True:
+            self.changed.clear()
+            try:
+                self.reload()
+            except Exception as e:
+                logger.error('加载定时任务失败: {0}'.format(e))
+            while not self.changed.is_set():
+                timeout = self.fire()
+                self.changed.wait(timeout)
+
 
 def StartCron():
-    if not os.path.exists(TABFILE):
-        with open(TABFILE, mode='w', encoding='utf-8') as f:
-            f.write('')
-    LIBS = Libs()
-    # 启动定时任务服务
-    LIBS.initCron()
-    logger.info("启动定时任务监控进程")
-    cronSubProc = Process(target=startCronSub)
-    cronSubProc.start()
-    md5 = get_file_md5(TABFILE)
-    logger.info("记录cron文件的指纹：{0}".format(md5))
-    while(True):
-        newmd5 = get_file_md5(TABFILE)
-        if md5 != newmd5:
-            logger.info("cron文件有变化，重新加载定时任务{0} : {1}".format(md5, newmd5))
-            # 有变化，重启进程
-            cronSubProc.terminate()
-            cronSubProc = Process(target=startCronSub)
-            cronSubProc.start()
-            md5 = newmd5
-        # else:
-        #     print("cron文件没有变化，等待10秒重试")
-        try:
-            # logger.info('已启动所有定时任务，开始10s一次检测任务执行状态')
-            time.sleep(10)
-        except:
-            break
+    cron = CronScheduler()
+    configOb = WatchConfigFile(cron.libs.libs_file, cron.changed)
+
+    def stop(sig, frame):
+        configOb.stop()
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    logger.info("定时任务服务已启动")
+    cron.run()
 
 if __name__ == '__main__':
     StartCron()
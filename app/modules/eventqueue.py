@@ -0,0 +1,188 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+import logging
+import os
+import threading
+import time
+from typing import Callable
+
+# 同一个路径最后一次变化后等待多久再处理
+WATCH_DEBOUNCE = float(os.getenv('WATCH_DEBOUNCE', '2'))
+# 并发处理事件的线程数
+WATCH_WORKERS = int(os.getenv('WATCH_WORKERS', '4'))
+# 每批最多处理的事件数
+WATCH_BATCH_SIZE = 1000
+
+# 和监控服务使用同一个日志，日志的输出由watch模块配置
+logger = logging.getLogger('watch')
+
+
+class PendingEvent:
+    # 合并后的事件，属性和watchdog的事件一致，处理函数不需要区分
+    event_type: str # created | deleted | modified | moved
+    src_path: str
+    dest_path: str
+    is_directory: bool
+    handler: object # 处理该事件的FileEventHandler
+    updated_at: float
+
+    def __init__(self, event_type: str, src_path: str, dest_path: str, is_directory: bool, handler: object):
+        self.event_type = event_type
+        self.src_path = src_path
+        self.dest_path = dest_path
+        self.is_directory = is_directory
+        self.handler = handler
+        self.updated_at = time.monotonic()
+
+    @property
+    def path(self) -> str:
+        # 事件最终作用的路径
+        return self.dest_path if self.event_type == 'moved' else self.src_path
+
+
+class EventQueue:
+    """
+    监控事件的防抖合并队列
+
+    watchdog的回调只把事件放入队列，同一个路径上的 创建 -> 修改 -> 移动 -> 删除 合并为最终结果，
+    路径在debounce秒内没有新事件后，由后台线程分批交给线程池处理。
+    目录事件按顺序串行处理，文件事件并发处理
+    """
+    debounce: float
+    batch_size: int
+    pending: OrderedDict[tuple[int, str], PendingEvent] # (handler id, 路径) => 合并后的事件
+    apply: Callable[[PendingEvent], None]
+    lock: threading.Condition
+    executor: ThreadPoolExecutor
+    thread: threading.Thread | None
+    running: bool
+
+    def __init__(self, apply: Callable[[PendingEvent], None], debounce: float = WATCH_DEBOUNCE, workers: int = WATCH_WORKERS, batch_size: int = WATCH_BATCH_SIZE):
+        self.apply = apply
+        self.debounce = debounce
+        self.batch_size = batch_size
+        self.pending = OrderedDict()
+        self.lock = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='watch')
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.loop, name='watch-queue', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.lock.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.executor.shutdown(wait=True)
+
+    def push(self, handler: object, event_type: str, src_path: str, dest_path: str = '', is_directory: bool = False):
+        with self.lock:
+            self.merge(handler, event_type, src_path, dest_path, is_directory)
+            self.lock.notify_all()
+
+    def merge(self, handler: object, event_type: str, src_path: str, dest_path: str, is_directory: bool):
+        # 必须在持有lock时调用
+        hid = id(handler)
+        if event_type == 'moved':
+            prev = self.pending.pop((hid, src_path), None)
+            if prev is not None and prev.event_type == 'created':
+                # 新建后又移动，等于在新位置新建
+                self.put(PendingEvent('created', dest_path, '', is_directory, handler))
+                return
+            if prev is not None and prev.event_type == 'moved':
+                # 连续移动，合并为从最初的位置移动到最终的位置
+                src_path = prev.src_path
+                if src_path == dest_path:
+                    return
+            self.put(PendingEvent('moved', src_path, dest_path, is_directory, handler))
+            return
+        prev = self.pending.get((hid, src_path))
+        if prev is None:
+            self.put(PendingEvent(event_type, src_path, '', is_directory, handler))
+            return
+        if event_type == 'deleted':
+            del self.pending[(hid, src_path)]
+            if prev.event_type == 'created':
+                # 新建后又删除，什么都不用做
+                return
+            if prev.event_type == 'moved':
+                # 移动后删除，等于删除原来的位置
+                self.put(PendingEvent('deleted', prev.src_path, '', is_directory, handler))
+                return
+            self.put(PendingEvent('deleted', src_path, '', is_directory, handler))
+            return
+        if event_type == 'created':
+            if prev.event_type == 'deleted' and not is_directory:
+                # 删除后又创建，文件被替换
+                event_type = 'modified'
+            self.put(PendingEvent(event_type, src_path, '', is_directory, handler))
+            return
+        if event_type == 'modified':
+            # 新建、移动之后的修改仍然按照之前的事件处理，只刷新时间
+            prev.updated_at = time.monotonic()
+            self.pending.move_to_end((hid, src_path))
+            return
+
+    def put(self, event: PendingEvent):
+        key = (id(event.handler), event.path)
+        self.pending.pop(key, None)
+        self.pending[key] = event
+
+    def takeReady(self) -> tuple[list[PendingEvent], float]:
+        # 取出已经稳定的事件，返回：事件列表，下一次需要等待的秒数
+        now = time.monotonic()
+        ready = []
+        timeout = self.debounce
+        for key in list(self.pending.keys()):
+            event = self.pending[key]
+            wait_time = event.updated_at + self.debounce - now
+            if wait_time > 0:
+                # pending按最后更新时间排序，后面的都还没稳定
+                timeout = wait_time
+                break
+            del self.pending[key]
+            ready.append(event)
+            if len(ready) >= self.batch_size:
+                timeout = 0
+                break
+        return ready, timeout
+
+    def loop(self):
+        while True:
+            with self.lock:
+                if not self.running:
+                    return
+                if len(self.pending) == 0:
+                    self.lock.wait()
+                    continue
+                ready, timeout = self.takeReady()
+                if len(ready) == 0:
+                    self.lock.wait(timeout)
+                    continue
+            self.applyBatch(ready)
+
+    def applyBatch(self, events: list[PendingEvent]):
+        # 目录事件会影响其中的文件，先按顺序串行处理，再并发处理文件事件
+        files = []
+        for event in events:
+            if event.is_directory:
+                self.safeApply(event)
+            else:
+                files.append(event)
+        if len(files) > 0:
+            wait([self.executor.submit(self.safeApply, event) for event in files])
+        logger.info('处理了 {0} 个合并后的文件事件'.format(len(events)))
+
+    def safeApply(self, event: PendingEvent):
+        try:
+            self.apply(event)
+        except Exception as e:
+            logger.error('处理事件失败 {0} {1} : {2}'.format(event.event_type, event.path, e))
@@ -1,19 +1,25 @@
 import argparse
-from pathlib import Path
+import itertools
+from typing import Iterable, Iterator
 import shutil
 import signal
-import textwrap
-import time
-import urllib
-import urllib.parse
+import stat
 import psutil
 
-from p115client import P115Client, tool
-import telegramify_markdown
-from app.core.lib import OO5, GetNow, Lib, Libs, OO5List, Setting, TGBot
+from p115client import tool
+from app.core.client import CheckClient, GetClient
+from app.core.exportcache import ExportCache
+from app.core.meta import MetaCopier, MetaManifest
+from app.core.lib import OO5, GetNow, Lib, Libs, OO5List
+from app.core.notify import Notify
+from app.core.snapshot import TreeSnapshot
+from app.core.progress import Progress
+from app.core.strm import StrmBuilder, StrmWriter
+from app.core.tree import TreeDiff
 import os, logging, sys
-from telegramify_markdown import customize
 
+from app.utils.fs import walkTree
+from app.utils.lock import FileLock
 from app.utils.log import getLogger
 from telebot import apihelper
 proxyHost = os.getenv('PROXY_HOST', '')
@@ -28,44 +34,40 @@ class Job:
     lib: Lib
     oo5Account: OO5
     logger: logging
+    full: bool # 忽略目录树快照，执行全量同步
+    dry_run: bool # 只输出同步计划，不修改任何文件
+    strmBuilder: StrmBuilder
+    progress: Progress # 结构化的同步进度
+    strm_batch_size: int = 500
 
     copyList: list[str]
 
-    def __init__(self, key: str = None, logStream: bool = False):
+    def __init__(self, key: str = None, logStream: bool = False, full: bool = False):
         if key is None:
             return
         self.key = key
+        self.full = full
+        self.dry_run = False
         self.lib = LIBS.getLib(key)
         if self.lib is None:
             raise ValueError('要执行的同步目录不存在，请刷新同步目录列表检查是否存在')
+        self.strmBuilder = StrmBuilder(self.lib)
+        self.progress = Progress(self.key)
         self.logger = getLogger(name = self.lib.key, clear=True, stream=logStream)
         if self.lib.cloud_type == '115':
             self.oo5Account = o5List.get(self.lib.id_of_115)
             if self.oo5Account is None:
                 self.logger.error('无法找到所选的115账号，请检查115账号列表中是否存在此项: %s' % self.lib.id_of_115)
                 raise ValueError('无法找到所选的115账号，请检查115账号列表中是否存在此项')
-        try:
-            if self.lib.extra.pid > 0 and psutil.pid_exists(self.lib.extra.pid):
-                self.logger.error('正在同步中，跳过本次执行')
-                raise ValueError('正在同步中，跳过本次执行')
-        except:
-            pass
-
-    def notify(self, msg):
-        settings = Setting()
-        if settings.telegram_bot_token == '' or settings.telegram_user_id == '':
+        if self.lib.extra.pid > 0 and self.lib.extra.pid != os.getpid() and psutil.pid_exists(self.lib.extra.pid):
+            self.logger.error('正在同步中，跳过本次执行')
+            raise ValueError('正在同步中，跳过本次执行')
+
+    def notify(self, msg, digest: bool = False):
+        # 放入通知队列后立即返回，同步完成的通知可以和其他同步目录的合并发送
+        if self.dry_run:
             return
-        bot = TGBot()
-        markdown_text = textwrap.dedent(msg)
-        can_be_sent = telegramify_markdown.markdownify(markdown_text)
-        rs, msg = bot.sendMsg(can_be_sent)
-        if rs:
-            lm = "成功发送通知"
-            if msg != "":
-                lm = "无法发送通知：{0}".format(msg)
-            self.logger.info(lm)
-        else:
-            self.logger.warning("无法发送通知: {0}".format(msg))
+        Notify(msg, digest)
 
     def start(self):
         # 记录开始时间
@@ -77,10 +79,11 @@ class Job:
         LIBS.saveExtra(self.lib)
         self.notify("*{0}* 开始同步".format(self.lib.name))
         self.lib = LIBS.getLib(self.key)
+        self.progress.start('strm')
         try:
             self.work()
+            self.progress.finish('done')
             self.lib.extra.status = 1
-            customize.strict_markdown = False
             tgmesage = """
 *{0}* 已完成同步
 
@@ -90,10 +93,11 @@ class Job:
 """
 
             tgmessage = tgmesage.format(self.lib.name, self.lib.extra.last_sync_result['strm'][1], self.lib.extra.last_sync_result['strm'][0], self.lib.extra.last_sync_result['meta'][0], self.lib.extra.last_sync_result['meta'][0], self.lib.extra.last_sync_result['delete'][0], self.lib.extra.last_sync_result['delete'][0])
-            self.notify(tgmessage)
+            self.notify(tgmessage, True)
         except Exception as e:
             self.logger.error('%s' % e)
             self.lib.extra.status = 3
+            self.progress.finish('failed', '%s' % e)
             self.notify("*{0}* 同步发生错误： {1}".format(self.lib.name, e))
         self.lib.extra.pid = 0
         LIBS.saveExtra(self.lib)
@@ -103,109 +107,222 @@ class Job:
         self.lib.extra.status = 3
         self.lib.extra.pid = 0
         LIBS.saveExtra(self.lib)
+        self.progress.finish('stopped')
         self.logger.info("*{0}* 中断同步".format(self.lib.name))
         self.notify("*{0}* 中断同步".format(self.lib.name))
         sys.exit(1)
     
-    def parseTree(self, src_tree_list: list, dest_tree_list: list) -> tuple[list, list, list]:
-        copy_list = []
-        added = []
-        for src_item in src_tree_list:
-            if src_item in dest_tree_list:
-                # 已存在，从dest中删除
-                dest_tree_list.remove(src_item)
-                continue
-            filename, ext = os.path.splitext(src_item)
+    def parseRemoved(self, removed_src: Iterable[str]) -> list:
+        # 快照中已删除的网盘路径转换为要删除的本地路径，视频文件对应.strm文件
+        deleted = []
+        for item in removed_src:
+            filename, ext = os.path.splitext(item)
             if ext.lower() in self.lib.strm_ext:
-                strm_file = filename + '.strm'
-                if strm_file in dest_tree_list:
-                    # 如果strm文件已存在，则从dest中删除
-                    dest_tree_list.remove(strm_file)
-                    continue
-                else:
-                    added.append(src_item)
-                    continue
-            if ext.lower() in self.lib.meta_ext:
-                # 如果是元数据，则加入复制列表
+                item = filename + '.strm'
+            deleted.append(item)
+        return deleted
+
+    def iterAdded(self, diff: TreeDiff, src_tree: Iterable[str], copy_list: list) -> Iterator[str]:
+        # 边解析边比对，需要生成STRM的文件直接交给doAdded，元数据放入copy_list
+        for src_item in src_tree:
+            self.progress.scan()
+            action = diff.classify(src_item)
+            if action == 'added':
+                yield src_item
+            elif action == 'meta':
                 copy_list.append(src_item)
-        return dest_tree_list, added, copy_list
 
-    def doAdded(self, added):
+    def doAdded(self, added: Iterable[str]):
+        # added可以是列表，也可以是边解析边产生的生成器，生成器没有总数
         c = 0
-        at = len(added)
+        at = len(added) if isinstance(added, list) else 0
         asuc = 0
         af = 0
-        for item in added:
+        writer = StrmWriter(self.lib.strm_root_path, workers=self.lib.strm_workers)
+        self.progress.start('strm', at)
+        for item, created, e in writer.write(self.iterStrm(added)):
             c += 1
-            rs = self.strm(item)
-            if rs == '':
+            if e is None:
                 # 成功
                 asuc += 1
-                self.logger.info('[%d / %d] STRM：%s' % (c, at, item))
+                if created:
+                    self.logger.info('[%d / %d] STRM：%s' % (c, max(at, c), item))
+                else:
+                    self.logger.info('[%d / %d] STRM已存在：%s' % (c, max(at, c), item))
             else:
                 af += 1
-                self.logger.error('[%d / %d] 错误：%s \n %s' % (c, at, item, rs))
-        self.lib.extra.last_sync_result['strm'] = [asuc, at]
+                self.logger.error('[%d / %d] 错误：%s \n %s' % (c, max(at, c), item, e))
+            self.progress.set(c, af)
+        self.lib.extra.last_sync_result['strm'] = [asuc, c]
         return True
 
+    def iterStrm(self, added: Iterable[str]) -> Iterator[tuple[str, str, str]]:
+        # 生成(网盘路径, STRM文件相对路径, STRM内容)交给StrmWriter，STRM内容按批次生成
+        batch = []
+        for item in added:
+            batch.append(item)
+            if len(batch) >= self.strm_batch_size:
+                yield from self.buildStrmBatch(batch)
+                batch = []
+        if len(batch) > 0:
+            yield from self.buildStrmBatch(batch)
+
+    def buildStrmBatch(self, batch: list[str]) -> Iterator[tuple[str, str, str]]:
+        paths = [item.replace('/', os.sep) for item in batch]
+        contents = self.strmBuilder.buildMany(paths)
+        for item, path, content in zip(batch, paths, contents):
+            filename, _ = os.path.splitext(path)
+            yield item, filename + '.strm', content
+
     def doDelete(self, dest_tree_list):
+        # 先把要删除的项目按类型和上级目录分组，批量删除后，再自底向上一次性清理不再需要的文件夹
         c = 0
         dt = len(dest_tree_list)
         ds = 0
         df = 0
+        root = self.lib.strm_root_path
+        del_dirs: list[str] = [] # 网盘中不存在的文件夹，整个删除
+        del_files: dict[str, list[str]] = {} # 上级目录 => 网盘中不存在的STRM文件
+        touched: set[str] = set() # 删除后需要检查是否还有用的文件夹
+        plan_size = 0
+        self.progress.start('delete', dt)
         for delete_item in dest_tree_list:
-            c += 1
-            delete_real_file = os.path.join(self.lib.strm_root_path, delete_item)
-            delete_real_path = os.path.dirname(delete_real_file)
-            if not os.path.exists(delete_real_file):
+            delete_real_file = os.path.join(root, delete_item)
+            try:
+                st = os.lstat(delete_real_file)
+            except FileNotFoundError:
+                c += 1
                 self.logger.error('[%d / %d] %s \n %s' % (c, dt, delete_item, '文件已经删除'))
                 ds += 1
                 continue
-            if os.path.isdir(delete_real_file):
-                # 文件夹直接删除
-                shutil.rmtree(delete_real_file)
-                self.logger.info('[%d / %d] 删除网盘不存在的文件夹：%s' % (c, dt, delete_real_file))
-                ds += 1
+            if stat.S_ISDIR(st.st_mode):
+                del_dirs.append(delete_real_file)
                 continue
-            # 处理文件，只删除strm文件
-            _, deleted_ext = os.path.splitext(delete_item)
-            if deleted_ext != '.strm':
-                # self.logger.warning('[%d / %d] 错误：网盘不存在该文件，疑似本地刮削产物： %s' % (c, dt, delete_item))
+            parent = os.path.dirname(delete_real_file)
+            touched.add(parent)
+            if os.path.splitext(delete_item)[1] != '.strm':
+                # 只删除strm文件，其他文件疑似本地刮削产物，由文件夹清理处理
+                c += 1
                 df += 1
-            else:
+                continue
+            del_files.setdefault(parent, []).append(delete_real_file)
+            plan_size += st.st_size
+        self.progress.set(c, df)
+        # 上级文件夹也要删除的，不需要再单独处理
+        del_dirs.sort()
+        removed: set[str] = set()
+        for delete_real_path in del_dirs:
+            self.progress.set(c, df)
+            c += 1
+            ds += 1
+            if self.underRemoved(delete_real_path, removed):
+                continue
+            removed.add(delete_real_path)
+            touched.add(os.path.dirname(delete_real_path))
+            if self.dry_run:
+                plan_size += self.treeSize(delete_real_path)
+                self.logger.info('[%d / %d] 计划删除网盘不存在的文件夹：%s' % (c, dt, delete_real_path))
+                continue
+            try:
+                shutil.rmtree(delete_real_path)
+                self.logger.info('[%d / %d] 删除网盘不存在的文件夹：%s' % (c, dt, delete_real_path))
+            except OSError as e:
+                self.logger.error('[%d / %d] 错误：%s \n %s' % (c, dt, delete_real_path, e))
+                ds -= 1
+                df += 1
+        for parent, files in del_files.items():
+            in_removed = self.underRemoved(parent, removed)
+            for delete_real_file in files:
+                self.progress.set(c, df)
+                c += 1
+                if in_removed:
+                    ds += 1
+                    continue
+                if self.dry_run:
+                    removed.add(delete_real_file)
+                    self.logger.info('[%d / %d] 计划删除网盘不存在的文件：%s' % (c, dt, delete_real_file))
+                    ds += 1
+                    continue
                 try:
                     os.unlink(delete_real_file)
-                    self.logger.info('[%d / %d] 删除网盘不存在的文件：%s' % (c, dt, delete_item))
+                    self.logger.info('[%d / %d] 删除网盘不存在的文件：%s' % (c, dt, delete_real_file))
                     ds += 1
                 except OSError as e:
-                    self.logger.error('[%d / %d] 错误：%s \n %s' % (c, dt, delete_item, e))
+                    self.logger.error('[%d / %d] 错误：%s \n %s' % (c, dt, delete_real_file, e))
                     df += 1
-            # 检查目录是否为空，如果为空，则删除目录
-            dirs = os.listdir(delete_real_path)
-            c = len(dirs)
-            if c == 0:
-                # 该目录为空，则删除该目录
-                os.remove(delete_real_path)
-                self.logger.info('[%d / %d] 删除空文件夹：%s' % (c, dt, delete_real_path))
-            else:
-                # 检查目录下是否有strm文件或者其他文件夹
-                can_delete = True
-                for d in dirs:
-                    item = os.path.join(delete_real_path, d)
-                    if os.path.isdir(item):
-                        can_delete = False
-                        break
-                    _, ext = os.path.splitext(item)
-                    if ext.lower() == '.strm':
-                        can_delete = False
-                        break
-                if can_delete == True:
-                    # 删除没有strm和子文件夹的目录
-                    shutil.rmtree(delete_real_path)
-                    self.logger.info('[%d / %d] 删除没有STRM的文件夹：%s' % (c, dt, delete_real_path))
-
+        self.progress.set(c, df)
+        swept, swept_size = self.sweepDirs(touched, removed)
+        plan_size += swept_size
+        if self.dry_run:
+            self.logger.info('删除计划：STRM文件 {0} 个，文件夹 {1} 个，清理文件夹 {2} 个，共 {3:.2f} MB'.format(
+                sum(len(files) for files in del_files.values()), len(del_dirs), swept, plan_size / 1024 / 1024))
         self.lib.extra.last_sync_result['delete'] = [ds, dt]
 
+    def underRemoved(self, path: str, removed: set[str]) -> bool:
+        # path本身或者它的上级文件夹是否已经删除
+        while True:
+            if path in removed:
+                return True
+            parent = os.path.dirname(path)
+            if parent == path:
+                return False
+            path = parent
+
+    def sweepDirs(self, touched: set[str], removed: set[str]) -> tuple[int, int]:
+        """
+        自底向上清理文件夹：没有STRM文件也没有子文件夹的文件夹整个删除(其中剩下的元数据一起删除)，
+        删除后再检查它的上级文件夹，同步目录的根文件夹和STRM根目录不会删除
+        :return: 删除的文件夹数量，这些文件夹的大小(只在dry_run时计算)
+        """
+        strm_root = os.path.normpath(self.lib.strm_root_path)
+        if self.lib.cloud_type == '115':
+            base_dir = os.path.normpath(os.path.join(strm_root, self.lib.path.replace('/', os.sep).strip(os.sep)))
+        else:
+            base_dir = strm_root
+        levels: dict[int, set[str]] = {}
+        for d in touched:
+            d = os.path.normpath(d)
+            levels.setdefault(d.count(os.sep), set()).add(d)
+        swept = 0
+        size = 0
+        while len(levels) > 0:
+            depth = max(levels.keys())
+            for d in levels.pop(depth):
+                if d == base_dir or not d.startswith(base_dir + os.sep) or self.underRemoved(d, removed):
+                    continue
+                try:
+                    with os.scandir(d) as it:
+                        entries = [entry for entry in it if entry.path not in removed]
+                except FileNotFoundError:
+                    continue
+                if any(entry.is_dir(follow_symlinks=False) or entry.name.lower().endswith('.strm') for entry in entries):
+                    continue
+                removed.add(d)
+                swept += 1
+                if self.dry_run:
+                    size += sum(entry.stat(follow_symlinks=False).st_size for entry in entries)
+                    self.logger.info('计划删除没有STRM的文件夹：%s' % d)
+                else:
+                    try:
+                        shutil.rmtree(d)
+                        self.logger.info('删除没有STRM的文件夹：%s' % d)
+                    except OSError as e:
+                        self.logger.error('删除文件夹失败：%s \n %s' % (d, e))
+                        continue
+                levels.setdefault(depth - 1, set()).add(os.path.dirname(d))
+        return swept, size
+
+    def treeSize(self, path: str) -> int:
+        size = 0
+        for rel in walkTree(path):
+            try:
+                st = os.lstat(os.path.join(path, rel))
+            except OSError:
+                continue
+            if not stat.S_ISDIR(st.st_mode):
+                size += st.st_size
+        return size
+
     def doMeta(self, copy_list: list):
         if self.lib.type == 'WebDAV':
             self.logger.info('webdav不处理元数据')
@@ -216,13 +333,34 @@ class Job:
         ct = len(copy_list)
         cs = 0
         cf = 0
+        self.progress.start('meta', ct)
+        if self.lib.copy_meta_file == '复制':
+            # copy_delay换算为每秒复制的文件数，多个线程共用这个额度
+            files_per_sec = 1 / self.lib.copy_delay if self.lib.copy_delay > 0 else 0
+            manifest = MetaManifest(self.key)
+            copier = MetaCopier(workers=self.lib.meta_workers, files_per_sec=files_per_sec, bytes_per_sec=self.lib.meta_rate * 1024 * 1024, manifest=manifest.load())
+            items = ((item, self.metaSrcFile(item), os.path.join(self.lib.strm_root_path, item)) for item in copy_list)
+            for item, copied, err in copier.copy(items):
+                c += 1
+                if err is None:
+                    cs += 1
+                    if copied:
+                        self.logger.info('[%d / %d] 元数据 - 复制：%s' % (c, ct, item))
+                elif isinstance(err, FileNotFoundError):
+                    cf += 1
+                    self.logger.error('[%d / %d] 元数据 - 源文件不存在：%s' % (c, ct, item))
+                else:
+                    cf += 1
+                    self.logger.error('[%d / %d] 元数据 - 复制错误：%s \n %s' % (c, ct, item, err))
+                self.progress.set(c, cf)
+            manifest.save(copier.updated)
+            manifest.close()
+            self.lib.extra.last_sync_result['meta'] = [cs, ct]
+            return
         for item in copy_list:
+            self.progress.set(c, cf)
             c += 1
-            src_file = ""
-            if self.lib.cloud_type == '115':
-                 src_file = os.path.join(self.lib.path_of_115, item)
-            else:
-                src_file = os.path.join(self.lib.path, item)
+            src_file = self.metaSrcFile(item)
             dest_file = os.path.join(self.lib.strm_root_path, item)
             dirname = os.path.dirname(dest_file)
             if not os.path.exists(dirname):
@@ -232,11 +370,6 @@ class Job:
                 self.logger.error('[%d / %d] 元数据 - 源文件不存在：%s' % (c, ct, src_file))
                 continue
             try:
-                if self.lib.copy_meta_file == '复制':
-                    self.logger.info('[%d / %d] 元数据 - 复制：%s => %s' % (c, ct, src_file, dest_file))
-                    if not os.path.exists(dest_file):
-                        shutil.copy(src_file, dest_file)
-                    time.sleep(self.lib.copy_delay)
                 if self.lib.copy_meta_file == '软链接':
                     self.logger.info('[%d / %d] 元数据 - 软链：%s' % (c, ct, item))
                     if not os.path.exists(dest_file):
@@ -245,128 +378,222 @@ class Job:
             except OSError as e:
                 self.logger.error('[%d / %d] 元数据 - 复制错误：%s \n %s' % (c, ct, item, e))
                 cf += 1
+        self.progress.set(c, cf)
         self.lib.extra.last_sync_result['meta'] = [cs, ct]
 
+    def tapMeta(self, src_tree: Iterable[str], meta_list: list) -> Iterator[str]:
+        # 检查元数据更新时，网盘中全部元数据都要比对，不只是新增的
+        meta_ext = self.lib.meta_ext
+        for item in src_tree:
+            if os.path.splitext(item)[1].lower() in meta_ext:
+                meta_list.append(item)
+            yield item
+
+    def metaSrcFile(self, item: str) -> str:
+        # 元数据在挂载目录中的路径
+        if self.lib.cloud_type == '115':
+            return os.path.join(self.lib.path_of_115, item)
+        return os.path.join(self.lib.path, item)
+
     def work(self):
-        src_tree_list = []
-        dest_tree_list = []
+        # 网盘目录树以生成器的形式边解析边比对边生成STRM，不在内存中保存完整的网盘目录树
+        snapshot = None
+        incremental = False
+        copy_list = []
+        meta_list = []
+        # 检查元数据更新：按清单比对网盘中的全部元数据，只重新复制有变化的
+        check_meta = self.lib.meta_update and self.lib.copy_meta_file == '复制' and self.lib.type != 'WebDAV'
         if self.lib.cloud_type == '115':
-            src_tree_list = self.get_src_tree_list()
             strm_base_dir = os.path.join(self.lib.strm_root_path, self.lib.path.replace('/', os.sep))
-            dest_tree_list = self.get_dest_tree_list(self.lib.strm_root_path, strm_base_dir, [self.lib.path.replace('/', os.sep)])
+            snapshot = TreeSnapshot(self.key)
+            src_tree = self.iter_src_tree()
+            if check_meta:
+                src_tree = self.tapMeta(src_tree, meta_list)
+            if not self.full and os.path.exists(strm_base_dir) and snapshot.exists():
+                # 有上次成功同步的快照，只处理有变化的文件
+                self.logger.info('增量同步：只处理和上次目录树快照相比有变化的文件')
+                incremental = True
+                diff = TreeDiff([], self.lib.strm_ext, self.lib.meta_ext)
+                src_tree = (item for item in src_tree if snapshot.feed(item))
+            else:
+                self.logger.info('全量同步：没有可用的目录树快照或者指定了全量同步')
+                dest_tree = itertools.chain([self.lib.path.replace('/', os.sep)], self.iter_dest_tree(self.lib.strm_root_path, strm_base_dir))
+                diff = TreeDiff(dest_tree, self.lib.strm_ext, self.lib.meta_ext)
+                src_tree = snapshot.recordIter(src_tree)
         else:
-            src_tree_list = self.get_dest_tree_list(self.lib.path, self.lib.path, [])
-            dest_tree_list = self.get_dest_tree_list(self.lib.strm_root_path, self.lib.strm_root_path, [])
-        dest_tree_list, added, copy_list = self.parseTree(src_tree_list, dest_tree_list)
-        # # added是要添加的, dest_tree_list剩下的是要删除的， copy_list是要复制的元数据
-        # # 处理删除
-        self.doDelete(dest_tree_list)
-        # # 处理添加
-        self.doAdded(added)
-        # # 处理元数据
-        self.doMeta(copy_list)
+            src_tree = self.iter_dest_tree(self.lib.path, self.lib.path)
+            if check_meta:
+                src_tree = self.tapMeta(src_tree, meta_list)
+            diff = TreeDiff(self.iter_dest_tree(self.lib.strm_root_path, self.lib.strm_root_path), self.lib.strm_ext, self.lib.meta_ext)
+        try:
+            # # 处理添加，边解析边生成
+            if self.dry_run:
+                at = sum(1 for _ in self.iterAdded(diff, src_tree, copy_list))
+                self.logger.info('计划生成STRM：%d 个' % at)
+            else:
+                self.doAdded(self.iterAdded(diff, src_tree, copy_list))
+            # # 处理删除，必须等网盘目录树解析完成
+            if incremental:
+                self.doDelete(self.parseRemoved(snapshot.removed()))
+            else:
+                self.doDelete(diff.orphaned())
+            # # 处理元数据
+            if self.dry_run:
+                self.logger.info('计划处理元数据：%d 个' % len(meta_list if check_meta else copy_list))
+            else:
+                self.doMeta(meta_list if check_meta else copy_list)
+        except Exception as e:
+            if snapshot is not None:
+                snapshot.discard()
+            raise e
+        if self.dry_run:
+            if snapshot is not None:
+                snapshot.discard()
+            return
+        if snapshot is not None:
+            if self.lib.extra.last_sync_result['strm'][0] < self.lib.extra.last_sync_result['strm'][1]:
+                # 有STRM生成失败，保留上次的快照，下次同步时重试
+                self.logger.warning('部分STRM生成失败，不更新目录树快照')
+                snapshot.discard()
+            else:
+                snapshot.commit()
         self.logger.info('删除结果：成功: {0}, 总共: {1}'.format(self.lib.extra.last_sync_result['delete'][0], self.lib.extra.last_sync_result['delete'][1]))
         self.logger.info('元数据结果：成功: {0}, 总共: {1}'.format(self.lib.extra.last_sync_result['meta'][0], self.lib.extra.last_sync_result['meta'][1]))
         self.logger.info('STRM结果：成功: {0}, 总共: {1}'.format(self.lib.extra.last_sync_result['strm'][0], self.lib.extra.last_sync_result['strm'][1]))
 
-    def get_src_tree_list(self):
-        ### 解析115目录树，生成目录数组
+    def exportRoot(self) -> tuple[str, list[Lib]]:
+        """
+        确定本次导出的根目录，以及会读取这次导出的其他同步目录
+        同一个115账号下有排队中的同步目录可以共用导出结果时，才导出它们共同的上级同步目录，
+        没有的话只导出本目录，也不写入缓存
+        """
+        path = self.lib.path.strip('/')
+        ancestors: list[Lib] = []
+        queued: list[Lib] = []
+        for lib in LIBS.list():
+            if lib.cloud_type != '115' or lib.id_of_115 != self.lib.id_of_115 or lib.key == self.key:
+                continue
+            p = lib.path.strip('/')
+            if p != '' and path.startswith(p + '/'):
+                ancestors.append(lib)
+            if lib.extra.status == 4:
+                queued.append(lib)
+        root = self.lib.path
+        shared = [lib for lib in queued if self.isUnder(lib.path, root)]
+        # 从近到远检查上级同步目录，只有共用的同步目录更多时才扩大导出范围
+        ancestors.sort(key=lambda lib: len(lib.path.strip('/')), reverse=True)
+        for ancestor in ancestors:
+            libs = [lib for lib in queued if self.isUnder(lib.path, ancestor.path)]
+            if len(libs) > len(shared):
+                root = ancestor.path
+                shared = libs
+        return root, shared
+
+    def isUnder(self, path: str, root: str) -> bool:
+        # path是否为root或者root下的路径
+        path = path.strip('/')
+        root = root.strip('/')
+        return path == root or path.startswith(root + '/')
+
+    def exportPrefix(self, root: str) -> str:
+        # 本目录在root的导出结果中的路径
+        return root + self.lib.path.strip('/')[len(root.strip('/')):]
+
+    def iter_src_tree(self) -> Iterator[str]:
+        ### 解析115目录树，逐个返回路径
+        # 每次同步都重新导出本目录，缓存只用于其他同步目录刚刚导出的、包含本目录的目录树
+        cache = ExportCache(self.oo5Account.key)
         try:
-            client = P115Client(self.oo5Account.cookie)
-            it = tool.export_dir_parse_iter(client=client, export_file_ids=self.lib.path, target_pid=self.lib.path, parse_iter=tool.parse_export_dir_as_dict_iter, 
+            root = None if self.full else cache.findRoot(self.lib.path, self.key)
+            if root is not None:
+                self.logger.info('使用其他同步目录刚刚导出的目录树：%s' % root)
+                cache.markRead(root, self.key)
+                yield from self.filterTree(cache.iterPaths(root, self.exportPrefix(root)), self.exportPrefix(root))
+                return
+            # 同一个115账号同时只允许一个导出任务，其他进程中的任务在这里等待
+            accountLock = FileLock('115-%s' % self.oo5Account.key)
+            if not accountLock.acquire(blocking=False):
+                self.logger.info('该115账号有其他目录正在导出目录树，等待完成')
+                accountLock.acquire()
+            try:
+                root = None if self.full else cache.findRoot(self.lib.path, self.key)
+                if root is not None:
+                    # 等待期间其他任务已经导出了包含本目录的目录树
+                    self.logger.info('使用其他任务刚刚导出的目录树：%s' % root)
+                    cache.markRead(root, self.key)
+                    yield from self.filterTree(cache.iterPaths(root, self.exportPrefix(root)), self.exportPrefix(root))
+                    return
+                root, shared = self.exportRoot()
+                paths = self.exportTree(root)
+                if len(shared) > 0:
+                    if root != self.lib.path:
+                        self.logger.info('导出上级同步目录的目录树：%s，结果可供其下排队中的同步目录共用' % root)
+                    paths = cache.recordIter(root, paths, self.key)
+                yield from self.filterTree(paths, self.exportPrefix(root))
+            finally:
+                accountLock.release()
+        finally:
+            cache.close()
+
+    def filterTree(self, paths: Iterable[str], prefix: str) -> Iterator[str]:
+        # 只返回本目录下的路径，导出根目录是上级目录时替换为本目录的路径
+        sub = prefix + '/'
+        for path in paths:
+            if path == prefix:
+                path = self.lib.path
+            elif path.startswith(sub):
+                path = self.lib.path + path[len(prefix):]
+            else:
+                continue
+            yield path.replace('/', os.sep)
+
+    def exportTree(self, root: str) -> Iterator[str]:
+        # 导出并解析root的目录树，返回使用/分隔的路径
+        client = GetClient(self.oo5Account)
+        try:
+            it = tool.export_dir_parse_iter(client=client, export_file_ids=root, target_pid=root, parse_iter=tool.parse_export_dir_as_dict_iter, 
                                 delete=True, async_=False, show_clock=True)
             i = 0
-            path_index = {}
-            src_tree_list = []
+            # 导出的目录树是深度优先的顺序，只需要保留当前项目的上级目录链
+            path_index = []
             for item in it:
                 i += 1
-                parent = path_index.get(item['parent_key'])
-                if parent is None:
-                    item['path'] = ''
+                while len(path_index) > 0 and path_index[-1][0] != item['parent_key']:
+                    path_index.pop()
+                if len(path_index) == 0:
+                    path = ''
                 else:
-                    if i == 2 and self.lib.path.endswith(item['name']):
-                        item['path'] = self.lib.path
+                    if i == 2 and root.endswith(item['name']):
+                        path = root
                     else:
-                        item['path'] = "{0}/{1}".format(parent['path'], item['name'])
-                path_index[item['key']] = item
-                if item['path'] != '':
-                    src_tree_list.append(item['path'].replace('/', os.sep))
-            return src_tree_list
+                        path = "{0}/{1}".format(path_index[-1][1], item['name'])
+                path_index.append((item['key'], path))
+                if path != '':
+                    yield path
+            if self.oo5Account.status != 0:
+                o5List.setStatus(self.oo5Account.key, 0, self.oo5Account.cookie)
         except Exception as e:
             self.logger.error('生成目录树出错: %s' % e)
+            if not CheckClient(self.oo5Account, client):
+                self.logger.error('115账号[%s]的cookie已失效，请更新cookie' % self.oo5Account.name)
             raise e
 
-    def get_dest_tree_list(self, base_dir: str, root_dir: str, dest_tree_list: list):
-        # 使用 Path 对象处理路径
-        base_dir = Path(base_dir).resolve()
-        root_dir = Path(root_dir).resolve()
-        
-        if not root_dir.exists():
-            print("root_dir not exists")
-            return dest_tree_list
-        
-        for item in root_dir.iterdir():
-            relative_path = str(item.relative_to(base_dir))
-            dest_tree_list.append(relative_path)
-            
-            if item.is_dir():
-                self.get_dest_tree_list(base_dir, item, dest_tree_list)
-                
-        return dest_tree_list
-
-    def strm(self, path: str):
-        try:
-            path = path.replace('/', os.sep)
-            dirname = os.path.dirname(path)
-            real_dirname = os.path.join(self.lib.strm_root_path, dirname)
-            if not os.path.exists(real_dirname):
-                os.makedirs(real_dirname)
-            filename, ext = os.path.splitext(path)
-            # 生成STRM文件
-            strm_file = filename + '.strm'
-            strm_real_file = os.path.join(self.lib.strm_root_path, strm_file)
-            if os.path.exists(strm_real_file):
-                # 如果已存在，则不处理
-                return
-            strm_content = ''
-            if self.lib.type == '本地路径':
-                if self.lib.cloud_type == '115':
-                    strm_content = os.path.join(self.lib.path_of_115, path)
-                else:
-                    strm_content = os.path.join(self.lib.path, path)
-            else:
-                path = path.replace(os.sep, '/')
-                if self.lib.mount_path != '':
-                    path = path.lstrip(self.lib.mount_path)
-                    print("path replace mount: {0}".format(path))
-                    if path.startswith('/'):
-                        path.lstrip('/')
-                pathList = path.split('/')
-                newPath = []
-                for p in pathList:
-                    newPath.append(urllib.parse.quote(p))
-                if self.lib.type == 'WebDAV':
-                    url = self.lib.webdav_url
-                    if not url.startswith('http'):
-                        url = "http://{0}".format(url)
-                    url = self.lib.webdav_url.replace('//', '//{0}:{1}@'.format(self.lib.webdav_username, self.lib.webdav_password))
-                    if url.endswith('/'):
-                        url = url.rstrip('/')
-                    strm_content = '{0}/{1}'.format(url, '/'.join(newPath))
-                else:
-                    url = self.lib.alist_server
-                    if url.endswith('/'):
-                        url = url.rstrip('/')
-                    alist_115_path = self.lib.alist_115_path.strip('/')
-                    strm_content = '{0}/d/{1}/{2}'.format(url, alist_115_path, '/'.join(newPath))
-            with open(strm_real_file, 'w', encoding='utf-8') as f:
-                f.write(strm_content)
-            return ''
-        except OSError as e:
-            return e
-        
-def StartJob(key: str, logStream: bool = False):
-    job = Job(key, logStream)
+    def iter_dest_tree(self, base_dir: str, root_dir: str) -> Iterator[str]:
+        # 返回root_dir下全部文件和目录相对于base_dir的路径，网络或FUSE挂载会并发遍历
+        if not os.path.exists(root_dir):
+            self.logger.info('目录不存在，跳过遍历：%s' % root_dir)
+            return iter([])
+        return walkTree(base_dir, root_dir)
+
+
+def StartJob(key: str, logStream: bool = False, full: bool = False, dry_run: bool = False):
+    job = Job(key, logStream, full)
+    if dry_run:
+        # 只输出计划，不更新同步状态和进度，也不发送通知
+        job.dry_run = True
+        job.progress.enabled = False
+        job.work()
+        return
     signal.signal(signal.SIGINT, job.stop)
     signal.signal(signal.SIGTERM, job.stop)
     job.start()
@@ -375,9 +602,11 @@ if __name__ == '__main__':
     key: str = ''
     parser = argparse.ArgumentParser(prog='115-STRM', description='将挂载的115网盘目录生成STRM', formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument('-k', '--key', help='要处理的同步目录')
+    parser.add_argument('-f', '--full', action='store_true', help='忽略目录树快照，执行全量同步')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='只输出要生成和删除的文件，不做任何修改')
     args, unknown = parser.parse_known_args()
     if args.key != None:
         key = args.key
     if key == '':
         sys.exit(0)
-    StartJob(key, True)
+    StartJob(key, True, args.full, args.dry_run)
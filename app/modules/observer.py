@@ -0,0 +1,359 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import logging
+import os
+import threading
+from watchdog.events import (
+    DirCreatedEvent, DirDeletedEvent, DirMovedEvent,
+    FileCreatedEvent, FileDeletedEvent, FileModifiedEvent, FileMovedEvent,
+    FileSystemEvent, FileSystemEventHandler,
+)
+from watchdog.observers import Observer
+from watchdog.observers.api import ObservedWatch
+
+from app.utils.fs import WALK_WORKERS, isRemoteMount
+
+# 监控方式：auto-本地文件系统用inotify，网络或FUSE挂载用轮询 | inotify | poll
+WATCH_MODE = os.getenv('WATCH_MODE', 'auto')
+# 轮询间隔秒数，同时也是挂载健康检查的间隔
+WATCH_POLL_INTERVAL = float(os.getenv('WATCH_POLL_INTERVAL', '10'))
+# 检查挂载时等待的最长秒数，FUSE挂载失效时stat可能一直卡住
+MOUNT_TIMEOUT = float(os.getenv('MOUNT_TIMEOUT', '5'))
+
+logger = logging.getLogger('watch')
+
+
+class MountError(Exception):
+    # 挂载不可用，本轮轮询的结果不可信
+    pass
+
+
+class DirState:
+    # 目录上一次列出时的状态，entries: 名称 => (是否目录, inode)
+    __slots__ = ('mtime', 'entries')
+
+    def __init__(self, mtime: float, entries: dict[str, tuple[bool, int]]):
+        self.mtime = mtime
+        self.entries = entries
+
+
+def listEntries(path: str) -> tuple[float, dict[str, tuple[bool, int]]]:
+    # 列出目录，DirEntry自带类型和inode，不需要逐个stat
+    st = os.stat(path)
+    entries = {}
+    with os.scandir(path) as it:
+        for entry in it:
+            entries[entry.name] = (entry.is_dir(), entry.inode())
+    return st.st_mtime, entries
+
+
+def statDir(path: str) -> float | None:
+    try:
+        return os.stat(path).st_mtime
+    except (FileNotFoundError, NotADirectoryError):
+        # 目录已删除，由上级目录的变化处理
+        return None
+    except OSError as e:
+        raise MountError(str(e))
+
+
+class IncrementalPoller:
+    """
+    增量轮询一个目录树
+
+    缓存每个目录上一次的列表，每轮只stat目录，只有mtime变化的目录才重新列出并和缓存比较，
+    文件数量再多，每轮的开销也只和目录数以及变化量有关。
+    同一轮中消失和出现的inode相同时合并为移动事件，事件交给handler.dispatch，和inotify一致
+    """
+    handler: FileSystemEventHandler
+    root: str
+    dirs: dict[str, DirState] # 绝对路径 => 目录状态
+    ready: bool
+
+    def __init__(self, handler: FileSystemEventHandler, root: str):
+        self.handler = handler
+        self.root = root
+        self.dirs = {}
+        self.ready = False
+
+    def scan(self, path: str) -> list[str]:
+        # 非递归列出整个子树并缓存，返回其中全部子项的路径（父目录在前）
+        items = []
+        stack = [path]
+        while len(stack) > 0:
+            real_dir = stack.pop()
+            try:
+                mtime, entries = listEntries(real_dir)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            except OSError as e:
+                raise MountError(str(e))
+            self.dirs[real_dir] = DirState(mtime, entries)
+            for name, (is_dir, _) in entries.items():
+                sub = os.path.join(real_dir, name)
+                items.append(sub)
+                if is_dir:
+                    stack.append(sub)
+        return items
+
+    def init(self):
+        self.dirs = {}
+        self.scan(self.root)
+        self.ready = True
+        logger.info('轮询监控已建立缓存：{0}，共 {1} 个目录'.format(self.root, len(self.dirs)))
+
+    def dropTree(self, path: str):
+        prefix = path + os.sep
+        for d in [d for d in self.dirs if d == path or d.startswith(prefix)]:
+            del self.dirs[d]
+
+    def moveTree(self, src: str, dest: str):
+        prefix = src + os.sep
+        for d in [d for d in self.dirs if d == src or d.startswith(prefix)]:
+            self.dirs[dest + d[len(src):]] = self.dirs.pop(d)
+
+    def poll(self, executor: ThreadPoolExecutor) -> int:
+        # 执行一轮轮询，返回事件数量；挂载不可用时抛出MountError，缓存保持不变
+        if not self.ready:
+            self.init()
+            return 0
+        paths = list(self.dirs.keys())
+        mtimes = list(executor.map(statDir, paths))
+        changed = sorted(p for p, m in zip(paths, mtimes) if m is not None and m != self.dirs[p].mtime)
+        if len(changed) == 0:
+            return 0
+        # 先重新列出全部变化的目录，再统一比较，跨目录的移动才能配对
+        listed: dict[str, tuple[float, dict[str, tuple[bool, int]]]] = {}
+        for path in changed:
+            try:
+                listed[path] = listEntries(path)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            except OSError as e:
+                raise MountError(str(e))
+        removed: dict[str, tuple[bool, int]] = {}
+        added: dict[str, tuple[bool, int]] = {}
+        modified: list[str] = []
+        for path, (mtime, entries) in listed.items():
+            old = self.dirs[path].entries
+            for name, info in old.items():
+                if name not in entries:
+                    removed[os.path.join(path, name)] = info
+            for name, info in entries.items():
+                prev = old.get(name)
+                if prev is None:
+                    added[os.path.join(path, name)] = info
+                elif prev[0] != info[0]:
+                    # 同名的文件和目录互相替换
+                    removed[os.path.join(path, name)] = prev
+                    added[os.path.join(path, name)] = info
+                elif not info[0] and info[1] != 0 and prev[1] != info[1]:
+                    # 文件被替换（上传通常是写临时文件再改名）
+                    modified.append(os.path.join(path, name))
+            self.dirs[path] = DirState(mtime, entries)
+        # 按inode配对移动
+        inodes = {(info[0], info[1]): path for path, info in removed.items() if info[1] != 0}
+        moves: list[tuple[str, str, bool]] = []
+        for path, info in list(added.items()):
+            src = inodes.pop((info[0], info[1]), None)
+            if src is None:
+                continue
+            del removed[src]
+            del added[path]
+            moves.append((src, path, info[0]))
+        events: list[FileSystemEvent] = []
+        for src, dest, is_dir in moves:
+            if is_dir:
+                self.moveTree(src, dest)
+                events.append(DirMovedEvent(src, dest))
+            else:
+                events.append(FileMovedEvent(src, dest))
+        for path in sorted(removed):
+            if removed[path][0]:
+                self.dropTree(path)
+                events.append(DirDeletedEvent(path))
+            else:
+                events.append(FileDeletedEvent(path))
+        for path in sorted(added):
+            if added[path][0]:
+                events.append(DirCreatedEvent(path))
+                for sub in self.scan(path):
+                    events.append(DirCreatedEvent(sub) if sub in self.dirs else FileCreatedEvent(sub))
+            else:
+                events.append(FileCreatedEvent(path))
+        for path in modified:
+            events.append(FileModifiedEvent(path))
+        for event in events:
+            self.handler.dispatch(event)
+        return len(events)
+
+
+class WatchItem:
+    # 一个被监控的目录，作为schedule的返回值
+    handler: FileSystemEventHandler
+    path: str
+    mode: str # inotify | poll
+    watch: ObservedWatch | None # inotify模式下的watchdog监控
+    poller: IncrementalPoller | None # 轮询模式下的轮询器
+    healthy: bool
+
+    def __init__(self, handler: FileSystemEventHandler, path: str, mode: str):
+        self.handler = handler
+        self.path = path
+        self.mode = mode
+        self.watch = None
+        self.poller = IncrementalPoller(handler, path) if mode == 'poll' else None
+        self.healthy = True
+
+
+class HybridObserver:
+    """
+    根据挂载类型选择监控方式的observer，接口和watchdog的Observer一致
+
+    CD2、rclone等FUSE挂载上，云端的变化不会产生inotify事件，这类目录改为增量轮询。
+    后台线程定期检查每个目录所在的挂载，挂载失效时暂停监控（不会把挂载丢失误判为文件删除），
+    恢复后inotify重新注册，轮询从缓存继续比较，期间的变化在下一轮补上
+    """
+    mode: str
+    interval: float
+    observer: Observer
+    items: dict[int, WatchItem]
+    lock: threading.Lock
+    stopped: threading.Event
+    thread: threading.Thread | None
+    executor: ThreadPoolExecutor # 并发stat目录
+    checker: ThreadPoolExecutor # 带超时的挂载检查
+
+    def __init__(self, mode: str = WATCH_MODE, interval: float = WATCH_POLL_INTERVAL):
+        self.mode = mode
+        self.interval = max(1, interval)
+        self.observer = Observer()
+        self.items = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.executor = ThreadPoolExecutor(max_workers=WALK_WORKERS, thread_name_prefix='poll')
+        self.checker = ThreadPoolExecutor(max_workers=2, thread_name_prefix='mount')
+
+    def chooseMode(self, path: str) -> str:
+        if self.mode in ('inotify', 'poll'):
+            return self.mode
+        return 'poll' if isRemoteMount(path) else 'inotify'
+
+    def schedule(self, handler: FileSystemEventHandler, path: str, recursive: bool = True) -> WatchItem:
+        if not os.path.isdir(path):
+            raise ValueError('{0}不存在'.format(path))
+        item = WatchItem(handler, path, self.chooseMode(path))
+        if item.mode == 'inotify':
+            item.watch = self.observer.schedule(handler, path, recursive=recursive)
+        with self.lock:
+            self.items[id(item)] = item
+        logger.info('监控目录：{0}，方式：{1}'.format(path, item.mode))
+        return item
+
+    def unschedule(self, item: WatchItem):
+        with self.lock:
+            self.items.pop(id(item), None)
+        if item.watch is not None:
+            try:
+                self.observer.unschedule(item.watch)
+            except KeyError:
+                pass
+            item.watch = None
+
+    def unschedule_all(self):
+        with self.lock:
+            items = list(self.items.values())
+        for item in items:
+            self.unschedule(item)
+
+    def start(self):
+        self.observer.start()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.loop, name='watch-poll', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.observer.stop()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def checkMount(self, path: str) -> bool:
+        future = self.checker.submit(os.path.isdir, path)
+        try:
+            return future.result(timeout=MOUNT_TIMEOUT)
+        except TimeoutError:
+            return False
+
+    def loop(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                items = list(self.items.values())
+            for item in items:
+                if self.stopped.is_set():
+                    return
+                try:
+                    self.check(item)
+                except Exception as e:
+                    logger.error('监控目录检查失败 {0} : {1}'.format(item.path, e))
+
+    def check(self, item: WatchItem):
+        healthy = self.checkMount(item.path)
+        if healthy and item.poller is not None:
+            try:
+                c = item.poller.poll(self.executor)
+                if c > 0:
+                    logger.info('轮询发现 {0} 个变化：{1}'.format(c, item.path))
+            except MountError as e:
+                logger.warning('轮询失败，挂载可能已失效 {0} : {1}'.format(item.path, e))
+                healthy = False
+        if healthy == item.healthy:
+            return
+        item.healthy = healthy
+        if not healthy:
+            logger.warning('挂载失效，暂停监控：{0}'.format(item.path))
+            if item.watch is not None:
+                try:
+                    self.observer.unschedule(item.watch)
+                except KeyError:
+                    pass
+                item.watch = None
+            return
+        logger.info('挂载已恢复，继续监控：{0}'.format(item.path))
+        if item.mode == 'inotify' and id(item) in self.items:
+            logger.warning('挂载失效期间的变化没有inotify事件，如有需要请手动同步：{0}'.format(item.path))
+            item.watch = self.observer.schedule(item.handler, item.path, recursive=True)
+
+
+class ConfigFileHandler(FileSystemEventHandler):
+    """
+    配置文件变化时设置changed，配置文件通过临时文件+重命名写入，所以也要检查移动事件的目标路径
+    """
+    file: str
+    changed: threading.Event
+
+    def __init__(self, file: str, changed: threading.Event):
+        super().__init__()
+        self.file = file
+        self.changed = changed
+
+    def on_any_event(self, event: FileSystemEvent):
+        if event.src_path == self.file or event.dest_path == self.file:
+            self.changed.set()
+
+
+def WatchConfigFile(file: str, changed: threading.Event) -> Observer:
+    """
+    监控一个配置文件，变化时设置changed，代替定时重新读取
+    :param file: 配置文件的绝对路径
+    :param changed: 配置变化时设置的事件
+    :return: 已启动的observer，退出时调用stop
+    """
+    configDir = os.path.dirname(file)
+    if not os.path.exists(configDir):
+        os.makedirs(configDir, exist_ok=True)
+    configOb = Observer()
+    configOb.schedule(ConfigFileHandler(file, changed), configDir, recursive=False)
+    configOb.start()
+    return configOb
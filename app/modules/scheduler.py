@@ -0,0 +1,258 @@
+from collections import deque
+import multiprocessing
+from multiprocessing.connection import Connection
+from multiprocessing.process import BaseProcess
+import os
+import signal
+import threading
+import psutil
+
+from app.core.lib import Lib, Libs
+from app.core.notify import Notify, SetNotifySink
+from app.modules.job import StartJob
+from app.utils.log import getLogger
+
+# 每个调度器同时运行的同步任务数量，也是常驻同步进程的数量
+# API、定时任务和命令行各有自己的调度器，这是每个进程的限制，不是全局的
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '3'))
+# 每个调度器中每个115账号同时运行的同步任务数量，同一个cookie并发导出目录树容易触发风控，同样是每个进程的限制
+JOB_ACCOUNT_LIMIT = int(os.getenv('JOB_ACCOUNT_LIMIT', '1'))
+
+logger = getLogger(name='scheduler', rotating=True, stream=True)
+# 同步进程使用spawn启动：调度器在API的线程池中创建进程，fork时其他线程可能正持有配置文件的锁，
+# 子进程继承一个永远不会释放的锁，第一次读取配置就会卡住
+_mpContext = multiprocessing.get_context('spawn')
+
+
+def workerMain(conn: Connection):
+    # 常驻同步进程的主循环，依次执行调度器发来的任务，已经导入的模块和115客户端在任务之间复用
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # 通知转发给调度器所在的进程统一发送，多个同步进程的完成通知才能合并成一条
+    SetNotifySink(lambda msg, digest: conn.send(('notify', msg, digest)))
+    while True:
+        try:
+            key, full, logStream = conn.recv()
+        except EOFError:
+            # 调度器已经退出
+            return
+        ok = True
+        try:
+            StartJob(key=key, logStream=logStream, full=full)
+        except Exception as e:
+            logger.error('同步目录[{0}]执行失败: {1}'.format(key, e))
+            ok = False
+        finally:
+            # Job在运行期间注册的信号处理不能留给下一个任务
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+        conn.send(('done', key, ok))
+
+
+class JobWorker:
+    """
+    常驻的同步任务进程，同一时间只运行一个任务
+    任务运行时Job把该进程的pid写入LibExtra.pid，停止同步时直接结束该进程，调度器会补充新的进程
+    """
+    process: BaseProcess
+    conn: Connection
+    key: str | None # 正在运行的同步目录
+    account: str | None # 正在运行的任务使用的115账号
+
+    def __init__(self):
+        self.conn, child = _mpContext.Pipe()
+        self.process = _mpContext.Process(target=workerMain, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+        self.key = None
+        self.account = None
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    def run(self, key: str, account: str | None, full: bool, logStream: bool = False):
+        self.key = key
+        self.account = account
+        self.conn.send((key, full, logStream))
+
+    def close(self):
+        self.conn.close()
+        self.process.join(timeout=5)
+
+
+class JobScheduler:
+    """
+    同步任务调度器
+
+    任务进入队列后按顺序交给常驻的同步进程执行，同时运行的任务不超过max_workers个，
+    同一个115账号的任务不超过account_limit个，本地路径(other)的任务只受总数限制。
+    API、定时任务和命令行各有一个调度器，这两个限制只在本进程内生效；其他进程正在同步的目录通过运行状态拒绝重复提交。
+    同步进程用spawn启动，在第一次提交任务时一次性创建，之后一直复用，不再为每个任务创建一次。
+    队列中的任务状态为4-排队中，启动后由Job更新为2-运行中，结束后为1-正常或3-中断
+    """
+    libs: Libs
+    max_workers: int
+    account_limit: int
+    queue: deque[tuple[str, bool, bool]] # (同步目录key, 是否全量同步, 是否把日志输出到终端)
+    workers: list[JobWorker]
+    idle: list[JobWorker]
+    running: dict[str, JobWorker]
+    accounts: dict[str, int] # 115账号 => 运行中的任务数量
+    lock: threading.Condition
+
+    def __init__(self, max_workers: int = JOB_WORKERS, account_limit: int = JOB_ACCOUNT_LIMIT, libs: Libs | None = None):
+        self.libs = libs if libs is not None else Libs()
+        self.max_workers = max(1, max_workers)
+        self.account_limit = max(1, account_limit)
+        self.queue = deque()
+        self.workers = []
+        self.idle = []
+        self.running = {}
+        self.accounts = {}
+        self.lock = threading.Condition()
+
+    def getAccount(self, lib: Lib) -> str | None:
+        if lib.cloud_type == '115':
+            return lib.id_of_115
+        return None
+
+    def startWorkers(self):
+        # 必须在持有lock时调用，补足常驻同步进程
+        while len(self.workers) < self.max_workers:
+            worker = JobWorker()
+            self.workers.append(worker)
+            self.idle.append(worker)
+            t = threading.Thread(target=self.waitWorker, args=(worker,), daemon=True)
+            t.start()
+            logger.info('启动同步进程：%d' % worker.pid)
+
+    def submit(self, key: str, full: bool = False, logStream: bool = False) -> tuple[bool, str]:
+        """
+        把同步目录加入队列
+        :param key: 同步目录key
+        :param full: 是否全量同步
+        :param logStream: 同步日志是否同时输出到终端（命令行执行时使用，同步进程继承调度器的终端）
+        """
+        lib = self.libs.getLib(key)
+        if lib is None:
+            return False, '同步目录不存在'
+        with self.lock:
+            if key in self.running:
+                return False, '该目录正在同步中...'
+            if lib.extra.status == 2 and lib.extra.pid > 0 and psutil.pid_exists(lib.extra.pid):
+                # 其他进程的调度器正在同步该目录，不能把状态改成排队中再执行一次
+                return False, '该目录正在同步中...'
+            for item in self.queue:
+                if item[0] == key:
+                    return False, '该目录已经在队列中'
+            self.queue.append((key, full, logStream))
+            lib.extra.status = 4
+            self.libs.saveExtra(lib)
+            logger.info('同步目录[%s]加入队列，排队中的任务：%d' % (lib.name, len(self.queue)))
+            self.startWorkers()
+            self.dispatch()
+        return True, ''
+
+    def dispatch(self):
+        # 必须在持有lock时调用，把队列中可以运行的任务交给空闲的同步进程
+        if len(self.idle) == 0:
+            return
+        skipped = deque()
+        while len(self.queue) > 0 and len(self.idle) > 0:
+            item = self.queue.popleft()
+            key = item[0]
+            lib = self.libs.getLib(key)
+            if lib is None:
+                logger.warning('同步目录[%s]已删除，移出队列' % key)
+                continue
+            account = self.getAccount(lib)
+            if account is not None and self.accounts.get(account, 0) >= self.account_limit:
+                # 该账号已经有任务在运行，留在队列中
+                skipped.append(item)
+                continue
+            self.start(lib, account, item[1], item[2])
+        skipped.extend(self.queue)
+        self.queue = skipped
+
+    def start(self, lib: Lib, account: str | None, full: bool, logStream: bool):
+        worker = self.idle.pop()
+        worker.run(lib.key, account, full, logStream)
+        self.running[lib.key] = worker
+        if account is not None:
+            self.accounts[account] = self.accounts.get(account, 0) + 1
+        logger.info('启动同步目录[%s]，进程：%d' % (lib.name, worker.pid))
+
+    def waitWorker(self, worker: JobWorker):
+        # 每个同步进程一个线程，等待任务完成或者进程退出
+        while True:
+            try:
+                msg = worker.conn.recv()
+                if msg[0] == 'notify':
+                    Notify(msg[1], msg[2])
+                    continue
+                _, key, ok = msg
+                self.finish(worker, ok, False)
+            except (EOFError, OSError):
+                # 进程退出：停止同步时被结束，或者Job收到信号后退出
+                worker.close()
+                self.finish(worker, False, True)
+                return
+
+    def finish(self, worker: JobWorker, ok: bool, exited: bool):
+        with self.lock:
+            key = worker.key
+            account = worker.account
+            worker.key = None
+            worker.account = None
+            if key is not None:
+                del self.running[key]
+                if account is not None:
+                    self.accounts[account] -= 1
+                    if self.accounts[account] <= 0:
+                        del self.accounts[account]
+                lib = self.libs.getLib(key)
+                if lib is not None and (lib.extra.status == 4 or (exited and lib.extra.pid == worker.pid)):
+                    # 任务没有启动（例如Job初始化失败：同步目录或者115账号已删除），
+                    # 或者进程异常退出，都没有来得及更新状态
+                    lib.extra.status = 3
+                    if lib.extra.pid == worker.pid or not psutil.pid_exists(lib.extra.pid):
+                        lib.extra.pid = 0
+                    self.libs.saveExtra(lib)
+                logger.info('同步目录[%s]结束，%s' % (key, '成功' if ok else '失败'))
+            if exited:
+                logger.warning('同步进程%d已退出，退出码：%s' % (worker.pid, worker.process.exitcode))
+                self.workers.remove(worker)
+                if worker in self.idle:
+                    self.idle.remove(worker)
+                if len(self.queue) > 0:
+                    self.startWorkers()
+            else:
+                self.idle.append(worker)
+            self.dispatch()
+            self.lock.notify_all()
+
+    def wait(self):
+        # 阻塞直到队列中的任务全部完成
+        with self.lock:
+            while len(self.queue) > 0 or len(self.running) > 0:
+                self.lock.wait()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'queued': [item[0] for item in self.queue],
+                'running': {key: worker.pid for key, worker in self.running.items()},
+                'workers': [worker.pid for worker in self.workers],
+                'max_workers': self.max_workers,
+                'account_limit': self.account_limit,
+            }
+
+
+_scheduler: JobScheduler | None = None
+
+
+def GetScheduler() -> JobScheduler:
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = JobScheduler()
+    return _scheduler
@@ -1,42 +1,72 @@
-from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+import json
 import shutil
 import signal
+import threading
 import time
-from typing import Mapping
-from watchdog.observers import Observer
-from watchdog.observers.api import ObservedWatch
 from watchdog.events import *
+from watchdog.observers import Observer
 import os, sys
 
 from app.core.lib import Lib, Libs
+from app.core.meta import MetaManifest, metaStamp
+from app.core.strm import StrmBuilder
+from app.modules.eventqueue import EventQueue, PendingEvent
+from app.modules.observer import HybridObserver, WatchConfigFile, WatchItem
+from app.utils.fs import walkTree
 from app.utils.log import getLogger
 
 LIBS = Libs()
 logger = getLogger(name='watch', rotating=True, stream=True)
-queue = Queue()
-pool: Mapping[str, ObservedWatch] = {}
-ob = Observer()
+pool: dict[str, WatchItem] = {}
+ob = HybridObserver()
+# 有同步目录无法启动监控时，重试的间隔秒数
+WATCH_RETRY_INTERVAL = float(os.getenv('WATCH_RETRY_INTERVAL', '60'))
+
+
+def applyEvent(event: PendingEvent):
+    # 在队列的工作线程中执行合并后的事件
+    handler: FileEventHandler = event.handler
+    if event.event_type == 'created':
+        handler.doCreated(event)
+    elif event.event_type == 'deleted':
+        handler.doDeleted(event)
+    elif event.event_type == 'moved':
+        handler.doMoved(event)
+    elif event.event_type == 'modified':
+        handler.doModified(event)
+
+
+queue = EventQueue(applyEvent)
+
 
 class FileEventHandler(FileSystemEventHandler):
+    """
+    watchdog的回调在observer线程中执行，这里只把事件放入防抖队列，
+    真正的文件操作在队列的工作线程中通过doXxx执行
+    """
 
     lib: Lib
-    taskPool: list[float]
+    strmBuilder: StrmBuilder
 
     def __init__(self, key):
         super().__init__()
         self.lib = LIBS.getLib(key)
         if self.lib is None:
             raise ValueError('同步目录不存在')
-        self.taskPool = []
-    
-    def getStrmPath(self, path):
-        # 返回目标位置路径
+        self.strmBuilder = StrmBuilder(self.lib)
+
+    def getRelPath(self, path):
+        # 返回相对于115挂载目录(或者other类型的同步路径)的路径，和同步任务中的路径一致
         if self.lib.cloud_type == '115':
             newPath: str = path.replace(self.lib.path_of_115, '')
         else:
             newPath: str = path.replace(self.lib.path, '')
-        newPath = newPath.lstrip(os.sep)
-        return os.path.join(self.lib.strm_root_path, newPath)
+        return newPath.lstrip(os.sep)
+    
+    def getStrmPath(self, path):
+        # 返回目标位置路径
+        return os.path.join(self.lib.strm_root_path, self.getRelPath(path))
 
     def getPrePath(self, path: str):
         pathList = path.split(os.sep)
@@ -47,64 +77,118 @@ class FileEventHandler(FileSystemEventHandler):
         pass
 
     def on_moved(self, event):
+        if getattr(event, 'is_synthetic', False):
+            # 目录移动时watchdog为其中每个文件生成的事件，由目录移动统一处理
+            return
+        queue.push(self, 'moved', event.src_path, event.dest_path, event.is_directory)
+
+    def on_created(self, event):
+        queue.push(self, 'created', event.src_path, '', event.is_directory)
+
+    def on_deleted(self, event):
+        queue.push(self, 'deleted', event.src_path, '', event.is_directory)
+
+    def on_modified(self, event):
+        if event.is_directory:
+            # 目录的修改时间变化由其中文件的事件处理
+            return
+        queue.push(self, 'modified', event.src_path, '', event.is_directory)
+
+    def doMoved(self, event: PendingEvent):
         srcStrmPath = self.getStrmPath(event.src_path)
         destStrmPath = self.getStrmPath(event.dest_path)
         if event.is_directory:
-            # preStrmPath = self.getPrePath(destStrmPath)
-            # if not os.path.exists(srcStrmPath):
-            #     logger.error("{0}不存在，无法移动到{1}".format(srcStrmPath, destStrmPath))
-            #     return False
-            # if not os.path.exists(preStrmPath):
-            #     logger.info("{0}不存在，创建该目录".format(preStrmPath))
-            #     os.makedirs(preStrmPath)
-            # if not os.path.exists(destStrmPath):
-            #     shutil.move(srcStrmPath, destStrmPath)
-            #     logger.info("移动：{0} => {1}".format(srcStrmPath, destStrmPath))
-            logger.warning("不处理目录移动，因为需要修改STRM文件内的路径 {0} => {1}".format(srcStrmPath, destStrmPath))
-            pass
+            return self.doMovedDir(event, srcStrmPath, destStrmPath)
         else:
             # 检查是否STRM文件
             filename, ext = os.path.splitext(srcStrmPath)
             destFilename, ext = os.path.splitext(destStrmPath)
             srcStrmFile = srcStrmPath
             destStrmFile = destStrmPath
-            if ext in self.lib.strm_ext:
+            if ext.lower() in self.lib.strm_ext:
                 srcStrmFile = "{0}.strm".format(filename)
                 destStrmFile = "{0}.strm".format(destFilename)
-                if not os.path.exists(srcStrmFile):
-                    logger.error("{0}不存在，无法移动到{1}".format(srcStrmFile, destStrmFile))
-                    return False
+            if not os.path.exists(srcStrmFile):
+                logger.error("{0}不存在，无法移动到{1}".format(srcStrmFile, destStrmFile))
+                return False
             destPath = os.path.dirname(destStrmFile)
             if not os.path.exists(destPath):
-                os.makedirs(destPath)
+                os.makedirs(destPath, exist_ok=True)
                 logger.info("创建目录：{0}".format(destPath))
             shutil.move(srcStrmFile, destStrmFile)
             logger.info("移动：{0} => {1}".format(srcStrmFile, destStrmFile))
         return True
-        # self.taskPool.append(timestamp = time.time())
 
-    def on_created(self, event):
+    def doMovedDir(self, event: PendingEvent, srcStrmPath: str, destStrmPath: str):
+        # 整个STRM目录直接改名，然后重写其中每个STRM文件里的路径
+        if not os.path.exists(srcStrmPath):
+            logger.error("{0}不存在，无法移动到{1}".format(srcStrmPath, destStrmPath))
+            return False
+        if os.path.exists(destStrmPath):
+            logger.error("{0}已存在，无法从{1}移动".format(destStrmPath, srcStrmPath))
+            return False
+        preStrmPath = os.path.dirname(destStrmPath)
+        if not os.path.exists(preStrmPath):
+            os.makedirs(preStrmPath, exist_ok=True)
+            logger.info("创建目录：{0}".format(preStrmPath))
+        shutil.move(srcStrmPath, destStrmPath)
+        logger.info("移动目录：{0} => {1}".format(srcStrmPath, destStrmPath))
+        destRelPath = self.getRelPath(event.dest_path)
+        start = time.time()
+        total = 0
+        changed = 0
+        strmFiles = (rel for rel in walkTree(destStrmPath) if rel.endswith('.strm'))
+        with ThreadPoolExecutor(max_workers=self.lib.strm_workers, thread_name_prefix='strm') as executor:
+            for rs in executor.map(lambda rel: self.rewriteStrm(destStrmPath, destRelPath, rel), strmFiles):
+                total += 1
+                if rs:
+                    changed += 1
+        logger.info("重写目录中的STRM文件：共 {0} 个，修改 {1} 个，耗时 {2:.2f}s".format(total, changed, time.time() - start))
+        return True
+
+    def rewriteStrm(self, destStrmPath: str, destRelPath: str, rel: str) -> bool:
+        # 按移动后的位置重新生成STRM内容，返回是否有修改
+        strmFile = os.path.join(destStrmPath, rel)
+        try:
+            with open(strmFile, mode='r', encoding='utf-8') as f:
+                oldContent = f.read()
+            ext = self.strmBuilder.getExt(oldContent)
+            content = self.strmBuilder.build(os.path.join(destRelPath, rel[:-5] + ext))
+            if content == oldContent:
+                return False
+            with open(strmFile, mode='w', encoding='utf-8') as f:
+                f.write(content)
+            return True
+        except OSError as e:
+            logger.error("重写STRM失败：{0} : {1}".format(strmFile, e))
+            return False
+
+    def doCreated(self, event: PendingEvent):
         srcStrmFile = self.getStrmPath(event.src_path)
         if os.path.exists(srcStrmFile):
             logger.info("已存在：{0}".format(srcStrmFile))
             return False
         if event.is_directory:
             if not os.path.exists(srcStrmFile):
-                os.makedirs(srcStrmFile)
+                os.makedirs(srcStrmFile, exist_ok=True)
                 logger.info("创建目录：{0}".format(srcStrmFile))
         else:
             filename, ext = os.path.splitext(srcStrmFile)
+            ext = ext.lower()
+            # 合并后的事件并发处理，上级目录的事件不一定已经处理
+            os.makedirs(os.path.dirname(srcStrmFile), exist_ok=True)
             if ext in self.lib.strm_ext:
                 strmFile = "{0}.strm".format(filename)
                 # 只处理strm文件
+                strmContent = self.strmBuilder.build(self.getRelPath(event.src_path))
                 with open(strmFile, mode='w', encoding='utf-8') as f:
-                    f.write(event.src_path)
-                logger.info("STRM文件: {0} => {1}".format(strmFile, event.src_path))
+                    f.write(strmContent)
+                logger.info("STRM文件: {0} => {1}".format(strmFile, strmContent))
             if ext in self.lib.meta_ext:
                 # 处理元数据
                 try:
                     if self.lib.copy_meta_file == '复制':
-                        shutil.copy(event.src_path, srcStrmFile)
+                        self.copyMeta(event.src_path, srcStrmFile)
                         logger.info("元数据复制: {0} => {1}".format(event.src_path, srcStrmFile))
                     if self.lib.copy_meta_file == '软链接':
                         os.symlink(event.src_path, srcStrmFile)
@@ -112,7 +196,7 @@ class FileEventHandler(FileSystemEventHandler):
                 except Exception as e:
                     logger.error("元数据失败: {0} => {1} : {2}".format(event.src_path, srcStrmFile, e))
 
-    def on_deleted(self, event):
+    def doDeleted(self, event: PendingEvent):
         srcStrmFile = self.getStrmPath(event.src_path)
         if event.is_directory:
             if not os.path.exists(srcStrmFile):
@@ -121,8 +205,8 @@ class FileEventHandler(FileSystemEventHandler):
             shutil.rmtree(srcStrmFile)
             logger.info("删除目录: {0}".format(srcStrmFile))
         else:
-            filename, ext = os.path.splitext(event.src_path)
-            if ext in self.lib.strm_ext:
+            filename, ext = os.path.splitext(srcStrmFile)
+            if ext.lower() in self.lib.strm_ext:
                 # 尝试删除strm文件
                 strmFile = "{0}.strm".format(filename)
                 if os.path.exists(strmFile):
@@ -134,12 +218,42 @@ class FileEventHandler(FileSystemEventHandler):
                     logger.info("删除其他文件: {0}".format(srcStrmFile))
                 
         return True
-        # self.taskPool.append(timestamp = time.time())
 
-    def on_modified(self, event):
-        pass
+    def doModified(self, event: PendingEvent):
+        # 云端更新了元数据（NFO、海报等），和清单中的记录不一致时重新复制；软链接不需要处理
+        if event.is_directory or self.lib.copy_meta_file != '复制' or self.lib.type == 'WebDAV':
+            return False
+        _, ext = os.path.splitext(event.src_path)
+        if ext.lower() not in self.lib.meta_ext:
+            return False
+        destFile = self.getStrmPath(event.src_path)
+        try:
+            manifest = MetaManifest(self.lib.key)
+            try:
+                record = manifest.get(self.getRelPath(event.src_path))
+            finally:
+                manifest.close()
+            if record == metaStamp(os.stat(event.src_path)) and os.path.exists(destFile):
+                return False
+            self.copyMeta(event.src_path, destFile)
+            logger.info("元数据更新: {0} => {1}".format(event.src_path, destFile))
+        except Exception as e:
+            logger.error("元数据更新失败: {0} => {1} : {2}".format(event.src_path, destFile, e))
+            return False
+        return True
 
-def watch(key: str) -> ObservedWatch | None:
+    def copyMeta(self, srcFile: str, destFile: str):
+        # 复制元数据并记录到清单中，和同步任务使用同一个清单
+        st = os.stat(srcFile)
+        os.makedirs(os.path.dirname(destFile), exist_ok=True)
+        shutil.copy2(srcFile, destFile)
+        manifest = MetaManifest(self.lib.key)
+        try:
+            manifest.save({self.getRelPath(srcFile): metaStamp(st)})
+        finally:
+            manifest.close()
+
+def watch(key: str) -> WatchItem | None:
     try:
         eventHandler = FileEventHandler(key)
         if eventHandler.lib.cloud_type == '115':
@@ -151,88 +265,80 @@ def watch(key: str) -> ObservedWatch | None:
         logger.info('同步目录[{0}]无法启动监控任务\n {1}'.format(key, e))
         return None
 
+def libFingerprint(lib: Lib) -> str:
+    # 同步目录的配置，变化后需要用新的配置重新启动监控
+    jsonLib = lib.getJson()
+    del jsonLib['extra']
+    return json.dumps(jsonLib, sort_keys=True, default=str)
+
+
+def syncWatches(fingerprints: dict[str, str]) -> bool:
+    """
+    对比配置和正在运行的监控任务，只启动、停止或重启有变化的同步目录
+    :param fingerprints: 正在运行的监控任务使用的配置
+    :return: 是否全部监控任务都已启动（没有的话需要稍后重试）
+    """
+    libs = {lib.key: lib for lib in LIBS.list() if lib.sync_type == '监控变更'}
+    for key in list(pool.keys()):
+        lib = libs.get(key)
+        if lib is not None and fingerprints.get(key) == libFingerprint(lib):
+            continue
+        try:
+            ob.unschedule(pool[key])
+        except Exception as e:
+            logger.error("监控任务停止失败 [{0}] : {1}".format(key, e))
+        del pool[key]
+        fingerprints.pop(key, None)
+        if lib is None:
+            logger.info('同步目录[%s]已删除或不再监控，终止监控任务' % key)
+        else:
+            logger.info('同步目录[%s]的配置已变更，重新启动监控任务' % lib.path)
+    allStarted = True
+    for key, lib in libs.items():
+        if key in pool:
+            continue
+        watchObj = watch(key)
+        if watchObj is None:
+            allStarted = False
+            continue
+        pool[key] = watchObj
+        fingerprints[key] = libFingerprint(lib)
+        logger.info('新增同步目录[%s]监控任务' % lib.path)
+    return allStarted
+
+
 def StartWatch():
     global pool
     global ob
+    changed = threading.Event()
+    configOb: Observer | None = None
+
     def stop(sig, frame):
+        if configOb is not None:
+            configOb.stop()
         ob.unschedule_all()
         ob.stop()
+        queue.stop()
         sys.exit(0)
 
     signal.signal(signal.SIGINT, stop)
     signal.signal(signal.SIGTERM, stop)
-    # 启动一个队列处理线程
-    # fst = Thread(target=doFailedQueue)
-    # fst.start()
-    # logger.info('失败重试服务已启动')
-    path_of_115 = ''
-    isStart = False
-    while(True):
-        libs = LIBS.list()
-        if len(libs) == 0:
-            logger.info('没有需要监控的目录，等待10s')
-            time.sleep(10)
-            continue
-        # logger.info("开始检测115挂载是否失效")
-        # if path_of_115 != "":
-        #     if not os.path.exists(path_of_115):
-        #         # 挂载丢失，停止全部线程，等待重试
-        #         logger.warning('115挂载丢失，将结束全部监控线程，等待30s重试')
-        #         ob.unschedule_all()
-        #         ob.stop()
-        #         isStart = False
-        #         pool = {}
-        #         time.sleep(60)
-        #     else:
-        #         logger.info('115挂载正常')
-        
-        # 开始处理同步目录
-        for item in libs:
-            # if item.cloud_type == '115' and item.type == '本地路径' and path_of_115 == '':
-            #     path_of_115 = os.path.join(item.path_of_115, item.path)
-            #     logger.info("检测挂载路径是否失效的路径：%s" % path_of_115)
-            # 检查是否存在进程
-            try:
-                p = pool.get(item.key)
-                if item.sync_type != '监控变更' and p is not None:
-                    # 结束进程
-                    logger.info('同步目录[%s]的同步方式变更为非监控，终止监控任务' % item.path)
-                    ob.unschedule(p)
-                    del pool[item.key]
-                    continue
-                if item.sync_type == '监控变更' and p is None:
-                    # 启动新的子进程
-                    watchObj = watch(item.key)
-                    if watchObj is not None:
-                        pool[item.key] = watchObj
-                        logger.info('新增同步目录[%s]监控任务' % item.path)
-                    continue
-            except Exception as e:
-                logger.error("同步目录处理失败 [{0}] : {1}".format(item.path, e))
-                continue
-        # 开始查找已经删除的任务
-        for key in pool:
-            item = LIBS.getLib(key)
-            if item is not None:
-                continue
-            # 同步目录已删除，终止任务
-            try:
-                watchObj = pool.get(key)
-                ob.unschedule(watchObj)
-            except Exception as e:
-                logger.error("监控任务停止失败 [{0}] : {1}".format(item.path, e))
-            del pool[key]
-            logger.info('同步目录[%s]已删除，终止监控任务' % item.path)
+    # 启动事件队列的处理线程
+    queue.start()
+    # 配置目录的变化由inotify通知，不再定时重新读取libs.json
+    configOb = WatchConfigFile(LIBS.libs_file, changed)
+    ob.start()
+    logger.info("监控服务已启动，等待同步目录配置变化")
+    fingerprints: dict[str, str] = {}
+    while True:
+        changed.clear()
         try:
-            if isStart is False:
-                ob.start()
-                isStart = True
-                logger.info("已启动全部监控任务")
-            #logger.info('已启动所有监控任务，开始10s一次检测任务执行状态')
-            time.sleep(10)
+            allStarted = syncWatches(fingerprints)
         except Exception as e:
-            logger.error("监控任务停止: {1}".format(e))
-            break
+            logger.error("处理同步目录配置失败: {0}".format(e))
+            allStarted = False
+        # 全部启动后一直等待配置变化；有启动失败的（例如挂载还没准备好）稍后重试
+        changed.wait(None if allStarted else WATCH_RETRY_INTERVAL)
 
 if __name__ == '__main__':
     StartWatch()
\ No newline at end of file
@@ -1,5 +1,6 @@
 import argparse
 import json
+import multiprocessing
 import os
 import sys
 
@@ -9,6 +10,7 @@ if not os.path.exists('../../data/config'):
     os.makedirs('../../data/config')
 
 from app.modules.job import StartJob
+from app.modules.scheduler import GetScheduler
 from app.core.lib import OO5, Lib, Libs, OO5List
 from rich import print as rprint
 from rich.prompt import Prompt, Confirm, FloatPrompt
@@ -35,14 +37,23 @@ def listLib():
     console = Console()
     console.print(table)
 
-def run(key: str | None = None):
+def run(key: str | None = None, full: bool = False, dry_run: bool = False):
     if key != None:
-        StartJob(key, logStream=True)
+        StartJob(key, logStream=True, full=full, dry_run=dry_run)
         return
-    # 循环执行所有目录
+    if dry_run:
+        # 只输出计划，依次执行即可
+        for lib in LIBS.list():
+            StartJob(lib.key, logStream=True, full=full, dry_run=True)
+        return
+    # 所有目录交给调度器并发执行，同一个115账号的目录依次执行
+    scheduler = GetScheduler()
     libs = LIBS.list()
     for lib in libs:
-        StartJob(lib.key, logStream=True)
+        rs, msg = scheduler.submit(lib.key, full, logStream=True)
+        if not rs:
+            rprint("[bold red]{0}[/]: {1}".format(lib.name, msg))
+    scheduler.wait()
 
 def add115():
     # 添加115账号
@@ -205,11 +216,15 @@ def create():
     
     
 if __name__ == '__main__':
+    # 打包后的程序中，spawn启动的同步进程要在这里转去执行同步进程的代码，不能再解析命令行
+    multiprocessing.freeze_support()
     action: str | None = None
     key: str | None = None
     parser = argparse.ArgumentParser(prog='115-STRM', description='将挂载的115网盘目录生成STRM', formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument('action', help='要执行的操作\nlist 列出所有已添加的同步目录\nadd115 添加115账号的cookie \ncreate 添加同步目录\nrun 执行同步任务')
     parser.add_argument('-k', '--key', help='要处理的同步目录')
+    parser.add_argument('-f', '--full', action='store_true', help='忽略目录树快照，执行全量同步')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='只输出要生成和删除的文件，不做任何修改')
     args, unknown = parser.parse_known_args()
     if args.action != None:
         action = args.action
@@ -222,6 +237,6 @@ if __name__ == '__main__':
     if action == 'create':
         create()
     if action == 'run':
-        run(key)
+        run(key, args.full, args.dry_run)
     if action == 'add115':
         add115()
\ No newline at end of file
@@ -0,0 +1,155 @@
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import os
+import threading
+import time
+from typing import Iterator
+
+import psutil
+
+# 网络文件系统和FUSE挂载（CD2、rclone、alist等）的类型前缀
+REMOTE_FSTYPES = ('nfs', 'cifs', 'smb', 'fuse', '9p', 'sshfs', 'davfs', 'afpfs', 'ceph', 'glusterfs')
+WALK_WORKERS = int(os.getenv('WALK_WORKERS', '8'))
+# 目录浏览缓存的有效时间，秒，有效期内目录的修改时间没有变化就直接使用缓存
+DIR_CACHE_TTL = float(os.getenv('DIR_CACHE_TTL', '30'))
+# 目录浏览最多缓存的目录数
+DIR_CACHE_SIZE = int(os.getenv('DIR_CACHE_SIZE', '256'))
+
+
+def getMountType(path: str) -> str:
+    """
+    获取路径所在挂载点的文件系统类型
+    :param path: 路径
+    :return: 文件系统类型，找不到返回空字符串
+    """
+    path = os.path.realpath(path)
+    fstype = ''
+    longest = -1
+    try:
+        partitions = psutil.disk_partitions(all=True)
+    except Exception:
+        return ''
+    for part in partitions:
+        mountpoint = part.mountpoint
+        if path != mountpoint and not path.startswith(mountpoint.rstrip(os.sep) + os.sep):
+            continue
+        if len(mountpoint) > longest:
+            longest = len(mountpoint)
+            fstype = part.fstype
+            if 'remote' in part.opts.split(','):
+                # windows的网络驱动器
+                fstype = 'smb'
+    return fstype.lower()
+
+
+def isRemoteMount(path: str) -> bool:
+    """
+    检查路径是否在网络文件系统或者FUSE挂载上
+    :param path: 路径
+    :return: 是否远程挂载
+    """
+    return getMountType(path).startswith(REMOTE_FSTYPES)
+
+
+def listDir(real_dir: str, rel_dir: str) -> tuple[list[str], list[tuple[str, str]]]:
+    # 列出一个目录，返回：全部子项的相对路径，子目录的(绝对路径, 相对路径)
+    items = []
+    subdirs = []
+    try:
+        with os.scandir(real_dir) as it:
+            for entry in it:
+                rel = entry.name if rel_dir == '' else rel_dir + os.sep + entry.name
+                items.append(rel)
+                # DirEntry在大多数系统上直接带有类型信息，不需要再stat
+                if entry.is_dir():
+                    subdirs.append((entry.path, rel))
+    except FileNotFoundError:
+        # 遍历过程中目录被删除
+        pass
+    return items, subdirs
+
+
+def walkTree(base_dir: str, root_dir: str | None = None, workers: int | None = None) -> Iterator[str]:
+    """
+    非递归遍历目录树，返回相对于base_dir的路径字符串（父目录一定先于子项返回）
+    :param base_dir: 计算相对路径的基准目录
+    :param root_dir: 开始遍历的目录，必须在base_dir内，默认等于base_dir
+    :param workers: 并发遍历的线程数，默认只有网络或FUSE挂载才并发
+    """
+    base_dir = os.path.realpath(base_dir)
+    root_dir = base_dir if root_dir is None else os.path.realpath(root_dir)
+    if not os.path.isdir(root_dir):
+        return
+    root_rel = os.path.relpath(root_dir, base_dir)
+    if root_rel == '.':
+        root_rel = ''
+    if workers is None:
+        workers = WALK_WORKERS if isRemoteMount(root_dir) else 1
+    if workers <= 1:
+        stack = [(root_dir, root_rel)]
+        while len(stack) > 0:
+            real_dir, rel_dir = stack.pop()
+            items, subdirs = listDir(real_dir, rel_dir)
+            yield from items
+            stack.extend(reversed(subdirs))
+        return
+    # 网络挂载上每次列目录都有延迟，多个子目录同时列出
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='walk') as executor:
+        pending = {executor.submit(listDir, root_dir, root_rel)}
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                items, subdirs = future.result()
+                yield from items
+                for real_dir, rel_dir in subdirs:
+                    pending.add(executor.submit(listDir, real_dir, rel_dir))
+
+
+def listSubDirs(path: str) -> list[str]:
+    # 列出目录下不是文件的子项（目录、指向目录的链接），按名称排序
+    # scandir自带类型信息，不需要对每个子项再stat一次，只有符号链接需要
+    with os.scandir(path) as it:
+        names = [entry.name for entry in it if not entry.is_file()]
+    names.sort(key=lambda name: (name.casefold(), name))
+    return names
+
+
+class DirCache:
+    """
+    目录浏览的缓存，115挂载上一个目录有上万个子项时，列出一次要很久
+
+    按路径缓存排序后的子目录，同时记录列出时目录的修改时间，
+    有效期内再次访问只需要stat目录本身，修改时间不变就直接返回缓存，过期或者变化后重新列出
+    """
+    ttl: float
+    size: int
+    entries: OrderedDict[str, tuple[int, float, list[str]]] # 路径 => (目录的修改时间, 列出的时间, 子目录)
+    lock: threading.Lock
+
+    def __init__(self, ttl: float = DIR_CACHE_TTL, size: int = DIR_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = max(1, size)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def list(self, path: str) -> list[str]:
+        """
+        获取目录下的子目录，不能修改返回的列表
+        :param path: 目录
+        """
+        path = os.path.normpath(path)
+        mtime = os.stat(path).st_mtime_ns
+        with self.lock:
+            cached = self.entries.get(path)
+            if cached is not None and cached[0] == mtime and cached[1] + self.ttl > time.time():
+                self.entries.move_to_end(path)
+                return cached[2]
+        names = listSubDirs(path)
+        if self.ttl <= 0:
+            return names
+        with self.lock:
+            self.entries[path] = (mtime, time.time(), names)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return names
@@ -0,0 +1,64 @@
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+LOCK_DIR = os.path.abspath("./data/config/locks")
+
+
+class FileLock:
+    """
+    跨进程的文件锁，API、定时任务、监控服务各自在不同的进程中运行，
+    需要互斥的操作（例如同一个115账号的导出目录树）通过它协调
+    """
+    lock_file: str
+    fd: int | None
+
+    def __init__(self, name: str):
+        if not os.path.exists(LOCK_DIR):
+            os.makedirs(LOCK_DIR, exist_ok=True)
+        self.lock_file = os.path.join(LOCK_DIR, '%s.lock' % name)
+        self.fd = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        if blocking and fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            self.fd = fd
+            return True
+        while True:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                self.fd = fd
+                return True
+            except OSError:
+                if not blocking:
+                    os.close(fd)
+                    return False
+                time.sleep(0.2)
+
+    def release(self):
+        if self.fd is None:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            else:
+                msvcrt.locking(self.fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
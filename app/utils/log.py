@@ -8,10 +8,22 @@ class DetailedFormatter(logging.Formatter):
                  datefmt='%Y-%m-%d %H:%M:%S', *args) -> None:
         super().__init__(fmt, datefmt, *args)
         
+LOG_DIR = os.path.abspath("./data/logs")
+
+
+def logFile(name: str) -> str:
+    # 日志文件路径，API读取日志时使用同一个路径
+    return os.path.join(LOG_DIR, "{0}.log".format(name))
+
+
 def getLogger(name: str, clear: bool = False, stream: bool = False, rotating: bool = False):
     logger = logging.getLogger(name)
     logger.setLevel(logging.INFO)
-    logfile = os.path.abspath("./data/logs/{0}.log".format(name))
+    # 常驻进程中同一个日志会被多次获取（例如同一个同步目录多次执行），先移除之前添加的handler
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    logfile = logFile(name)
     if clear:
         with open(logfile, mode='w', encoding='utf-8') as f:
             f.write('')
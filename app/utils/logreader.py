@@ -0,0 +1,131 @@
+import asyncio
+import os
+from typing import AsyncIterator
+
+# 实时日志检查文件变化的间隔，秒
+LOG_STREAM_INTERVAL = float(os.getenv('LOG_STREAM_INTERVAL', '1'))
+# 实时日志没有新内容时发送心跳的间隔，秒，防止代理断开空闲连接
+LOG_STREAM_HEARTBEAT = float(os.getenv('LOG_STREAM_HEARTBEAT', '15'))
+
+
+class LogChunk:
+    """
+    日志的一段内容
+    start/end是内容在文件中的字节偏移，继续读取时把end作为下一次的offset
+    """
+    content: str
+    start: int
+    end: int
+    size: int # 读取时文件的大小
+
+    def __init__(self, content: str = '', start: int = 0, end: int = 0, size: int = 0):
+        self.content = content
+        self.start = start
+        self.end = end
+        self.size = size
+
+    def getJson(self) -> dict:
+        return {'content': self.content, 'start': self.start, 'end': self.end, 'size': self.size}
+
+
+def readRange(file: str, offset: int = 0, limit: int = 65536) -> LogChunk:
+    """
+    从offset开始读取最多limit字节，只返回完整的行，不会把一个字符截成两半
+    :param file: 日志文件
+    :param offset: 起始字节偏移，超出文件大小时(日志被清空重写了)从头开始读取
+    :param limit: 最多读取的字节数
+    """
+    if not os.path.exists(file):
+        return LogChunk()
+    with open(file, mode='rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if offset < 0 or offset > size:
+            offset = 0
+        f.seek(offset)
+        data = f.read(max(1, limit))
+    if offset + len(data) < size:
+        # 没有读到文件末尾，去掉最后不完整的一行；一行就超过limit时只能原样返回
+        pos = data.rfind(b'\n')
+        if pos >= 0:
+            data = data[:pos + 1]
+    return LogChunk(data.decode('utf-8', errors='replace'), offset, offset + len(data), size)
+
+
+def readTail(file: str, lines: int = 1000, block_size: int = 65536) -> LogChunk:
+    """
+    读取最后lines行，从文件末尾按块向前查找换行，不读取整个文件
+    :param file: 日志文件
+    :param lines: 行数
+    """
+    if not os.path.exists(file):
+        return LogChunk()
+    with open(file, mode='rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        pos = size
+        blocks = []
+        count = 0
+        # 末尾的换行不算一行，所以要找到lines+1个换行；只统计新读取的块，最后一次拼接
+        while pos > 0 and count <= lines:
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            block = f.read(step)
+            count += block.count(b'\n')
+            blocks.append(block)
+    blocks.reverse()
+    data = b''.join(blocks)
+    start = pos
+    parts = data.split(b'\n')
+    trailing = data.endswith(b'\n')
+    keep = lines + 1 if trailing else lines
+    if len(parts) > keep:
+        cut = len(data) - len(b'\n'.join(parts[-keep:]))
+        data = data[cut:]
+        start = pos + cut
+    return LogChunk(data.decode('utf-8', errors='replace'), start, size, size)
+
+
+def formatEvent(chunk: LogChunk, event: str = 'log') -> str:
+    # 一个SSE事件，id是下一次读取的偏移，断线重连时浏览器通过Last-Event-ID带回
+    lines = ['id: %d' % chunk.end, 'event: %s' % event]
+    for line in chunk.content.rstrip('\n').split('\n'):
+        lines.append('data: %s' % line)
+    return '\n'.join(lines) + '\n\n'
+
+
+async def followLog(file: str, offset: int | None = None, limit: int = 65536, is_disconnected=None) -> AsyncIterator[str]:
+    """
+    实时日志，生成SSE格式的事件，只推送新写入的行
+    每次只stat一次文件，没有新内容时不读取，开销和日志大小无关
+    同步任务开始时会清空日志，检测到文件变小时推送reset事件，然后从头开始推送
+    :param file: 日志文件
+    :param offset: 起始字节偏移，None表示从当前末尾开始
+    :param is_disconnected: 检查客户端是否已断开的协程函数
+    """
+    if offset is None:
+        offset = os.path.getsize(file) if os.path.exists(file) else 0
+    idle = 0.0
+    while True:
+        if is_disconnected is not None and await is_disconnected():
+            return
+        try:
+            size = os.path.getsize(file)
+        except OSError:
+            size = 0
+        if size < offset:
+            offset = 0
+            yield formatEvent(LogChunk('', 0, 0, size), 'reset')
+        if size > offset:
+            chunk = await asyncio.to_thread(readRange, file, offset, limit)
+            if chunk.end > offset:
+                offset = chunk.end
+                idle = 0
+                yield formatEvent(chunk)
+                # 还有没读完的内容时立即继续
+                if chunk.end < chunk.size:
+                    continue
+        if idle >= LOG_STREAM_HEARTBEAT:
+            idle = 0
+            yield ': ping\n\n'
+        await asyncio.sleep(LOG_STREAM_INTERVAL)
+        idle += LOG_STREAM_INTERVAL
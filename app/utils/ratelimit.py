@@ -0,0 +1,42 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    令牌桶限速，线程安全
+    令牌按rate每秒补充，最多积累capacity个；取令牌时不够的部分记为欠账，调用方睡眠到欠账还清，
+    多个线程同时取令牌时按顺序排队，总速度不会超过rate
+    """
+    rate: float # 每秒补充的令牌数，<=0表示不限速
+    capacity: float
+    tokens: float
+    updated_at: float
+    lock: threading.Lock
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = max(1.0, capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, n: float = 1) -> float:
+        # 预订n个令牌，返回需要等待的秒数
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= n
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def take(self, n: float = 1) -> float:
+        # 取n个令牌，不够时阻塞，返回等待的秒数
+        wait = self.reserve(n)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
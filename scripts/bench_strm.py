@@ -0,0 +1,95 @@
+"""
+STRM内容生成性能测试
+
+生成指定数量的剧集路径，对比旧的逐个文件拼接URL和StrmBuilder批量生成的耗时：
+
+    python scripts/bench_strm.py
+    python scripts/bench_strm.py -n 100000 -t Alist
+"""
+import argparse
+import os
+import random
+import time
+import urllib.parse
+from sys import path
+from os.path import dirname, abspath
+path.append(dirname(dirname(abspath(__file__))))
+
+from app.core.lib import Lib
+from app.core.strm import StrmBuilder
+
+
+def makeLib(type: str) -> Lib:
+    return Lib({
+        'key': 'bench',
+        'name': 'bench',
+        'path': '媒体库/电视剧',
+        'type': type,
+        'cloud_type': '115',
+        'path_of_115': '/mnt/115',
+        'strm_root_path': '/tmp/strm',
+        'webdav_url': '192.168.1.2:5244/dav',
+        'webdav_username': 'admin',
+        'webdav_password': 'admin',
+        'alist_server': 'http://192.168.1.2:5244/',
+        'alist_115_path': '115',
+    })
+
+
+def makePaths(size: int, seed: int = 115) -> list[str]:
+    # 每季约12集，每部剧2季
+    rnd = random.Random(seed)
+    paths = []
+    show = 0
+    while len(paths) < size:
+        show += 1
+        for season in range(1, 3):
+            season_dir = os.path.join('媒体库', '电视剧', '剧集 %d (20%02d)' % (show, show % 25), 'Season %d' % season)
+            for ep in range(1, rnd.randint(8, 16)):
+                paths.append(os.path.join(season_dir, '剧集 %d S%02dE%02d [1080p].mkv' % (show, season, ep)))
+    return paths[:size]
+
+
+def legacyBuild(lib: Lib, path: str) -> str:
+    # 原来Job.strm中拼接STRM内容的实现（不含挂载目录的处理），仅用于对比
+    if lib.type == '本地路径':
+        return os.path.join(lib.path_of_115, path)
+    path = path.replace(os.sep, '/')
+    newPath = []
+    for p in path.split('/'):
+        newPath.append(urllib.parse.quote(p))
+    if lib.type == 'WebDAV':
+        url = lib.webdav_url
+        if not url.startswith('http'):
+            url = "http://{0}".format(url)
+        url = url.replace('//', '//{0}:{1}@'.format(lib.webdav_username, lib.webdav_password))
+        if url.endswith('/'):
+            url = url.rstrip('/')
+        return '{0}/{1}'.format(url, '/'.join(newPath))
+    url = lib.alist_server
+    if url.endswith('/'):
+        url = url.rstrip('/')
+    return '{0}/d/{1}/{2}'.format(url, lib.alist_115_path.strip('/'), '/'.join(newPath))
+
+
+def bench(size: int, type: str):
+    lib = makeLib(type)
+    paths = makePaths(size)
+    start = time.perf_counter()
+    legacy = [legacyBuild(lib, p) for p in paths]
+    legacy_cost = time.perf_counter() - start
+    start = time.perf_counter()
+    contents = StrmBuilder(lib).buildMany(paths)
+    cost = time.perf_counter() - start
+    assert contents == legacy
+    print('%9d 个文件 [%s]: 旧实现 %.3fs, StrmBuilder %.3fs (%.1fx)' % (size, type, legacy_cost, cost, legacy_cost / max(cost, 1e-9)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='STRM内容生成性能测试')
+    parser.add_argument('-n', '--size', type=int, action='append', help='文件数量，可以多次指定')
+    parser.add_argument('-t', '--type', action='append', choices=['WebDAV', 'Alist', '本地路径'], help='STRM类型，可以多次指定')
+    args = parser.parse_args()
+    for type in args.type or ['WebDAV', 'Alist']:
+        for size in args.size or [10_000, 100_000, 1_000_000]:
+            bench(size, type)
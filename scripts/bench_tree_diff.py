@@ -0,0 +1,93 @@
+"""
+目录树比对性能测试
+
+生成指定规模的网盘目录树和本地STRM目录树，测试TreeDiff的耗时：
+
+    python scripts/bench_tree_diff.py
+    python scripts/bench_tree_diff.py -n 10000 -n 100000 --legacy
+"""
+import argparse
+import os
+import random
+import time
+from sys import path
+from os.path import dirname, abspath
+path.append(dirname(dirname(abspath(__file__))))
+
+from app.core.tree import diffTree
+
+STRM_EXT = ['.mkv', '.mp4', '.ts']
+META_EXT = ['.jpg', '.nfo', '.srt']
+
+
+def makeTrees(size: int, seed: int = 115) -> tuple[list[str], list[str]]:
+    # 每个剧集目录下：1个视频，1个nfo，1个封面
+    # 本地已有约90%的STRM，另外有约5%的STRM在网盘已被删除
+    rnd = random.Random(seed)
+    src = []
+    dest = []
+    show = 0
+    while len(src) < size:
+        show += 1
+        show_dir = os.path.join('Media', '电视剧', 'Show %d' % show)
+        src.append(show_dir)
+        dest.append(show_dir)
+        for ep in range(1, 21):
+            base = os.path.join(show_dir, 'S01E%02d' % ep)
+            src.append(base + rnd.choice(STRM_EXT))
+            src.append(base + '.nfo')
+            src.append(base + '-thumb.jpg')
+            if rnd.random() < 0.9:
+                dest.append(base + '.strm')
+                dest.append(base + '.nfo')
+            if rnd.random() < 0.05:
+                dest.append(os.path.join(show_dir, 'Removed E%02d.strm' % ep))
+    rnd.shuffle(dest)
+    return src[:size], dest
+
+
+def legacyParseTree(src_tree_list: list, dest_tree_list: list) -> tuple[list, list, list]:
+    # 原来Job.parseTree的实现，仅用于对比
+    copy_list = []
+    added = []
+    for src_item in src_tree_list:
+        if src_item in dest_tree_list:
+            dest_tree_list.remove(src_item)
+            continue
+        filename, ext = os.path.splitext(src_item)
+        if ext.lower() in STRM_EXT:
+            strm_file = filename + '.strm'
+            if strm_file in dest_tree_list:
+                dest_tree_list.remove(strm_file)
+                continue
+            else:
+                added.append(src_item)
+                continue
+        if ext.lower() in META_EXT:
+            copy_list.append(src_item)
+    return dest_tree_list, added, copy_list
+
+
+def bench(size: int, legacy: bool):
+    src, dest = makeTrees(size)
+    start = time.perf_counter()
+    result = diffTree(src, dest, STRM_EXT, META_EXT)
+    cost = time.perf_counter() - start
+    print('%9d 个路径 (本地 %d): %.3fs  新增 %d, 保留 %d, 删除 %d, 元数据 %d' % (
+        len(src), len(dest), cost, len(result.added), len(result.kept), len(result.orphaned), len(result.meta)))
+    if legacy:
+        start = time.perf_counter()
+        orphaned, added, copy_list = legacyParseTree(src, list(dest))
+        cost = time.perf_counter() - start
+        print('%9s 旧实现: %.3fs  新增 %d, 删除 %d, 元数据 %d' % ('', cost, len(added), len(orphaned), len(copy_list)))
+        assert sorted(orphaned) == sorted(result.orphaned)
+        assert added == result.added
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='目录树比对性能测试')
+    parser.add_argument('-n', '--size', type=int, action='append', help='网盘路径数量，可以多次指定')
+    parser.add_argument('--legacy', action='store_true', help='同时运行旧的列表实现（路径数量较大时非常慢）')
+    args = parser.parse_args()
+    for size in args.size or [10_000, 100_000, 1_000_000]:
+        bench(size, args.legacy)
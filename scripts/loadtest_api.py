@@ -0,0 +1,107 @@
+"""
+API并发压测
+
+模拟多个同时打开的页面轮询同步目录列表、同步进度和日志，统计每个接口的延迟分布，
+可以同时浏览一个很慢的挂载目录，检查慢请求是否会拖慢其他接口：
+
+    python scripts/loadtest_api.py -c 50 -d 30
+    python scripts/loadtest_api.py --url http://127.0.0.1:11566 -u admin -p admin --dir /mnt/115/Media
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+
+
+class Stats:
+    latencies: dict[str, list[float]]
+    errors: dict[str, int]
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, name: str, cost: float, ok: bool):
+        self.latencies.setdefault(name, []).append(cost)
+        if not ok:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, duration: float):
+        print('%-28s %8s %6s %9s %9s %9s %9s %9s' % ('接口', '请求数', '错误', 'req/s', 'p50(ms)', 'p90(ms)', 'p99(ms)', 'max(ms)'))
+        for name, values in sorted(self.latencies.items()):
+            values.sort()
+            print('%-28s %8d %6d %9.1f %9.1f %9.1f %9.1f %9.1f' % (
+                name, len(values), self.errors.get(name, 0), len(values) / duration,
+                percentile(values, 50), percentile(values, 90), percentile(values, 99), values[-1] * 1000))
+
+
+def percentile(values: list[float], p: float) -> float:
+    # values已经排序，返回毫秒
+    if len(values) == 0:
+        return 0
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index] * 1000
+
+
+async def request(client: httpx.AsyncClient, stats: Stats, name: str, method: str, url: str, **kwargs):
+    start = time.perf_counter()
+    ok = True
+    try:
+        resp = await client.request(method, url, **kwargs)
+        ok = resp.status_code < 400
+    except httpx.HTTPError:
+        ok = False
+    stats.add(name, time.perf_counter() - start, ok)
+
+
+async def poller(client: httpx.AsyncClient, stats: Stats, key: str | None, interval: float, deadline: float):
+    # 一个打开的页面：依次请求列表、进度和日志，然后等待下一次轮询
+    while time.time() < deadline:
+        await request(client, stats, 'GET /api/libs', 'GET', '/api/libs')
+        if key is not None:
+            await request(client, stats, 'GET /api/lib/progress/{key}', 'GET', '/api/lib/progress/%s' % key)
+            await request(client, stats, 'GET /api/lib/log/{key}/tail', 'GET', '/api/lib/log/%s/tail' % key, params={'lines': 100})
+        if interval > 0:
+            await asyncio.sleep(interval)
+
+
+async def browser(client: httpx.AsyncClient, stats: Stats, base_dir: str, deadline: float):
+    # 反复浏览同一个目录
+    while time.time() < deadline:
+        await request(client, stats, 'POST /api/dir', 'POST', '/api/dir', json={'base_dir': base_dir})
+
+
+async def main(args):
+    async with httpx.AsyncClient(base_url=args.url, timeout=60, limits=httpx.Limits(max_connections=args.concurrency + 4)) as client:
+        resp = await client.post('/api/login', json={'username': args.username, 'password': args.password})
+        resp.raise_for_status()
+        client.headers['Authorization'] = 'Bearer %s' % resp.json()['access_token']
+        try:
+            libs = (await client.get('/api/libs')).json()['data']
+            key = args.key or (libs[0]['key'] if len(libs) > 0 else None)
+            stats = Stats()
+            deadline = time.time() + args.duration
+            tasks = [poller(client, stats, key, args.interval, deadline) for _ in range(args.concurrency)]
+            if args.dir is not None:
+                tasks.extend(browser(client, stats, args.dir, deadline) for _ in range(args.dir_clients))
+            print('并发页面 %d 个，轮询间隔 %.1fs，持续 %ds，同步目录：%s' % (args.concurrency, args.interval, args.duration, key))
+            start = time.time()
+            await asyncio.gather(*tasks)
+            stats.report(time.time() - start)
+        finally:
+            await client.post('/api/logout')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='API并发压测')
+    parser.add_argument('--url', default='http://127.0.0.1:11566', help='API地址')
+    parser.add_argument('-u', '--username', default='admin')
+    parser.add_argument('-p', '--password', default='admin')
+    parser.add_argument('-c', '--concurrency', type=int, default=50, help='同时轮询的页面数')
+    parser.add_argument('-d', '--duration', type=int, default=30, help='持续时间，秒')
+    parser.add_argument('-i', '--interval', type=float, default=1, help='每个页面的轮询间隔，秒，0表示不间断')
+    parser.add_argument('-k', '--key', help='轮询进度和日志的同步目录，默认第一个')
+    parser.add_argument('--dir', help='同时浏览的目录，例如很慢的挂载目录')
+    parser.add_argument('--dir-clients', type=int, default=2, help='同时浏览目录的客户端数')
+    asyncio.run(main(parser.parse_args()))
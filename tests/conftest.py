@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# 各模块在导入时按当前目录确定 ./data 下的配置和日志路径，测试在临时目录中运行，不会写入仓库
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORK_DIR = tempfile.mkdtemp(prefix='q115-strm-test-')
+os.makedirs(os.path.join(WORK_DIR, 'data', 'logs'), exist_ok=True)
+os.makedirs(os.path.join(WORK_DIR, 'data', 'config'), exist_ok=True)
+os.chdir(WORK_DIR)
@@ -0,0 +1,66 @@
+import time
+
+import pytest
+
+from app.core.exportcache import ExportCache
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(ExportCache, 'cache_dir', str(tmp_path / 'exports'))
+    cache = ExportCache('account')
+    yield cache
+    cache.close()
+
+
+def record(cache: ExportCache, root: str, paths: list[str], reader: str) -> list[str]:
+    return list(cache.recordIter(root, iter(paths), reader))
+
+
+def test_exporter_does_not_read_its_own_export(cache):
+    paths = ['Media', 'Media/a', 'Media/a/e1.mkv']
+    assert record(cache, 'Media', paths, 'a') == paths
+    # 再次同步时必须重新导出
+    assert cache.findRoot('Media/a', 'a') is None
+    assert cache.findRoot('Media', 'a') is None
+
+
+def test_other_library_reads_export_once(cache):
+    record(cache, 'Media', ['Media', 'Media/a', 'Media/a/e1.mkv', 'Media/b', 'Media/b/x.mkv'], 'a')
+    assert cache.findRoot('Media/b', 'b') == 'Media'
+    assert cache.findRoot('/Media/b/', 'b') == 'Media'
+    assert list(cache.iterPaths('Media', 'Media/b')) == ['Media/b', 'Media/b/x.mkv']
+    cache.markRead('Media', 'b')
+    assert cache.findRoot('Media/b', 'b') is None
+    # 不在导出范围内的目录
+    assert cache.findRoot('Other', 'c') is None
+    assert cache.findRoot('MediaX', 'c') is None
+
+
+def test_new_export_resets_readers(cache):
+    record(cache, 'Media', ['Media', 'Media/b'], 'a')
+    cache.markRead('Media', 'b')
+    record(cache, 'Media', ['Media', 'Media/b', 'Media/b/y.mkv'], 'c')
+    assert cache.findRoot('Media/b', 'b') == 'Media'
+    assert cache.findRoot('Media/b', 'a') == 'Media'
+    assert list(cache.iterPaths('Media', 'Media/b')) == ['Media/b', 'Media/b/y.mkv']
+
+
+def test_expired_export_is_not_used(cache):
+    cache.ttl = 0.01
+    record(cache, 'Media', ['Media', 'Media/b'], 'a')
+    time.sleep(0.05)
+    assert cache.findRoot('Media/b', 'b') is None
+
+
+def test_failed_export_keeps_previous_cache(cache):
+    record(cache, 'Media', ['Media', 'Media/b'], 'a')
+
+    def broken():
+        yield 'Media'
+        raise OSError('export failed')
+
+    with pytest.raises(OSError):
+        list(cache.recordIter('Media', broken(), 'c'))
+    assert cache.findRoot('Media/b', 'b') == 'Media'
+    assert list(cache.iterPaths('Media', 'Media')) == ['Media', 'Media/b']
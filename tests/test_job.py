@@ -0,0 +1,194 @@
+import logging
+import os
+
+import pytest
+
+pytest.importorskip('p115client')
+
+from app.core.exportcache import ExportCache
+from app.core.lib import Lib, LibExtraStore, Libs, OO5List
+from app.core.progress import Progress
+from app.modules import job
+from app.modules.job import Job
+
+
+@pytest.fixture
+def libs(tmp_path, monkeypatch):
+    monkeypatch.setattr(Libs, 'libs_file', str(tmp_path / 'libs.json'))
+    monkeypatch.setattr(LibExtraStore, 'extra_dir', str(tmp_path / 'extra'))
+    monkeypatch.setattr(OO5List, 'oo5_files', str(tmp_path / '115.json'))
+    monkeypatch.setattr(ExportCache, 'cache_dir', str(tmp_path / 'exports'))
+    libs = Libs()
+    o5List = OO5List()
+    rs, msg = o5List.add({'name': 'account', 'cookie': 'cookie'})
+    assert rs, msg
+    monkeypatch.setattr(job, 'LIBS', libs)
+    monkeypatch.setattr(job, 'o5List', o5List)
+    return libs
+
+
+def addLib(libs: Libs, tmp_path, name: str, path: str) -> str:
+    account = job.o5List.getByCookie('cookie').key
+    rs, msg = libs.add({'name': name, 'path': path, 'strm_root_path': str(tmp_path), 'path_of_115': '', 'id_of_115': account})
+    assert rs, msg
+    return libs.getByName(name).key
+
+
+def setStatus(libs: Libs, key: str, status: int):
+    lib = libs.getLib(key)
+    lib.extra.status = status
+    libs.saveExtra(lib)
+
+
+class Cloud:
+    # 代替115导出，记录导出的根目录
+    def __init__(self, paths: list[str]):
+        self.paths = paths
+        self.exports = []
+
+    def exportTree(self, job: Job, root: str):
+        self.exports.append(root)
+        prefix = root.strip('/')
+        return (path for path in self.paths if path == prefix or path.startswith(prefix + '/'))
+
+
+def srcTree(key: str, cloud: Cloud, monkeypatch) -> list[str]:
+    monkeypatch.setattr(Job, 'exportTree', lambda self, root: cloud.exportTree(self, root))
+    return list(Job(key).iter_src_tree())
+
+
+def sep(*paths: str) -> list[str]:
+    return [path.replace('/', os.sep) for path in paths]
+
+
+def test_resync_exports_again(libs, tmp_path, monkeypatch):
+    # 同一个同步目录再次同步时重新导出，能看到网盘中的变化
+    movies = addLib(libs, tmp_path, 'movies', 'Media/Movies')
+    shows = addLib(libs, tmp_path, 'shows', 'Media/Shows')
+    addLib(libs, tmp_path, 'media', 'Media')
+    setStatus(libs, shows, 4)
+    cloud = Cloud(['Media', 'Media/Movies', 'Media/Movies/e1.mkv', 'Media/Shows', 'Media/Shows/s1.mkv'])
+    assert srcTree(movies, cloud, monkeypatch) == sep('Media/Movies', 'Media/Movies/e1.mkv')
+    assert cloud.exports == ['Media']
+    cloud.paths = ['Media', 'Media/Movies', 'Media/Movies/e2.mkv', 'Media/Shows', 'Media/Shows/s1.mkv']
+    assert srcTree(movies, cloud, monkeypatch) == sep('Media/Movies', 'Media/Movies/e2.mkv')
+    assert len(cloud.exports) == 2
+
+
+def test_queued_sibling_reads_shared_export_once(libs, tmp_path, monkeypatch):
+    movies = addLib(libs, tmp_path, 'movies', 'Media/Movies')
+    shows = addLib(libs, tmp_path, 'shows', 'Media/Shows')
+    addLib(libs, tmp_path, 'media', 'Media')
+    setStatus(libs, shows, 4)
+    cloud = Cloud(['Media', 'Media/Movies', 'Media/Movies/e1.mkv', 'Media/Shows', 'Media/Shows/s1.mkv'])
+    srcTree(movies, cloud, monkeypatch)
+    setStatus(libs, shows, 2)
+    assert srcTree(shows, cloud, monkeypatch) == sep('Media/Shows', 'Media/Shows/s1.mkv')
+    assert cloud.exports == ['Media']
+    # 读取过一次后，下次同步重新导出自己的目录
+    setStatus(libs, shows, 1)
+    srcTree(shows, cloud, monkeypatch)
+    assert cloud.exports == ['Media', 'Media/Shows']
+
+
+def test_export_root_not_widened_without_queued_library(libs, tmp_path, monkeypatch):
+    movies = addLib(libs, tmp_path, 'movies', 'Media/Movies')
+    addLib(libs, tmp_path, 'shows', 'Media/Shows')
+    addLib(libs, tmp_path, 'media', 'Media')
+    cloud = Cloud(['Media', 'Media/Movies', 'Media/Movies/e1.mkv', 'Media/Shows', 'Media/Shows/s1.mkv'])
+    assert srcTree(movies, cloud, monkeypatch) == sep('Media/Movies', 'Media/Movies/e1.mkv')
+    assert cloud.exports == ['Media/Movies']
+    # 没有其他同步目录读取，不写入缓存
+    assert not os.path.exists(ExportCache(job.o5List.getByCookie('cookie').key).cache_file)
+
+
+def test_export_root_covers_queued_libraries(libs, tmp_path, monkeypatch):
+    movies = addLib(libs, tmp_path, 'movies', 'Media/Movies')
+    addLib(libs, tmp_path, 'shows', 'Media/Shows')
+    media = addLib(libs, tmp_path, 'media', 'Media')
+    hd = addLib(libs, tmp_path, 'hd', 'Media/Movies/HD')
+    setStatus(libs, hd, 4)
+    root, shared = Job(movies).exportRoot()
+    assert root == 'Media/Movies'
+    assert [lib.key for lib in shared] == [hd]
+    setStatus(libs, media, 4)
+    root, shared = Job(movies).exportRoot()
+    assert root == 'Media'
+    assert sorted(lib.key for lib in shared) == sorted([hd, media])
+
+
+def deleteJob(root, dry_run: bool) -> Job:
+    # 不经过__init__，只准备删除阶段需要的属性
+    deleter = Job()
+    deleter.key = 'delete'
+    deleter.lib = Lib({'name': 'delete', 'path': 'Media', 'strm_root_path': str(root), 'cloud_type': '115'})
+    deleter.dry_run = dry_run
+    deleter.logger = logging.getLogger('test-delete')
+    deleter.progress = Progress('delete', enabled=False)
+    return deleter
+
+
+@pytest.fixture
+def strmTree(tmp_path):
+    root = tmp_path / 'strm'
+    for rel in ['Media/Movies/a.strm', 'Media/Movies/a.nfo', 'Media/Movies/Gone/b.strm', 'Media/Movies/Gone/b.nfo',
+                'Media/Shows/S1/x.strm', 'Media/Shows/S1/x.nfo', 'Media/Shows/S1/poster.jpg', 'Media/Extras/readme.nfo']:
+        path = root / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(rel)
+    return root
+
+
+def listTree(root) -> list[str]:
+    return sorted(str(path.relative_to(root)).replace(os.sep, '/') for path in root.rglob('*'))
+
+
+ORPHANED = sep('Media/Movies/Gone', 'Media/Movies/Gone/b.strm', 'Media/Shows/S1/x.strm', 'Media/Shows/missing.strm')
+
+
+def test_delete_dry_run_changes_nothing(strmTree, caplog):
+    before = listTree(strmTree)
+    deleter = deleteJob(strmTree, True)
+    with caplog.at_level(logging.INFO, logger='test-delete'):
+        deleter.doDelete(list(ORPHANED))
+    assert listTree(strmTree) == before
+    assert deleter.lib.extra.last_sync_result['delete'] == [4, 4]
+    planned = [record.getMessage() for record in caplog.records]
+    assert any('计划删除网盘不存在的文件夹' in msg and msg.endswith(os.path.join('Movies', 'Gone')) for msg in planned)
+    assert any('计划删除网盘不存在的文件' in msg and msg.endswith('x.strm') for msg in planned)
+    # 删除x.strm后S1只剩元数据，S1清理后Shows也是空的，自底向上都会清理
+    swept = sorted(msg.rsplit(os.sep, 1)[-1] for msg in planned if '计划删除没有STRM的文件夹' in msg)
+    assert swept == ['S1', 'Shows']
+    summary = [msg for msg in planned if msg.startswith('删除计划')]
+    assert summary == ['删除计划：STRM文件 2 个，文件夹 1 个，清理文件夹 2 个，共 0.00 MB']
+
+
+def test_delete_sweeps_empty_dirs_bottom_up(strmTree):
+    deleter = deleteJob(strmTree, False)
+    deleter.doDelete(list(ORPHANED))
+    assert listTree(strmTree) == [
+        'Media',
+        'Media/Extras',
+        'Media/Extras/readme.nfo',
+        'Media/Movies',
+        'Media/Movies/a.nfo',
+        'Media/Movies/a.strm',
+    ]
+    assert deleter.lib.extra.last_sync_result['delete'] == [4, 4]
+
+
+def test_delete_keeps_non_strm_files_and_library_root(strmTree):
+    deleter = deleteJob(strmTree, False)
+    deleter.doDelete(sep('Media/Movies/a.strm', 'Media/Movies/a.nfo', 'Media/Movies/Gone'))
+    # a.nfo不是STRM文件，不单独删除；Movies中没有STRM和子文件夹后整个清理，同步目录的根文件夹保留
+    assert listTree(strmTree) == [
+        'Media',
+        'Media/Extras',
+        'Media/Extras/readme.nfo',
+        'Media/Shows',
+        'Media/Shows/S1',
+        'Media/Shows/S1/poster.jpg',
+        'Media/Shows/S1/x.nfo',
+        'Media/Shows/S1/x.strm',
+    ]
+    assert deleter.lib.extra.last_sync_result['delete'] == [2, 3]
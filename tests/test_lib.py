@@ -0,0 +1,167 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from app.core.lib import ConfigFile, LibExtraStore, Libs, OO5List
+
+
+@pytest.fixture
+def libs(tmp_path, monkeypatch):
+    monkeypatch.setattr(Libs, 'libs_file', str(tmp_path / 'libs.json'))
+    monkeypatch.setattr(LibExtraStore, 'extra_dir', str(tmp_path / 'extra'))
+    return Libs()
+
+
+@pytest.fixture
+def o5List(tmp_path, monkeypatch):
+    monkeypatch.setattr(OO5List, 'oo5_files', str(tmp_path / '115.json'))
+    return OO5List()
+
+
+def libData(tmp_path, name: str) -> dict:
+    return {'name': name, 'path': 'Media/%s' % name, 'strm_root_path': str(tmp_path), 'path_of_115': ''}
+
+
+def runConcurrently(writers: list, readers: list):
+    # 写线程全部结束后再停止读线程，返回读线程中出现的异常
+    errors = []
+    stop = threading.Event()
+
+    def read(func):
+        while not stop.is_set():
+            try:
+                func()
+            except Exception as e:
+                errors.append(e)
+
+    readThreads = [threading.Thread(target=read, args=(func,)) for func in readers]
+    writeThreads = [threading.Thread(target=func) for func in writers]
+    for t in readThreads + writeThreads:
+        t.start()
+    for t in writeThreads:
+        t.join()
+    stop.set()
+    for t in readThreads:
+        t.join()
+    return errors
+
+
+def test_concurrent_add_and_list(libs, tmp_path):
+    results = []
+
+    def add(n: int):
+        for i in range(100):
+            results.append(libs.add(libData(tmp_path, 'lib-%d-%d' % (n, i))))
+
+    errors = runConcurrently([lambda n=n: add(n) for n in range(3)], [libs.list] * 4)
+    assert errors == []
+    assert all(rs for rs, _ in results)
+    with open(libs.libs_file, encoding='utf-8') as f:
+        assert len(json.load(f)) == 300
+    assert len(Libs().list()) == 300
+
+
+def test_concurrent_update_and_delete(libs, tmp_path):
+    for i in range(50):
+        libs.add(libData(tmp_path, 'lib-%d' % i))
+    keys = [lib.key for lib in libs.list()]
+
+    def update():
+        for key in keys[:25]:
+            lib = libs.getLib(key)
+            data = lib.getJson()
+            data['name'] = lib.name + '-new'
+            assert libs.updateLib(key, data) == (True, '')
+
+    def delete():
+        for key in keys[25:]:
+            assert libs.deleteLib(key) == (True, '')
+
+    errors = runConcurrently([update, delete], [libs.list] * 2)
+    assert errors == []
+    names = sorted(lib.name for lib in Libs().list())
+    assert names == sorted(libs.getLib(key).name for key in keys[:25])
+    assert all(name.endswith('-new') for name in names)
+
+
+def test_returned_lib_is_a_copy(libs, tmp_path):
+    libs.add(libData(tmp_path, 'lib'))
+    lib = libs.list()[0]
+    lib.name = 'changed'
+    lib.extra.status = 2
+    again = libs.getLib(lib.key)
+    assert again.name == 'lib'
+    assert again.extra.status == 1
+
+
+def test_concurrent_oo5_add_and_list(o5List):
+    def add(n: int):
+        for i in range(50):
+            assert o5List.add({'name': 'oo5-%d-%d' % (n, i), 'cookie': 'cookie-%d-%d' % (n, i)}) == (True, '')
+
+    def setStatus():
+        for _ in range(50):
+            for oo5 in o5List.getList():
+                o5List.setStatus(oo5.key, 1)
+
+    errors = runConcurrently([lambda n=n: add(n) for n in range(3)] + [setStatus], [o5List.getList] * 3)
+    assert errors == []
+    with open(o5List.oo5_files, encoding='utf-8') as f:
+        assert len(json.load(f)) == 150
+    assert len(OO5List().getList()) == 150
+
+
+SET_STATUS_SCRIPT = '''
+import sys
+from app.core.lib import OO5List
+OO5List.oo5_files = sys.argv[1]
+o5List = OO5List()
+for i in range(int(sys.argv[3])):
+    o5List.setStatus(sys.argv[2], i % 2)
+'''
+
+
+def test_status_from_other_process_keeps_new_accounts(o5List):
+    # 同步进程修改账号状态的同时，API进程添加账号，同步进程不能用旧的列表覆盖
+    assert o5List.add({'name': 'oo5', 'cookie': 'cookie'}) == (True, '')
+    key = o5List.getByCookie('cookie').key
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    procs = [subprocess.Popen([sys.executable, '-c', SET_STATUS_SCRIPT, o5List.oo5_files, key, '500'], env=env) for _ in range(2)]
+    i = 0
+    while i < 100 or any(proc.poll() is None for proc in procs):
+        i += 1
+        assert o5List.add({'name': 'oo5-%d' % i, 'cookie': 'cookie-%d' % i}) == (True, '')
+    assert [proc.wait() for proc in procs] == [0, 0]
+    assert len(OO5List().getList()) == i + 1
+
+
+def test_status_is_not_set_for_replaced_cookie(o5List):
+    assert o5List.add({'name': 'oo5', 'cookie': 'old'}) == (True, '')
+    key = o5List.getByCookie('old').key
+    o5List.updateOO5(key, {'name': 'oo5', 'cookie': 'new'})
+    # 用旧cookie检查出的失效不能标记到新cookie上
+    o5List.setStatus(key, 1, 'old')
+    assert o5List.get(key).status == 0
+    o5List.setStatus(key, 1, 'new')
+    assert o5List.get(key).status == 1
+
+
+def test_config_reloads_same_size_rewrite(tmp_path):
+    # 其他进程在同一个时间精度内写入大小相同的内容
+    file = str(tmp_path / 'setting.json')
+    store = ConfigFile(file, dict)
+    store.save({'value': 'a'}, {'value': 'a'})
+    assert store.load() == {'value': 'a'}
+    st = os.stat(file)
+    tmpFile = file + '.other'
+    with open(tmpFile, mode='w', encoding='utf-8') as f:
+        json.dump({'value': 'b'}, f)
+    os.utime(tmpFile, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(tmpFile, file)
+    assert os.stat(file).st_size == st.st_size
+    assert store.load() == {'value': 'b'}
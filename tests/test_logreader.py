@@ -0,0 +1,41 @@
+import pytest
+
+from app.utils.logreader import readRange, readTail
+
+
+def naiveTail(content: bytes, lines: int) -> bytes:
+    # 按行切分后取最后lines行，末尾的换行不算一行
+    parts = content.split(b'\n')
+    if content.endswith(b'\n'):
+        return b'\n'.join(parts[-lines - 1:])
+    return b'\n'.join(parts[-lines:])
+
+
+@pytest.mark.parametrize('trailing', [True, False])
+@pytest.mark.parametrize('block_size', [7, 64, 65536])
+@pytest.mark.parametrize('lines', [1, 3, 50, 500, 1000])
+def test_read_tail_matches_split(tmp_path, trailing, block_size, lines):
+    content = '\n'.join('第%d行 %s' % (i, 'x' * (i % 13)) for i in range(600)).encode('utf-8')
+    if trailing:
+        content += b'\n'
+    file = tmp_path / 'job.log'
+    file.write_bytes(content)
+    chunk = readTail(str(file), lines, block_size=block_size)
+    expected = naiveTail(content, lines)
+    assert chunk.content == expected.decode('utf-8')
+    assert chunk.start == len(content) - len(expected)
+    assert chunk.end == chunk.size == len(content)
+
+
+def test_read_tail_missing_file(tmp_path):
+    chunk = readTail(str(tmp_path / 'missing.log'), 10)
+    assert (chunk.content, chunk.start, chunk.end, chunk.size) == ('', 0, 0, 0)
+
+
+def test_read_range_returns_whole_lines(tmp_path):
+    file = tmp_path / 'job.log'
+    file.write_bytes(b'one\ntwo\nthree\n')
+    chunk = readRange(str(file), 0, 10)
+    assert (chunk.content, chunk.end) == ('one\ntwo\n', 8)
+    chunk = readRange(str(file), chunk.end, 10)
+    assert (chunk.content, chunk.end) == ('three\n', 14)
@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+from app.core import meta
+from app.core.meta import MetaCopier, metaStamp
+
+
+class Bucket:
+    # 记录取令牌的顺序，代替TokenBucket
+    def __init__(self, name: str, events: list):
+        self.name = name
+        self.events = events
+
+    def take(self, n: float = 1) -> float:
+        self.events.append((self.name, n))
+        return 0
+
+
+@pytest.fixture
+def events(tmp_path, monkeypatch):
+    # 记录对挂载目录(src)的stat和取令牌的顺序
+    events = []
+    src_dir = str(tmp_path / 'src')
+    stat = os.stat
+
+    def recordStat(path, *args, **kwargs):
+        if str(path).startswith(src_dir):
+            events.append(('stat', os.path.basename(path)))
+        return stat(path, *args, **kwargs)
+
+    monkeypatch.setattr(meta.os, 'stat', recordStat)
+    return events
+
+
+def makeCopier(events: list, manifest: dict) -> MetaCopier:
+    copier = MetaCopier(workers=1, manifest=manifest)
+    copier.files = Bucket('files', events)
+    copier.bytes = Bucket('bytes', events)
+    return copier
+
+
+def writeFile(path, content: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, mode='w', encoding='utf-8') as f:
+        f.write(content)
+
+
+def test_unchanged_files_take_a_file_token_before_stat(tmp_path, events):
+    manifest = {}
+    items = []
+    for name in ['a.nfo', 'b.nfo', 'c.jpg']:
+        src = str(tmp_path / 'src' / name)
+        dest = str(tmp_path / 'dest' / name)
+        writeFile(src, name)
+        writeFile(dest, name)
+        manifest[name] = metaStamp(os.stat(src))
+        items.append((name, src, dest))
+    events.clear()
+    results = list(makeCopier(events, manifest).copy(items))
+    assert sorted(results) == [('a.nfo', False, None), ('b.nfo', False, None), ('c.jpg', False, None)]
+    assert events == [('files', 1), ('stat', 'a.nfo'), ('files', 1), ('stat', 'b.nfo'), ('files', 1), ('stat', 'c.jpg')]
+
+
+def test_changed_file_copies_with_the_same_file_token(tmp_path, events):
+    src = str(tmp_path / 'src' / 'a.nfo')
+    dest = str(tmp_path / 'dest' / 'a.nfo')
+    writeFile(src, 'new content')
+    writeFile(dest, 'old')
+    copier = makeCopier(events, {'a.nfo': (3, 0)})
+    assert list(copier.copy([('a.nfo', src, dest)])) == [('a.nfo', True, None)]
+    assert events[:3] == [('files', 1), ('stat', 'a.nfo'), ('bytes', len('new content'))]
+    assert [event for event in events if event[0] == 'files'] == [('files', 1)]
+    with open(dest, encoding='utf-8') as f:
+        assert f.read() == 'new content'
+    assert copier.updated == {'a.nfo': metaStamp(os.stat(src))}
+
+
+def test_missing_source_still_takes_a_token(tmp_path, events):
+    src = str(tmp_path / 'src' / 'missing.nfo')
+    dest = str(tmp_path / 'dest' / 'missing.nfo')
+    results = list(makeCopier(events, {}).copy([('missing.nfo', src, dest)]))
+    assert len(results) == 1 and isinstance(results[0][2], FileNotFoundError)
+    assert events[0] == ('files', 1)
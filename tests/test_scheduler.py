@@ -0,0 +1,135 @@
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+pytest.importorskip('p115client')
+
+from app.core.lib import LibExtraStore, Libs, OO5List
+from app.modules import job
+from app.modules.scheduler import JobScheduler
+
+
+@pytest.fixture
+def libs(tmp_path, monkeypatch):
+    # 同步进程由spawn启动，重新导入模块时按当前目录确定配置路径，测试进程使用同一组路径
+    config = tmp_path / 'data' / 'config'
+    config.mkdir(parents=True)
+    (tmp_path / 'data' / 'logs').mkdir()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(Libs, 'libs_file', str(config / 'libs.json'))
+    monkeypatch.setattr(LibExtraStore, 'extra_dir', str(config / 'extra'))
+    monkeypatch.setattr(OO5List, 'oo5_files', str(config / '115.json'))
+    return Libs()
+
+
+@pytest.fixture
+def scheduler(libs):
+    scheduler = JobScheduler(max_workers=1, libs=libs)
+    yield scheduler
+    for worker in scheduler.workers:
+        worker.process.kill()
+        worker.close()
+
+
+def addLib(libs: Libs, tmp_path, name: str, id_of_115: str) -> str:
+    rs, msg = libs.add({'name': name, 'path': 'Media/%s' % name, 'strm_root_path': str(tmp_path), 'path_of_115': '', 'id_of_115': id_of_115})
+    assert rs, msg
+    return libs.getByName(name).key
+
+
+def test_missing_account_returns_lib_and_worker(libs, scheduler, tmp_path):
+    # Job初始化时找不到115账号，任务失败但同步进程不会退出
+    key = addLib(libs, tmp_path, 'lib', 'missing-account')
+    assert scheduler.submit(key) == (True, '')
+    scheduler.wait()
+    lib = libs.getLib(key)
+    assert lib.extra.status == 3
+    assert lib.extra.pid == 0
+    stats = scheduler.stats()
+    assert stats['queued'] == [] and stats['running'] == {}
+    assert len(scheduler.idle) == 1 and scheduler.idle[0].process.is_alive()
+    pid = scheduler.idle[0].pid
+    # 同一个进程可以继续执行下一个任务
+    assert scheduler.submit(key) == (True, '')
+    scheduler.wait()
+    assert libs.getLib(key).extra.status == 3
+    assert [worker.pid for worker in scheduler.idle] == [pid]
+
+
+def test_deleted_lib_returns_worker(libs, scheduler, tmp_path):
+    key = addLib(libs, tmp_path, 'lib', 'missing-account')
+    assert scheduler.submit(key) == (True, '')
+    libs.deleteLib(key)
+    scheduler.wait()
+    assert libs.getLib(key) is None
+    assert scheduler.stats()['running'] == {}
+    assert len(scheduler.idle) == len(scheduler.workers) == 1
+
+
+def test_submit_unknown_key(scheduler):
+    assert scheduler.submit('unknown') == (False, '同步目录不存在')
+    assert scheduler.stats()['queued'] == []
+
+
+def test_log_stream_reaches_terminal(libs, scheduler, tmp_path, capfd):
+    # 命令行执行时，同步进程的日志输出到继承的终端
+    key = addLib(libs, tmp_path, 'lib', 'missing-account')
+    assert scheduler.submit(key, logStream=True) == (True, '')
+    scheduler.wait()
+    assert '无法找到所选的115账号' in capfd.readouterr().err
+
+
+def test_worker_does_not_inherit_held_locks(libs, scheduler, tmp_path):
+    # API的其他线程持有配置文件的锁时创建同步进程，同步进程不能继承这个锁
+    key = addLib(libs, tmp_path, 'lib', 'missing-account')
+    held = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with job.LIBS.store.lock:
+            held.set()
+            release.wait()
+
+    holder = threading.Thread(target=hold, daemon=True)
+    holder.start()
+    held.wait()
+    try:
+        assert scheduler.submit(key) == (True, '')
+    finally:
+        release.set()
+        holder.join()
+    done = threading.Thread(target=scheduler.wait, daemon=True)
+    done.start()
+    done.join(timeout=60)
+    assert not done.is_alive()
+    assert libs.getLib(key).extra.status == 3
+
+
+def test_submit_rejects_lib_running_in_other_process(libs, scheduler, tmp_path):
+    # 其他进程的调度器正在同步该目录
+    key = addLib(libs, tmp_path, 'lib', 'missing-account')
+    lib = libs.getLib(key)
+    lib.extra.status = 2
+    lib.extra.pid = os.getpid()
+    libs.saveExtra(lib)
+    assert scheduler.submit(key) == (False, '该目录正在同步中...')
+    lib = libs.getLib(key)
+    assert lib.extra.status == 2 and lib.extra.pid == os.getpid()
+    assert scheduler.workers == []
+
+
+def test_submit_accepts_lib_with_stale_running_status(libs, scheduler, tmp_path):
+    # 上次同步的进程已经不存在
+    key = addLib(libs, tmp_path, 'lib', 'missing-account')
+    proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+    proc.wait()
+    lib = libs.getLib(key)
+    lib.extra.status = 2
+    lib.extra.pid = proc.pid
+    libs.saveExtra(lib)
+    assert scheduler.submit(key) == (True, '')
+    scheduler.wait()
+    assert libs.getLib(key).extra.status == 3
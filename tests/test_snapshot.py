@@ -0,0 +1,67 @@
+import pytest
+
+from app.core.snapshot import TreeSnapshot
+
+
+@pytest.fixture
+def snapshotDir(tmp_path, monkeypatch):
+    monkeypatch.setattr(TreeSnapshot, 'snapshot_dir', str(tmp_path / 'snapshots'))
+
+
+def sync(paths: list[str], ok: bool = True) -> tuple[list[str], list[str]]:
+    # 一次同步：逐个feed，读取删除的路径，成功时提交，失败时丢弃
+    snapshot = TreeSnapshot('lib')
+    added = [path for path in paths if snapshot.feed(path)]
+    removed = list(snapshot.removed())
+    if ok:
+        snapshot.commit()
+    else:
+        snapshot.discard()
+    return added, removed
+
+
+def test_first_sync_has_no_snapshot(snapshotDir):
+    assert not TreeSnapshot('lib').exists()
+    added, removed = sync(['Movies', 'Movies/a.mkv'])
+    assert added == ['Movies', 'Movies/a.mkv']
+    assert removed == []
+    assert TreeSnapshot('lib').exists()
+
+
+def test_feed_reports_only_changes(snapshotDir):
+    sync(['Movies', 'Movies/a.mkv', 'Movies/b.mkv'])
+    added, removed = sync(['Movies', 'Movies/a.mkv', 'Movies/c.mkv'])
+    assert added == ['Movies/c.mkv']
+    assert removed == ['Movies/b.mkv']
+    # 提交后新的目录树成为下一次比对的基准
+    assert sync(['Movies', 'Movies/a.mkv', 'Movies/c.mkv']) == ([], [])
+
+
+def test_discard_keeps_previous_snapshot(snapshotDir):
+    sync(['Movies', 'Movies/a.mkv'])
+    assert sync(['Movies', 'Movies/b.mkv'], ok=False) == (['Movies/b.mkv'], ['Movies/a.mkv'])
+    # 失败的同步没有替换快照，下次同步时重新处理同样的变化
+    assert sync(['Movies', 'Movies/b.mkv']) == (['Movies/b.mkv'], ['Movies/a.mkv'])
+
+
+def test_feed_across_batches(snapshotDir, monkeypatch):
+    monkeypatch.setattr(TreeSnapshot, 'batch_size', 3)
+    old = ['Movies/%03d.mkv' % i for i in range(10)]
+    sync(old)
+    new = old[2:] + ['Movies/%03d.mkv' % i for i in range(10, 14)]
+    added, removed = sync(new)
+    assert added == ['Movies/%03d.mkv' % i for i in range(10, 14)]
+    assert removed == old[:2]
+
+
+def test_record_iter_for_full_sync(snapshotDir):
+    snapshot = TreeSnapshot('lib')
+    assert list(snapshot.recordIter(iter(['Movies', 'Movies/a.mkv']))) == ['Movies', 'Movies/a.mkv']
+    snapshot.commit()
+    assert sync(['Movies']) == ([], ['Movies/a.mkv'])
+
+
+def test_delete(snapshotDir):
+    sync(['Movies'])
+    TreeSnapshot('lib').delete()
+    assert not TreeSnapshot('lib').exists()
@@ -0,0 +1,98 @@
+import os
+import urllib.parse
+
+import pytest
+
+from app.core.lib import Lib
+from app.core.strm import StrmBuilder
+
+PATHS = [
+    os.path.join('媒体库', '电视剧', '剧集 1 (2020)', 'Season 1', '剧集 1 S01E01 [1080p].mkv'),
+    os.path.join('媒体库', '电视剧', '剧集 1 (2020)', 'Season 1', '剧集 1 S01E02 #2 & 100%.mkv'),
+    os.path.join('媒体库', '电影', 'A?B.mp4'),
+    'root.mkv',
+]
+
+
+def makeLib(**data) -> Lib:
+    lib = {
+        'key': 'strm',
+        'name': 'strm',
+        'path': '媒体库',
+        'cloud_type': '115',
+        'path_of_115': os.path.join(os.sep, 'mnt', '115'),
+        'strm_root_path': os.path.join(os.sep, 'tmp', 'strm'),
+        'webdav_url': 'http://192.168.1.2:5244/dav/',
+        'webdav_username': 'admin',
+        'webdav_password': 'p@ss',
+        'alist_server': 'http://192.168.1.2:5244/',
+        'alist_115_path': '/115/',
+    }
+    lib.update(data)
+    return Lib(lib)
+
+
+def legacyBuild(lib: Lib, path: str) -> str:
+    # 原来Job.strm中拼接STRM内容的实现，挂载根文件夹按完整的目录名去掉
+    if lib.type == '本地路径':
+        if lib.cloud_type == '115':
+            return os.path.join(lib.path_of_115, path)
+        return os.path.join(lib.path, path)
+    path = path.replace(os.sep, '/')
+    mount_path = lib.mount_path.strip('/')
+    if mount_path != '' and path.startswith(mount_path + '/'):
+        path = path[len(mount_path) + 1:]
+    newPath = []
+    for p in path.split('/'):
+        newPath.append(urllib.parse.quote(p))
+    if lib.type == 'WebDAV':
+        url = lib.webdav_url.replace('//', '//{0}:{1}@'.format(lib.webdav_username, lib.webdav_password))
+        if url.endswith('/'):
+            url = url.rstrip('/')
+        return '{0}/{1}'.format(url, '/'.join(newPath))
+    url = lib.alist_server
+    if url.endswith('/'):
+        url = url.rstrip('/')
+    return '{0}/d/{1}/{2}'.format(url, lib.alist_115_path.strip('/'), '/'.join(newPath))
+
+
+@pytest.mark.parametrize('lib', [
+    makeLib(type='本地路径'),
+    makeLib(type='本地路径', cloud_type='other', path=os.path.join(os.sep, 'data', 'media')),
+    makeLib(type='WebDAV'),
+    makeLib(type='alist302'),
+    makeLib(type='alist302', mount_path='/媒体库/'),
+], ids=['local-115', 'local-other', 'webdav', 'alist', 'alist-mount'])
+def test_build_matches_legacy(lib):
+    builder = StrmBuilder(lib)
+    expected = [legacyBuild(lib, path) for path in PATHS]
+    assert [builder.build(path) for path in PATHS] == expected
+    # 批量生成和逐个生成一致，重复生成时使用缓存的目录前缀
+    assert builder.buildMany(PATHS) == expected
+    assert builder.buildMany(PATHS) == expected
+
+
+def test_alist_mount_path_strips_whole_directory():
+    # 原来用lstrip按字符去掉挂载根文件夹，会把"媒体"开头的其他目录也截掉
+    builder = StrmBuilder(makeLib(type='alist302', mount_path='媒体'))
+    assert builder.build(os.path.join('媒体库', 'a.mkv')) == 'http://192.168.1.2:5244/d/115/%E5%AA%92%E4%BD%93%E5%BA%93/a.mkv'
+    assert builder.build(os.path.join('媒体', 'a.mkv')) == 'http://192.168.1.2:5244/d/115/a.mkv'
+
+
+def test_alist_without_115_path():
+    builder = StrmBuilder(makeLib(type='alist302', alist_115_path=''))
+    assert builder.build('a.mkv') == 'http://192.168.1.2:5244/d/a.mkv'
+
+
+def test_webdav_without_scheme_or_credentials():
+    builder = StrmBuilder(makeLib(type='WebDAV', webdav_url='192.168.1.2:5244/dav', webdav_username='', webdav_password=''))
+    assert builder.build(os.path.join('a b', 'c.mkv')) == 'http://192.168.1.2:5244/dav/a%20b/c.mkv'
+    builder = StrmBuilder(makeLib(type='WebDAV', webdav_url='192.168.1.2:5244/dav'))
+    assert builder.build('c.mkv') == 'http://admin:p@ss@192.168.1.2:5244/dav/c.mkv'
+
+
+def test_get_ext_from_content():
+    builder = StrmBuilder(makeLib(type='alist302'))
+    assert builder.getExt(builder.build(PATHS[2])) == '.mp4'
+    builder = StrmBuilder(makeLib(type='本地路径'))
+    assert builder.getExt(builder.build(PATHS[0]) + '\n') == '.mkv'
@@ -0,0 +1,55 @@
+import os
+
+from app.core.tree import TreeDiff, diffTree
+
+STRM_EXT = ['.mkv', '.MP4']
+META_EXT = ['.nfo', '.jpg']
+
+
+def p(*parts: str) -> str:
+    return os.path.join(*parts)
+
+
+def test_new_video_is_added():
+    result = diffTree([p('Movies', 'a.mkv')], [], STRM_EXT, META_EXT)
+    assert result.added == [p('Movies', 'a.mkv')]
+    assert result.kept == [] and result.orphaned == []
+
+
+def test_existing_strm_is_unchanged():
+    dest = ['Movies', p('Movies', 'a.strm')]
+    result = diffTree(['Movies', p('Movies', 'a.mkv')], dest, STRM_EXT, META_EXT)
+    assert result.added == []
+    assert result.kept == ['Movies', p('Movies', 'a.mkv')]
+    assert result.orphaned == []
+
+
+def test_extension_match_is_case_insensitive():
+    # 扩展名不区分大小写，.strm对应任何一种视频扩展名
+    result = diffTree([p('Movies', 'a.Mp4'), p('Movies', 'b.MKV')], [p('Movies', 'a.strm')], STRM_EXT, META_EXT)
+    assert result.added == [p('Movies', 'b.MKV')]
+    assert result.kept == [p('Movies', 'a.Mp4')]
+
+
+def test_removed_items_are_orphaned_in_local_order():
+    dest = ['Movies', p('Movies', 'a.strm'), p('Movies', 'gone'), p('Movies', 'gone', 'b.strm'), p('Movies', 'a.nfo')]
+    result = diffTree(['Movies', p('Movies', 'a.mkv')], dest, STRM_EXT, META_EXT)
+    assert result.orphaned == [p('Movies', 'gone'), p('Movies', 'gone', 'b.strm'), p('Movies', 'a.nfo')]
+
+
+def test_meta_and_other_files():
+    src = [p('Movies', 'a.nfo'), p('Movies', 'a.jpg'), p('Movies', 'a.txt')]
+    result = diffTree(src, [p('Movies', 'a.jpg')], STRM_EXT, META_EXT)
+    # 已经复制过的元数据算作已存在，其他扩展名不处理
+    assert result.meta == [p('Movies', 'a.nfo')]
+    assert result.kept == [p('Movies', 'a.jpg')]
+    assert result.added == [] and result.orphaned == []
+
+
+def test_streaming_classify_matches_diff():
+    dest = ['Movies', p('Movies', 'a.strm'), p('Movies', 'c.strm')]
+    src = ['Movies', p('Movies', 'a.mkv'), p('Movies', 'b.mkv'), p('Movies', 'b.nfo')]
+    diff = TreeDiff(iter(dest), STRM_EXT, META_EXT)
+    actions = [diff.classify(item) for item in src]
+    assert actions == ['kept', 'kept', 'added', 'meta']
+    assert diff.orphaned() == [p('Movies', 'c.strm')]